@@ -24,6 +24,20 @@ OUTPUT
 	             Used to respond to GET messages got through Serial.
 	Error    --> 2 bytes | 0b10000000 + E (69), errorcode (0-127)
 
+	Protocol 2 (S V 2) replaces A and D frames with one frame per loop each.
+	Masks are 7 bits per byte, bit i of byte j is the pin of index 7*j+i.
+
+	Analog2  --> 0b10000000 + a (97), mask (1 byte per 7 analog pins),
+	             ValueHI, ValueLO for each pin in the mask, lowest first
+	Digital2 --> 0b10000000 + d (100), changed mask, state mask
+	             (1 byte per 7 digital pins each). All pins are marked
+	             as changed after a forced read (F)
+
+	Time     --> 4 bytes | 0b10000000 + T (84), ms2, ms1, ms0
+	             Only if enabled (S T 1). Sent before the first frame of each
+	             loop, the frames which follow were read at this time
+	             ms = (ms2 << 14) + (ms1 << 7) + ms0, millis() wrapping at 2^21
+
 INPUT
  
 	CMD PARAM VALUE SEP
@@ -38,6 +52,14 @@ INPUT
 
 	F 0 0   --> force digital read
 	S H ms  --> Set Heartbeat to value (in ms)
+	S T 0/1 --> Disable/enable timestamps (Time). Not stored, off after a restart
+	S d ms  --> Set the delay between loops without storing it (protocol 2).
+	            0 goes back to the stored delay (S D)
+	S V n   --> Use protocol version n (1-PROTOCOL_VERSION). Not stored, 1 after a restart
+	G V id  --> Reply the protocol version in use
+	G R id  --> Reply the supported baudrates, as a bitmask of indices in baudrates
+	S R i   --> Switch to baudrates[i]. If the driver sends no heartbeat (H)
+	            for BAUDRATE_FALLBACK_MS, the device goes back to BAUDRATE
 */
 
 #include <EEPROM.h>
@@ -58,8 +80,8 @@ INPUT
 //#define BLINK_LED_WHEN_DRIVER_NOT_PRESENT
 
 /* PROTOCOL */
-#define BAUDRATE 115200
-//#define BAUDRATE 250000
+#define BAUDRATE 115200     // the rate at startup, the driver can negotiate a higher one (S R)
+#define BAUDRATE_FALLBACK_MS 1000
 #define CMD_DIGITAL  68      // D igital
 #define CMD_ANALOG   65      // A nalog
 #define CMD_HERTBEAT 72      // H eartbeat
@@ -68,6 +90,12 @@ INPUT
 #define CMD_MESSAGE  77      // M essage
 #define CMD_INFO     73      // I info
 #define CMD_BUTTON   66      // B utton
+#define CMD_TIME     84      // T ime
+#define CMD_ANALOG2  97      // a nalog, all changed pins in one frame (protocol 2)
+#define CMD_DIGITAL2 100     // d igital, all pins in one frame (protocol 2)
+#define PROTOCOL_VERSION 2   // the highest protocol supported, see S V
+#define MASK_BYTES(numpins) (((numpins) + 6) / 7)
+#define TIME_MASK    0x1FFFFF  // timestamps are sent as 21 bits (3 x 7)
 
 /* INTERNAL */
 #define MAX_ANALOG_PINS  4   // A4 and A5 are not used, left for future expansion using I2C        
@@ -127,6 +155,10 @@ INPUT
 #define CHECK_CMD_LENGTH(n) if(command_length != n) { send_error(ERROR_COMMAND_NUMBYTES); break; }
 #define sign(num) int((num>0)-(num<0))
 
+// the first one must be BAUDRATE. The driver has a copy of this table
+const unsigned long baudrates[] = {115200, 230400, 250000, 500000, 1000000};
+const int num_baudrates = sizeof(baudrates)/sizeof(unsigned long);
+
 const int enabled_pins_digital[] = {2, 3, 4, 5, 6, 7, 8, 9, 10, 11}; // pin 12 unused
 const int enabled_pins_analog[]  = {0, 1, 2, 3};
 
@@ -155,7 +187,10 @@ int command_length      = 0,
 	command_pointer     = 0,
 	button_state        = 0,
 	blink_enabled       = 1,
-	delay_between_loops = 20;
+	delay_between_loops = 20,
+	transient_delay     = 0,   // if not 0, used instead of delay_between_loops (S d)
+	protocol            = 1,
+	baudrate_index      = 0;
 
 const int
 	num_digital_pins = sizeof(enabled_pins_digital)/sizeof(int),
@@ -172,7 +207,9 @@ char command[COMMAND_MAXLENGTH];
 boolean 
 	command_complete   = false,
 	blink_led          = false,
-	force_digital_read = false;
+	force_digital_read = false,
+	timestamps_enabled = false,
+	timestamp_sent     = false;
 
 SignalFilter Filter[MAX_ANALOG_PINS];
 int filtertypes[MAX_ANALOG_PINS];
@@ -212,6 +249,15 @@ void set_heartbeat_period(unsigned value) {
 	}
 }
 
+void set_baudrate(int index) {
+	Serial.flush();  // wait until everything was sent at the current rate
+	Serial.end();
+	Serial.begin(baudrates[index]);
+	baudrate_index = index;
+	// the driver has BAUDRATE_FALLBACK_MS to send a heartbeat at the new rate
+	last_incomming_heartbeat = now;
+}
+
 void send_reply(byte reply_id, int value) {
 	int hi, lo;
 	hi = value >> 7;
@@ -222,6 +268,18 @@ void send_reply(byte reply_id, int value) {
 	Serial.write(lo);
 }
 
+void send_timestamp() {
+	// the time of this loop, sent once before its first frame
+	if( timestamps_enabled && !timestamp_sent ) {
+		unsigned long ms = now & TIME_MASK;
+		Serial.write(128 + CMD_TIME);
+		Serial.write((ms >> 14) & 0b1111111);
+		Serial.write((ms >> 7) & 0b1111111);
+		Serial.write(ms & 0b1111111);
+		timestamp_sent = true;
+	}
+}
+
 void send_error(int errorcode) {
 	Serial.write(128 + CMD_ERROR);
 	Serial.write(errorcode >> 7);
@@ -501,6 +559,16 @@ void act_on_command() {
 						delay_between_loops = value;
 						eeprom_write_uint(ADDR_U2_DELAY, delay_between_loops);
 					}
+					break;
+				case 'd': // SET DELAY, NOT STORED (changed often by the driver)
+					CHECK_CMD_LENGTH(4)
+					value = (command[2] << 7) + command[3];
+					if( value != 0 && (value < MIN_DELAY || value > MAX_DELAY) ) {
+						send_error(ERROR_VALUE);
+						break;
+					}
+					transient_delay = value;
+					break;
 				case 'O': // DENOISE BY PREVENTING OSCILLATION
 					CHECK_CMD_LENGTH(4)
 					pin   = command[2];
@@ -513,6 +581,30 @@ void act_on_command() {
 						EEPROM.write(ADDR0+ADDR_U1_DENOISE+pin, value);
 					} 
 					break;
+				case 'R':  // BAUDRATE, not stored
+					CHECK_CMD_LENGTH(3)
+					value = command[2];
+					if( value < 0 || value >= num_baudrates ) {
+						send_error(ERROR_VALUE);
+						break;
+					}
+					if( value != baudrate_index ) {
+						set_baudrate(value);
+					}
+					break;
+				case 'V':  // PROTOCOL VERSION, not stored
+					CHECK_CMD_LENGTH(3)
+					value = command[2];
+					if( value < 1 || value > PROTOCOL_VERSION ) {
+						send_error(ERROR_VALUE);
+						break;
+					}
+					protocol = value;
+					break;
+				case 'T':  // TIMESTAMPS enable/disable, not stored
+					CHECK_CMD_LENGTH(3)
+					timestamps_enabled = command[2] == 1;
+					break;
 				case 'B':  // BLINKING enable/disable
 					CHECK_CMD_LENGTH(3);
 					value = command[2];
@@ -603,6 +695,16 @@ void act_on_command() {
 					replyid = command[2];
 					send_reply(replyid, blink_enabled);
 					break;
+				case 'V': // PROTOCOL VERSION
+					CHECK_CMD_LENGTH(3)
+					replyid = command[2];
+					send_reply(replyid, protocol);
+					break;
+				case 'R': // SUPPORTED BAUDRATES
+					CHECK_CMD_LENGTH(3)
+					replyid = command[2];
+					send_reply(replyid, (1 << num_baudrates) - 1);
+					break;
 
 			}
 			break;	
@@ -614,6 +716,10 @@ void act_on_command() {
 			CHECK_CMD_LENGTH(7)
 			// numblinks:uint, blinkperiod:uint, blinkdur:uint
 			led_signal((command[1]<<7)+command[2], (command[3]<<7)+command[4], (command[5]<<7)+command[6]);
+			// nothing was read while blinking, the heartbeats of the driver
+			// are waiting: don't fall back to BAUDRATE before reading them
+			now = millis();
+			last_incomming_heartbeat = now;
 			break;
 	}
 }
@@ -628,10 +734,17 @@ void loop() {
 	int current_direction;
 	int pin, i;
 	unsigned long newnow;
+	// protocol 2: the pins are collected during the loop and sent in one frame
+	byte digital_changed[MASK_BYTES(MAX_DIGITAL_PINS)],
+	     digital_states[MASK_BYTES(MAX_DIGITAL_PINS)],
+	     analog_changed[MASK_BYTES(MAX_ANALOG_PINS)];
+	int analog_values[MAX_ANALOG_PINS];
+	boolean any_changed;
 
 	newnow = millis();
 	measured_update_period = (measured_update_period >> 1) + ((newnow - now) >> 1);
 	now = newnow;
+	timestamp_sent = false;
 	
 	if( blink_led && (blink_state == 1) && (now - last_blink) > BLINK_PERIOD_MS) {
 		last_blink = now;
@@ -650,8 +763,15 @@ void loop() {
 		act_on_command();
 	}
 
+	// a driver which negotiated a higher rate sends heartbeats. If they stop,
+	// go back to the default rate, at which a driver can find the device again
+	if( baudrate_index != 0 && (now - last_incomming_heartbeat) > BAUDRATE_FALLBACK_MS ) {
+		set_baudrate(0);
+	}
+
 	if( ((now - last_heartbeat) > heartbeat_period) || (last_heartbeat > now) ) {
 		#ifdef NORMAL
+			send_timestamp();
 			Serial.write(128 + CMD_HERTBEAT); 
 			Serial.write(DEVICE_ID);
 		#else
@@ -676,6 +796,7 @@ void loop() {
 	if( value != button_state ) {
 		button_state = value;
 		#ifdef NORMAL
+			send_timestamp();
 			Serial.write(128 + CMD_BUTTON);
 			Serial.write(0);
 			Serial.write(value);
@@ -687,6 +808,10 @@ void loop() {
 
 	///////////////////////
 	// DIGITAL
+	any_changed = false;
+	for(i=0; i < MASK_BYTES(num_digital_pins); i++) {
+		digital_changed[i] = digital_states[i] = 0;
+	}
 	for(i=0; i < num_digital_pins; i++) {
 		pin = enabled_pins_digital[i];
 		value = digitalRead(pin);
@@ -696,16 +821,25 @@ void loop() {
 		#ifdef STRESS_TEST
 			value = random(2);
 		#endif
+		if( value ) {
+			digital_states[i / 7] |= 1 << (i % 7);
+		}
 		if( force_digital_read || (value != digital_state[pin]) ) {
 			digital_state[pin] = value;
 			if( blink_enabled ) {
 				blink_led = true;	
 			}
 			#ifdef NORMAL
-				Serial.write(128 + CMD_DIGITAL);
-				//Serial.write(pin);
-				Serial.write(i);
-				Serial.write(value);
+				if( protocol >= 2 ) {
+					digital_changed[i / 7] |= 1 << (i % 7);
+					any_changed = true;
+				} else {
+					send_timestamp();
+					Serial.write(128 + CMD_DIGITAL);
+					//Serial.write(pin);
+					Serial.write(i);
+					Serial.write(value);
+				}
 			#else
 				Serial.print("D");
 				Serial.print(pin);
@@ -715,9 +849,25 @@ void loop() {
 		};
 	};
 	force_digital_read = false;
+	#ifdef NORMAL
+		if( any_changed ) {
+			send_timestamp();
+			Serial.write(128 + CMD_DIGITAL2);
+			for(i=0; i < MASK_BYTES(num_digital_pins); i++) {
+				Serial.write(digital_changed[i]);
+			}
+			for(i=0; i < MASK_BYTES(num_digital_pins); i++) {
+				Serial.write(digital_states[i]);
+			}
+		}
+	#endif
 
 	///////////////////
 	// ANALOG 
+	any_changed = false;
+	for(i=0; i < MASK_BYTES(num_analog_pins); i++) {
+		analog_changed[i] = 0;
+	}
 	for(i=0; i < num_analog_pins; i++) {
 		pin = enabled_pins_analog[i];
 		last_sentvalue = analog_sentvalue[pin];
@@ -818,11 +968,18 @@ void loop() {
 		}
 
 		#ifdef NORMAL
-			Serial.write(128 + CMD_ANALOG);
-			//Serial.write(pin);
-			Serial.write(i);
-			Serial.write(value >> 7);
-			Serial.write(value & 0b1111111);
+			if( protocol >= 2 ) {
+				analog_changed[i / 7] |= 1 << (i % 7);
+				analog_values[i] = value;
+				any_changed = true;
+			} else {
+				send_timestamp();
+				Serial.write(128 + CMD_ANALOG);
+				//Serial.write(pin);
+				Serial.write(i);
+				Serial.write(value >> 7);
+				Serial.write(value & 0b1111111);
+			}
 		#else
 			Serial.print("A");
 			Serial.print(pin);
@@ -831,12 +988,28 @@ void loop() {
 		#endif
 	};
 
+	#ifdef NORMAL
+		if( any_changed ) {
+			send_timestamp();
+			Serial.write(128 + CMD_ANALOG2);
+			for(i=0; i < MASK_BYTES(num_analog_pins); i++) {
+				Serial.write(analog_changed[i]);
+			}
+			for(i=0; i < num_analog_pins; i++) {
+				if( analog_changed[i / 7] & (1 << (i % 7)) ) {
+					Serial.write(analog_values[i] >> 7);
+					Serial.write(analog_values[i] & 0b1111111);
+				}
+			}
+		}
+	#endif
+
 	// if( blink_state == 0 ) {
 	// 	digitalWrite(LEDPIN, HIGH);
 	// 	blink_state = 1;
 	// }
 
-	delay(delay_between_loops);	
+	delay(transient_delay ? transient_delay : delay_between_loops);	
 }
 
 void serialEvent() {
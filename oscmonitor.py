@@ -58,8 +58,9 @@ class OSCMonitorServer(object):
         self.app.quit(external=True)
 
     def ping_handler(self, path, args, types, src):
+        # the core pings registered clients to keep them registered
         ping_id = args[0]
-        self.server.send(src, '/reply', ping_id)
+        self.server.send(self.coreaddr, '/pingback', ping_id)
 
 class TerminalApp(object):
     def __init__(self, coreaddr=('localhost', 47120), exclude=['/heartbeat']):
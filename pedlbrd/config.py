@@ -12,40 +12,81 @@ DEFAULT_CONFIG = {
 
 	'autocalibrate_digital' : True,
 	'reset_after_reconnect' : False,
+	'persist_calibration': True,        # the ranges learned by the analog inputs are saved per device and restored at startup. /resetstate forgets them
+	'calibration_save_period': 10,      # seconds between saves of the ranges (only saved when they changed)
 	'open_log_at_startup': False,
 
 	# OSC
 	'osc_port' : 47120,
 	'osc_data_addresses' : [ ("127.0.0.1", 47121) ],
 	'osc_ui_addresses'   : [ ("127.0.0.1", 47121) ], 
+	'osc_data_filters'   : {},             # "host:port" -> labels (A1, D*) or paths (/data/A) it receives. See /registerdata
+	'osc_lease_ttl': 120,               # registered addresses which don't renew (register again or answer /ping) within this time are removed. 0: never
+	'osc_permanent_addresses': [ ("127.0.0.1", 47121) ],  # addresses which never expire
 	'osc_send_raw_data': True,
 	'osc_datatype': 'f',			   # use f (32bit) or d (64bit) to send normalized analog values
 	'osc_async': True,
 	'osc_add_kind_to_address': True,   # send {/data/kind pin value}, otherwise {/data kind pin value}
 	'osc_reply_namespace': True,        # the /reply(s) are mirrored as /reply/method values
+	'osc_multicast': False,             # send data once to a multicast group instead of to each data address
+	'osc_multicast_group': '239.255.47.121',
+	'osc_multicast_port': 47121,
+	'osc_multicast_ttl': 1,             # 1: don't leave the local network
+	'osc_timetag': False,               # send data in bundles timetagged with the time the device read it (needs device_timestamps)
+	'osc_timetag_latency': 0.01,        # added to the timetag, should be more than the jitter of the connection
+	'osc_tcp': False,                   # also serve OSC over TCP (SLIP framed) at the same port
+	'osc_tcp_maxqueue': 1024,           # data packets waiting for a slow TCP client. When full, the oldest are dropped
+	'websocket': False,                 # serve OSC over websocket (binary messages), for browsers
+	'websocket_port': 47122,
+	'websocket_rate': 30,               # max. data updates per second sent to each websocket client. 0: no limit
+	'shm': False,                       # write the data also to a memory-mapped ring buffer (see shm.py)
+	'shm_path': None,                   # None: /dev/shm/pedlbrd.shm (or the temp dir)
+	'shm_capacity': 4096,               # number of records in the ring buffer
 	
 	# CONNECTION
 	'firsttime_retry_period': 0.3,     # if possitive, dont give up if no device present at creation time, try to reconnect
 	'firsttime_accept_fail': True,     # dont fail if there is no connection. Build everything and drops to noconnection state
 	'reconnect_period_seconds': 1,  # 0 if no reconnection should be attempted 
+	'device_protocol': 2,              # the serial protocol asked to the device. 2: all changed pins in one frame (if supported)
+	'serial_max_baudrate': 250000,     # a higher baudrate is negotiated with the device, up to this. The connection starts always at 115200
+	'serial_baudrate_trial': 5,        # seconds after a baudrate switch in which losing the device excludes that rate for the session
+	'host_heartbeat_period': 0.3,      # seconds between the heartbeats sent to the device. A negotiated baudrate needs them
+	'adaptive_rate': False,            # the device runs fast while the analog inputs move and slows down when idle (needs protocol 2). /delay/set has then no lasting effect
+	'adaptive_rate_delays': [4, 40],   # min. and max. delay between loops of the device (ms, 1-100)
+	'adaptive_rate_idle': 2,           # seconds without movement before slowing down
+	'adaptive_rate_period': 0.25,      # seconds between updates of the rate
+	'device_timestamps': False,        # ask the device to timestamp its frames. The data is then timed by the device clock (see deviceclock.py)
+	'heartbeat_watchdog_periods': 3,   # the device is lost after this many heartbeat periods without a heartbeat (then it is looked for again). 0 disables
 	'autostart': True,
 	'autosave_config_period': 40,
 	'serialloop_async': True,
 	'sync_bg_checkinterval': 0.2,
-	'idle_threshold' : 3,
 	'serialtimeout_async': 0.1,
 	'serialtimeout_sync' : 0.1,
+	'control_max_latency': 0.02,       # max. time for a change (reset, midichannel, mapping) to reach the idle mainloop, where the serial port can't be waited on (windows). Elsewhere the change wakes the mainloop
 	'stop_on_keyboard_interrupt' : True,
 	'force_device_info_when_reconnect': False,  # When reconnecting, should we ask again for the device info? (this should not change between connects)
+	'device_reply_timeout': 1,         # seconds to wait for the device to reply to a query before sending an /error
+	'device_max_pending': 8,           # max. queries waiting for a reply from the device. Identical queries are sent only once
+	'serial_write_pacing': 0,          # seconds between commands sent to the device. 0: one loop of the device (from its delay)
+	'serial_write_queuesize': 32,      # max. commands waiting to be written to the device
 
 	'reset_click_duration': 1,
 
 	# MIDI
 	'midi_device_name' : 'PEDLBRD',
 	'midichannel' : 0,
+	'midi_coalesce_window': 0.004,     # seconds. CC values within this window are merged (0: send immediately)
+	'midiports_poll_period': 3,        # seconds. Only used if ALSA port announcements are not available
+	'midithrough_queuesize': 256,      # messages waiting for a midithrough port. When full, the oldest are dropped
 	
 	# ----------------------------------------------------- 
 	# inputs are the UI side of pins, identified by a label
+	# analog inputs can define a response 'curve':
+	#     'linear', 'log', 'exp', 'scurve', [name, shape]
+	#     or a list of breakpoints [[x0, y0], [x1, y1], ...] (0-1)
+	# and a midi 'mode': 'cc' (7-bit, default), 'cc14' (14-bit CC,
+	#     the CC must be < 32) or 'nrpn' (parameter number in 'nrpn', 0-16383)
 	# -----------------------------------------------------
 	'input_mapping' : { 
 		'D1' : { 'inverted': False, 
@@ -78,13 +119,17 @@ DEFAULT_CONFIG = {
 		'D10': { 'inverted': False, 
 		         'midi':{ 'channel': 0, 'cc': 10, 'output':[0, 127]}
 		},
-		'A1': { 'midi':{ 'channel': 0, 'cc': 101}
+		'A1': { 'midi':{ 'channel': 0, 'cc': 101},
+		       'curve': 'linear'
 	    },
-	    'A2': { 'midi':{ 'channel': 0, 'cc': 102}
+	    'A2': { 'midi':{ 'channel': 0, 'cc': 102},
+		       'curve': 'linear'
 	    },
-	    'A3': { 'midi':{ 'channel': 0, 'cc': 103}
+	    'A3': { 'midi':{ 'channel': 0, 'cc': 103},
+		       'curve': 'linear'
 	    },
-	    'A4': { 'midi':{ 'channel': 0, 'cc': 104}
+	    'A4': { 'midi':{ 'channel': 0, 'cc': 104},
+		       'curve': 'linear'
 	    }
 	},
 }
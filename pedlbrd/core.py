@@ -2,20 +2,25 @@ from __future__ import division as _division, absolute_import as _absolute_impor
 
 # stdlib
 import os
+import re
 import sys
 import glob
 import time
 import logging
 import logging.handlers
 import shutil
+import socket
+import select
 import inspect
 import fnmatch
 import json
-from collections import namedtuple
-from Queue import Queue
+import math
+import struct
+import bisect
+import threading
+from collections import namedtuple, deque
 
 # dependencies
-import timer2
 import liblo
 import serial
 import rtmidi2 as rtmidi
@@ -25,6 +30,15 @@ from notifydict import ChangedDict
 from .config import *
 from . import util
 from . import envir
+from .midi import MidiWriter, MidiOutputs, MidiPortManager
+from .osc import OSCSender, OSCLeases, OSCStreamServer, OSCStreamClient, message_prefix, encode_bundle
+from .websocket import WebSocketServer
+from .shm import ShmWriter
+from .serialwriter import SerialWriter
+from .scheduler import Scheduler, SchedulerThread
+from .frames import mask_bytes, read_analog2, read_digital2
+from .deviceclock import DeviceClock
+from .watchdog import HeartbeatWatchdog
 
 """
 PROTOCOL
@@ -46,13 +60,28 @@ VALUE = VALUE_HIGH * 128 + VALUE_LOW
 #################################
 # CONSTANTS & SETUP
 # this can't be configured because it is hardwired in other parts
-# (baudrate is defined in the firmware, the oscport is hardwired in the clients)
+# (the baudrate at connection time is defined in the firmware, a higher one
+# can be negotiated later, the oscport is hardwired in the clients)
 # The oscport could be configurable if we implemented some sort of
 # zeroconf support, which is overkill for this project
 #################################
 BAUDRATE = 115200
+BAUDRATES = (115200, 230400, 250000, 500000, 1000000)  # copied from firmware.ino, the index is sent
 OSCPORT = 47120
 PEDLBRD_ID = 5
+MAX_ANALOG_RESOLUTION = 2047  # copied from firmware.ino
+HEARTBEAT_PERIOD = 300        # ms, the default of the device (firmware.ino)
+AUTORANGE_MIN_SPAN = 10       # an autorange pin is not active until its range is bigger
+# the dispatch tables have an entry for every pin index a frame can carry,
+# indices not reported by the device map to a function rejecting the frame
+DISPATCH_TABLE_SIZE = 256
+
+# the device parameters which only change when set by the host, and can
+# be cached. param -> number of index bytes (the pin) after the param
+DEVICE_CACHED_PARAMS = {'H': 0, 'D': 0, 'B': 0, 'V': 0, 'S': 1, 'F': 1, 'O': 1}
+# the S(et) commands which are not cached -> number of index bytes before the value
+DEVICE_UNCACHED_PARAMS = {'d': 0, 'T': 0, 'R': 0}
+PROTOCOL_VERSION = 2          # the highest serial protocol understood, see firmware.ino
 
 DEBUG = False
 
@@ -136,6 +165,9 @@ class Configuration(dict):
     This implements a dictionary which will notify a registered callback
     when a change is made.
     It also supports subdictionaries (very similar to 'notifydict')
+
+    Values are never modified in place by set: a change replaces the
+    subdictionaries along its path, so they can be shared between threads
     """
     def __init__(self, config, overrides=None, callback=None):
         """
@@ -149,9 +181,18 @@ class Configuration(dict):
             config.update(overrides)
         self.callback = callback
         self.update(config)
+        self._lock = threading.Lock()
         self._callback_enabled = True
         self.state = {'saved': False, 'changed': True}
 
+    def snapshot(self):
+        """
+        ==> a shallow copy of the config, which can be read (saved) from
+            any thread: the subdictionaries are never modified in place
+        """
+        with self._lock:
+            return dict(self)
+
     def getpath(self, path):
         if isinstance(path, basestring):
             if "/" in path:
@@ -181,23 +222,29 @@ class Configuration(dict):
         else:
             raise ValueError("the path must be a string of the type key1/key2/..."
                              " or a seq [key1, key2, ...]")
-        d = self
         if len(keys) == 0:
             self[path] = value
-            self.state['changed'] = True
-            if self._callback_enabled:
-                self.callback(path, value)
         else:
-            for key in keys[:-1]:
-                v = d.get(key)
-                if isinstance(v, dict):
-                    d = v
-                else:
-                    raise KeyError("set -- key not found: [%s]" % str(key))
-            d[keys[-1]] = value
-            self.state['changed'] = True
-            if self._callback_enabled:
-                self.callback(path, value)
+            # copy-on-write: the subdictionaries along the path are copied and
+            # the new version is swapped in with one assignment, so a reader
+            # holding a subdictionary never sees it half updated
+            with self._lock:
+                dicts = [self]
+                for key in keys[:-1]:
+                    v = dicts[-1].get(key)
+                    if isinstance(v, dict):
+                        dicts.append(v)
+                    else:
+                        raise KeyError("set -- key not found: [%s]" % str(key))
+                new = value
+                for d, key in reversed(zip(dicts[1:], keys[1:])):
+                    d = dict(d)
+                    d[key] = new
+                    new = d
+                self[keys[0]] = new
+        self.state['changed'] = True
+        if self._callback_enabled:
+            self.callback(path, value)
 
     def midi_mapping_for_label(self, label):
         return self['input_mapping'].get(label).get('midi')
@@ -216,39 +263,100 @@ class Pedlbrd(object):
         self._serialport = None
         self._running = False
         self._status = ''
-        self._num_analog_pins = 6
-        self._num_digital_pins = 12
+        # the number of inputs, as configured until the device reports them (see _pins_resize)
+        self._num_analog_pins = self.config['num_analog_pins']
+        self._num_digital_pins = self.config['num_digital_pins']
         self._analog_resolution_per_pin = [DEFAULTS['max_analog_value'] for i in range(self._num_analog_pins)]
         self._midiout = None
-        self._midioutports = set()
+        self._midiwriter = None
+        self._midiports = None
         self._oscasync = oscasync if oscasync is not None else self.config['osc_async']
         self._serialtimeout = self.config['serialtimeout_async'] if oscasync else self.config['serialtimeout_sync']
+        # control messages (RESET, UPDATE) for the mainloop, see _control_post.
+        # They are checked for each frame read. When the device is idle the
+        # mainloop waits on the port and on a pipe, written to wake it up
+        self._control = deque()
+        self._wakeup_fds = _wakeup_pipe()
+        self._control_max_latency = self.config.get('control_max_latency', 0.02)
+        if self._wakeup_fds is None:
+            # the port can't be waited on (windows), the timeout bounds the latency
+            self._serialtimeout = min(self._serialtimeout, self._control_max_latency)
         self._dispatch_funcs_by_pin = {}
-        self._analog_funcs  = [None for i in range(self._num_analog_pins)]
-        self._digital_funcs = [None for i in range(self._num_digital_pins)]
+        self._analog_funcs  = [None for i in range(DISPATCH_TABLE_SIZE)]
+        self._digital_funcs = [None for i in range(DISPATCH_TABLE_SIZE)]
         self._digital_inverted = [False for i in range(self._num_digital_pins)]
         self._handlers = {}
         self._serialconnection = None
+        self._serialwriter = None
         self._oscserver = None
         self._oscapi = None
-        self._midithrough_ports = set()
+        self._oscstream = None
+        self._websocket = None
+        self._shm = None
+        self._osc_handlers = {}
+        self._midithrough_ports = frozenset()
         self._midithrough_index = 0  # <----- this reflects the last selected midithrough port
+        # negotiated baudrates at which the device was lost, not tried again
+        self._baudrates_failed = set()
+        # the time the baudrate was last switched
+        self._baudrate_switch_time = 0
         self._ip = None
-        self._callbackreg = {}
+        # the requests sent to the device waiting for a reply
+        self._pending = PendingRequests(timeout=self.config.get('device_reply_timeout', 1),
+                                        maxpending=self.config.get('device_max_pending', 8))
         self._first_conn = True
-        self._digitalinput_needs_calibration = [False for i in range(self._num_digital_pins)]
-        self._osc_data_addresses = []
-        self._osc_ui_addresses = []
-        self._replyid = 0
+        self._digitalinput_needs_calibration = [False for i in range(DISPATCH_TABLE_SIZE)]
+        # all OSC output goes through one UDP socket, each group of
+        # destinations is updated in place when the config changes
+        self._oscsender = OSCSender()
+        self._osc_data_dests = self._oscsender.group()
+        self._osc_ui_dests = self._oscsender.group()
+        # (kind, pin) -> the destinations interested in the data of that pin
+        self._osc_pin_dests = {}
+        # the runtime view of the config, replaced (never modified) by _runtime_update
+        self._runtime = None
+        self._runtime_lock = threading.RLock()
+        # the leases of the registered addresses, renewed by registering again, /ping or /pingback
+        self._osc_leases = OSCLeases()
+        self._pingback_registry = {}
         self._osc_reply_addresses = set()
         self._device_info = {}
+        # query (a tuple of ints, like (G, H)) -> value, see _device_query
+        self._device_params = {}
         self._midiout_openports = []
-        self._midi_analog_lastvalues = [0 for i in range(self.config['num_analog_pins'])]
+        self._midi_analog_lastvalues = [0 for i in range(self._num_analog_pins)]
+        self._midi_nrpn_selected = {}
+        self._analog_minvalues = [0] * self._num_analog_pins
+        self._analog_maxvalues = [0] * self._num_analog_pins
+        self._analog_autorange = [1] * self._num_analog_pins
+        self._analog_curves = [_curve_linear] * self._num_analog_pins
+        self._analog_luts = [[-1] * (MAX_ANALOG_RESOLUTION + 1) for i in range(self._num_analog_pins)]
 
         self.logger = Log()
-        self._scheduler = timer2.Timer(precision=0.5)
+        # jobs run from the mainloop, see _call_later
+        self._scheduler = Scheduler(wakeup=self._mainloop_wakeup)
+        # jobs writing to disk, run from their own thread so that they
+        # don't delay the mainloop
+        self._io_scheduler = SchedulerThread()
+        self._io_scheduler.start()
+        # maps the timestamps of the device (T frames) to host time
+        self._device_clock = DeviceClock()
+        # the device is lost when its heartbeats stop (see _mainloop)
+        self._watchdog = HeartbeatWatchdog()
+        mindelay, maxdelay = self.config.get('adaptive_rate_delays', (4, 40))
+        self._rate_controller = AdaptiveRate(mindelay, maxdelay,
+                                             idle_time=self.config.get('adaptive_rate_idle', 2))
+        # the ranges learned by the analog inputs, per device (see _calibration_save)
+        self._calibration = self._calibration_load()
+        # the device (id, as str) the current ranges belong to
+        self._calibration_device = None
+        # _calibration is saved from the io thread
+        self._calibration_lock = threading.Lock()
         self.reset_state()
-        self._cache_update()
+        # the last device used is assumed until it identifies itself,
+        # so that its data is scaled right from the first frame
+        self._calibration_restore(self._calibration['last_device'])
+        self._runtime_update()
         self._oscserver, self._oscapi = self._create_oscserver()
         if self._oscserver is None:
             raise OSCPortUsed("Could not create OSC server."
@@ -258,6 +366,18 @@ class Pedlbrd(object):
             self._oscserver.start()
         else:
             self.logger.debug("osc is in sync mode")
+        if self.config.get('osc_tcp', False):
+            self._oscstream = self._streamserver_start(OSCStreamServer(
+                OSCPORT, self._oscstream_received,
+                maxqueue=self.config.get('osc_tcp_maxqueue', 1024)))
+        if self.config.get('websocket', False):
+            self._websocket = self._streamserver_start(WebSocketServer(
+                self.config.get('websocket_port', 47122), self._oscstream_received,
+                maxqueue=self.config.get('osc_tcp_maxqueue', 1024),
+                rate=self.config.get('websocket_rate', 30)))
+
+        if self.config.get('shm', False):
+            self._shm_start()
 
         # Here we actually try to connect to the device.
         # If firsttime_retry_period is possitive, it will 
@@ -270,10 +390,38 @@ class Pedlbrd(object):
         self.logger.debug("configfile: %s" % self.configfile)
 
     def _call_regularly(self, period, function, args=(), kws={}):
-        return self._scheduler.apply_interval(period*1000, function, args, kws)
+        """
+        call function every `period` seconds from the mainloop
+
+        ==> a job, which can be cancelled
+        """
+        return self._scheduler.call_regularly(period, function, args, kws)
 
     def _call_later(self, deltatime, function, args=(), kws={}):
-        return self._scheduler.apply_after(deltatime*1000, function, args, kws)
+        """
+        call function after deltatime seconds from the mainloop.
+        With deltatime 0 it is called in the next iteration of the loop
+        """
+        return self._scheduler.call_later(deltatime, function, args, kws)
+
+    def _control_post(self, msg):
+        """
+        post a control message (RESET, UPDATE, RESYNC) to the mainloop
+        """
+        self._control.append(msg)
+        self._mainloop_wakeup()
+
+    def _mainloop_wakeup(self):
+        """
+        wake the mainloop if it waits for the device (from any thread)
+        """
+        fds = self._wakeup_fds
+        if fds is not None:
+            try:
+                os.write(fds[1], 'w')
+            except OSError:
+                # the pipe is full, the mainloop will wake up anyway
+                pass
 
     #####################################################
     #
@@ -287,19 +435,27 @@ class Pedlbrd(object):
         * Reset the polarity of the digital pins
         """
         self.logger.debug("reset_state --> resetting")
-        self._analog_minvalues = [
-            resolution for resolution in self._analog_resolution_per_pin]
-        self._analog_maxvalues = [1] * self._num_analog_pins
-        self._analog_autorange = [1] * self._num_analog_pins
+        self._analog_ranges_reset()
+        self._calibration_forget()
         self._input_labels = self.config['input_mapping'].keys()
         self._send_osc_ui('/notify/reset')
         self._led_pattern(15, 50, 45)
         if self._running:
             self.logger.debug("putting RESET in the queue")
-            self._msgqueue.put_nowait("RESET")
+            self._control_post("RESET")
         else:
             self.logger.debug("finished reset, mainloop is not running")
 
+    def _analog_ranges_reset(self):
+        # the lists are modified in place, since the dispatch functions
+        # hold a reference to them
+        self._analog_minvalues[:] = [
+            resolution for resolution in self._analog_resolution_per_pin]
+        self._analog_maxvalues[:] = [1] * self._num_analog_pins
+        self._analog_autorange[:] = [1] * self._num_analog_pins
+        for pin in range(self._num_analog_pins):
+            self._analog_lut_update(pin)
+
     def find_device(self, retry_period=0):
         """
         find the path of the serial device. check that it is alive
@@ -349,16 +505,74 @@ class Pedlbrd(object):
         self._send_to_all('/quit')
         # this will exit the mainloop, and _terminate will be called
         self._running = False
+        self._mainloop_wakeup()
 
     def _send_to_all(self, path, *args):
-        addrs = self.config['osc_ui_addresses']
-        for addr in addrs:
-            libloaddr = liblo.Address(*addr)
-            self._oscserver.send(libloaddr, path, *args)
-        addrs = self.config['osc_data_addresses']
-        for addr in addrs:
-            libloaddr = liblo.Address(*addr)
-            self._oscserver.send(libloaddr, path, *args)
+        """
+        send a notification to every registered address, once each.
+        Not to the multicast group, which only carries data
+        """
+        runtime = self._runtime
+        sent = set()
+        for addr in runtime.ui_addresses + runtime.data_addresses:
+            if addr not in sent:
+                sent.add(addr)
+                self._oscsender.sendto(addr, path, *args)
+
+    def _osc_send(self, addr, path, *args):
+        """
+        send to addr, which can be a liblo address or a client
+        connected via the OSC stream server
+        """
+        if isinstance(addr, OSCStreamClient):
+            addr.send(path, *args)
+        else:
+            self._oscserver.send(addr, path, *args)
+
+    def _shm_start(self):
+        """
+        write the data also to a memory-mapped ring buffer (see shm.py)
+        """
+        try:
+            self._shm = ShmWriter(self._num_analog_pins, self._num_digital_pins,
+                                  capacity=self.config.get('shm_capacity', 4096),
+                                  path=self.config.get('shm_path'),
+                                  timefunc=self._device_clock.time)
+        except (OSError, IOError, EnvironmentError):
+            self.logger.error("could not create the shared memory output: %s" % str(sys.exc_info()[1]))
+
+    def _streamserver_start(self, server):
+        """
+        Serve the OSC api through server (an OSCStreamServer or
+        a WebSocketServer), which also receives all data and ui messages
+
+        ==> the server, or None if it could not be started
+        """
+        try:
+            server.start()
+        except socket.error:
+            self.logger.error("could not start %s at port %d: %s" % (
+                server.__class__.__name__, server.port, str(sys.exc_info()[1])))
+            return None
+        self._osc_data_dests.add_sink(server.send_data)
+        with self._runtime_lock:
+            for (kind, pin), dests in self._osc_pin_dests.items():
+                dests.add_sink(server.data_sink(*_data_filter_keys(kind, pin)))
+        self._osc_ui_dests.add_sink(server.send_ui)
+        return server
+
+    def _oscstream_received(self, client, path, types, args):
+        handler = self._osc_handlers.get(path)
+        if handler is None:
+            self.logger.error("OSC stream: no method for %s" % path)
+            client.send('/error', path, 'no method')
+            return
+        handler, method, signature = handler
+        if signature is not None and types != signature:
+            self.logger.error("OSC stream: %s expects types %s, got %s" % (path, signature, types))
+            client.send('/error', path, 'expected types: %s' % signature)
+            return
+        handler(path, args, types, client, method)
 
     def _terminate(self):
         self.logger.debug("- - - - - - - - >>> TERMINATE <<< - - - - - - - - ")
@@ -366,16 +580,32 @@ class Pedlbrd(object):
             self._oscserver.stop()
             time.sleep(0.1)
             self._oscserver.free()
-
-        if self._serialconnection:
-            self._serialconnection.close()
+        for server in (self._oscstream, self._websocket):
+            if server is not None:
+                server.stop()
+        if self._shm is not None:
+            self._shm.close()
+        self._oscsender.close()
+
+        if self._rate_controller.delay is not None and self._serialwriter is not None:
+            # back to the delay stored in the device
+            self.send_to_device(('S', 'd', 0, 0))
+            self._serialwriter.drain(0.5)
+        self._serial_close()
         self._midi_turnoff()
 
-        self._save_config()
-
         for handlername, handler in self._handlers.iteritems():
             self.logger.debug('cancelling handler: %s' % handlername)
             handler.cancel()
+        self._scheduler.clear()
+        if self._wakeup_fds is not None:
+            fds, self._wakeup_fds = self._wakeup_fds, None
+            for fd in fds:
+                os.close(fd)
+        # the last saves, after a save running in the io thread finished
+        self._io_scheduler.stop()
+        self._save_config()
+        self._calibration_save(background=False)
 
     def calibrate_digital(self):
         """
@@ -388,7 +618,7 @@ class Pedlbrd(object):
         off position before calibration
         """
         if self._running:
-            for i in range(len(self._digitalinput_needs_calibration)):
+            for i in range(self._num_digital_pins):
                 self._digitalinput_needs_calibration[i] = True
             self.send_to_device(('F'))
         else:
@@ -396,8 +626,8 @@ class Pedlbrd(object):
                 "attempted to calibrate digital inputs outside of main loop")
             return
         self._send_osc_ui('/notify/calibrate')
-        time.sleep(0.2)
-        self._led_pattern(3, 110, 100)
+        # called from the mainloop, which should not block
+        self._call_later(0.2, self._led_pattern, (3, 110, 100))
 
     ####################################################
     #
@@ -405,46 +635,154 @@ class Pedlbrd(object):
     #
     ####################################################
 
-    def _register_callback(self, key, func):
+    def _apply_callback(self, replyid, *args):
         """
-        key: a number from 0-127
-        func : a function taking one integer argument
+        call the callbacks waiting for replyid
         """
-        if isinstance(key, basestring):
-            if not len(key) == 1:
-                self.logger.error(
-                    "the reply_id should be a number of character between 0-127")
-                return
-            key = ord(key[0])
-        self._callbackreg[key] = func
+        callbacks = self._pending.pop(replyid)
+        if callbacks is None:
+            self.logger.debug('no callback for replyid %d, args: %s' % (replyid, str(args)))
+            return
+        for callback in callbacks:
+            try:
+                callback(*args)
+            except:
+                self.logger.error("error in callback registered to {replyid}. error: {error}".format(
+                    replyid=replyid, error=sys.exc_info()[1]))
 
-    def _apply_callback(self, key, *args):
-        func = self._callbackreg.get(key)
-        if func:
-            func(*args)
-            del self._callbackreg[key]
+    def _device_query(self, bytes, callback, errback=None):
+        """
+        ask the device for a parameter. Parameters which only change
+        when set by the host (DEVICE_CACHED_PARAMS) are answered from
+        the cache if present, without asking the device
 
-    def _cache_osc_addresses(self):
-        def as_liblo_address(addr):
-            if isinstance(addr, (tuple, list)):
-                return liblo.Address(*addr)
-            else:
-                return liblo.Address(addr)
-        self._osc_ui_addresses[:] = \
-            [as_liblo_address(addr) for addr in self.config['osc_ui_addresses']]
-        self._osc_data_addresses[:] = \
-            [as_liblo_address(addr) for addr in self.config['osc_data_addresses']]
+        bytes: the query, like ('G', 'S', pin)
+        """
+        key = _device_param_key(bytes)
+        value = self._device_params.get(key)
+        if value is not None:
+            callback(value)
+            return
+        if key[1:] and chr(key[1]) in DEVICE_CACHED_PARAMS:
+            def store(value, key=key, callback=callback):
+                self._device_params[key] = value
+                if key == (ord('G'), ord('D')) and self._serialwriter is not None:
+                    # the transient delay (adaptive_rate), if set, is the one in use
+                    self._serialwriter.pacing = self._serial_pacing(self._rate_controller.delay)
+                callback(value)
+            self.send_to_device(bytes, store, errback)
+        else:
+            self.send_to_device(bytes, callback, errback)
 
-    def _cache_update(self):
-        if self._running:
-            wasrunning = True
-            self.stop()
+    def _device_params_clear(self):
+        self._device_params.clear()
+
+    def _device_params_prefetch(self):
+        """
+        read the parameters not present in the Info frame, so that they
+        can be answered from the cache
+        """
+        for param in ('H', 'D', 'B', 'V'):
+            self._device_query(('G', param), lambda value: None)
+
+    def _pending_expire(self):
+        for bytes, errbacks in self._pending.expire():
+            self.logger.error("device did not reply to %s" % str(bytes))
+            for errback in errbacks:
+                errback("timeout")
+
+    def _runtime_update(self):
+        """
+        Build a new RuntimeConfig from the config and publish it.
+
+        The OSC thread and the serial loop read the runtime view of the
+        config only through self._runtime, which is never modified: a change
+        builds a new snapshot and swaps the reference. The destinations are
+        updated under the same lock, so that two writers can't leave them
+        out of sync with the snapshot
+        """
+        config = self.config
+        with self._runtime_lock:
+            self._runtime = runtime = RuntimeConfig(
+                data_addresses=tuple(tuple(addr) for addr in config['osc_data_addresses']),
+                ui_addresses=tuple(tuple(addr) for addr in config['osc_ui_addresses']),
+                data_filters=dict((key, tuple(patterns)) for key, patterns
+                                  in config.get('osc_data_filters', {}).items()),
+                multicast=self._osc_multicast_address())
+            self._cache_osc_addresses(runtime)
+
+    def _cache_osc_addresses(self, runtime):
+        self._osc_ui_dests.set_addresses(runtime.ui_addresses)
+        if runtime.multicast:
+            # data is sent once to the group, regardless of the number of listeners
+            self._oscsender.set_multicast_ttl(self.config.get('osc_multicast_ttl', 1))
+            self._osc_data_dests.set_addresses([runtime.multicast])
         else:
-            wasrunning = False
-        self._cache_osc_addresses()
-        self._sendraw = self.config['osc_send_raw_data']
-        if wasrunning:
-            self.start()
+            self._osc_data_dests.set_addresses(runtime.data_addresses)
+        for (kind, pin), dests in self._osc_pin_dests.items():
+            dests.set_addresses(self._osc_data_addresses_for(kind, pin, runtime))
+
+    def _osc_data_addresses_for(self, kind, pin, runtime=None):
+        """
+        the data addresses whose filters (see /registerdata) accept the given pin
+        """
+        runtime = runtime or self._runtime
+        if runtime.multicast:
+            return [runtime.multicast]
+        filters = runtime.data_filters
+        if not filters:
+            return runtime.data_addresses
+        label, path = _data_filter_keys(kind, pin)
+        out = []
+        for addr in runtime.data_addresses:
+            patterns = filters.get("%s:%d" % addr)
+            if not patterns or any(fnmatch.fnmatch(label, patt) or fnmatch.fnmatch(path, patt)
+                                   for patt in patterns):
+                out.append(addr)
+        return out
+
+    def _osc_pin_destinations(self, kind, pin):
+        """
+        ==> the destinations for the data of the given pin. They are
+            updated in place, so dispatch functions can keep them
+        """
+        dests = self._osc_pin_dests.get((kind, pin))
+        if dests is None:
+            with self._runtime_lock:
+                dests = self._oscsender.group(self._osc_data_addresses_for(kind, pin))
+                # the stream servers apply the data filters of each of their clients
+                for server in (self._oscstream, self._websocket):
+                    if server is not None:
+                        dests.add_sink(server.data_sink(*_data_filter_keys(kind, pin)))
+                self._osc_pin_dests[(kind, pin)] = dests
+        return dests
+
+    def _osc_data_sender(self, kind, pin):
+        """
+        ==> a function sending an encoded data message of the given pin.
+            With osc_timetag, the message is sent in a bundle timetagged
+            with the time the device read the pin (see DeviceClock) plus
+            osc_timetag_latency, so that receivers can act on it with a
+            constant latency instead of at arrival time
+        """
+        send_packet = self._osc_pin_destinations(kind, pin).send_packet
+        if not self.config.get('osc_timetag', False):
+            return send_packet
+        clock = self._device_clock.time
+        latency = self.config.get('osc_timetag_latency', 0.01)
+
+        def send_timetagged(packet):
+            send_packet(encode_bundle(clock() + latency, packet))
+        return send_timetagged
+
+    def _osc_multicast_address(self):
+        """
+        ==> (group, port) if data should be sent to a multicast group, None otherwise
+        """
+        if not self.config.get('osc_multicast', False):
+            return None
+        return (self.config.get('osc_multicast_group', '239.255.47.121'),
+                self.config.get('osc_multicast_port', 47121))
 
     @property
     def ip(self):
@@ -461,19 +799,45 @@ class Pedlbrd(object):
             "PORT       : %s" % self._serialport,
             "OSC IN     : %s, %d" % (self.ip, OSCPORT)
         ]
-        osc_data = self.config['osc_data_addresses']
-        osc_ui = self.config['osc_ui_addresses']
+        if self._oscstream is not None:
+            lines.append("OSC TCP    : %s, %d (%d clients)" % (self.ip, OSCPORT, len(self._oscstream.clients)))
+        if self._websocket is not None:
+            lines.append("WEBSOCKET  : %s, %d (%d clients)" % (
+                self.ip, self._websocket.port, len(self._websocket.clients)))
+        runtime = self._runtime
+        osc_data = runtime.data_addresses
+        osc_ui = runtime.ui_addresses
 
         def addr_to_str(addr):
             return ("%s:%d" % tuple(addr)).ljust(16)
-        if osc_data:
-            oscdata_addresses = map(addr_to_str, osc_data)
+        multicast = runtime.multicast
+        if multicast:
+            lines.append(
+                "OSC OUT    : data  ---------> multicast %s" % addr_to_str(multicast))
+        elif osc_data:
+            filters = runtime.data_filters
+
+            def data_addr_to_str(addr):
+                patterns = filters.get("%s:%d" % tuple(addr))
+                if patterns:
+                    return "%s [%s]" % (addr_to_str(addr).strip(), ",".join(patterns))
+                return addr_to_str(addr)
+            oscdata_addresses = map(data_addr_to_str, osc_data)
             lines.append(
                 "OSC OUT    : data  ---------> %s" % " | ".join(oscdata_addresses))
         if osc_ui:
             oscui_addresses = map(addr_to_str, osc_ui)
             lines.append(
                 "           : notifications -> %s" % " | ".join(oscui_addresses))
+        if self.config.get('osc_lease_ttl', 0) > 0:
+            lines.append("OSC LEASES : %d active, %d expired (ttl: %ds)" % (
+                len(self._osc_leases), self._osc_leases.expired, self.config['osc_lease_ttl']))
+        if self._midiports is not None:
+            for portname, dropped, errors, broken in self._midiports.stats():
+                lines.append("MIDI THRU  : %s (dropped: %d%s)" % (
+                    portname, dropped, ", BROKEN" if broken else ""))
+        if self._device_clock.active:
+            lines.append("CLOCK      : device timestamps (drift: %+.0f ppm)" % (self._device_clock.drift * 1e6))
         lines.append("- - - - - - - - - - - - - - - - - - - - - - - - - - - - - - ")
         lines.extend(self._lines_report_oscapi())
         lines.extend(self._lines_report_config())
@@ -526,9 +890,9 @@ class Pedlbrd(object):
         returns a list of functions operating on the pin corresponding to
         the given label
         """
-        midiout = self._midiout
-        assert midiout is not None
-        sendmidi = midiout.send_message
+        midiwriter = self._midiwriter
+        assert midiwriter is not None
+        sendmidi = midiwriter.send
         # ----------------------
         # Digital
         # ----------------------
@@ -538,11 +902,20 @@ class Pedlbrd(object):
             midichan = self.config['midichannel']
             byte1 = 176 + midichan
 
+            # switches are never coalesced, a quick press would be lost
+            sendmidi_ordered = midiwriter.send_ordered
+            osc_sendpacket = self._osc_data_sender('D', pin)
+            osc_prefix = message_prefix('/data/D', ',ii', pin)
+            pack_i = struct.Struct('>i').pack
+            shm_write = self._shm.write if self._shm is not None else None
+
             def callback(value):
                 if inverted:
                     value = 1 - value
-                sendmidi((byte1, cc, value*127))
-                self._send_osc_data('/data/D', pin, value)
+                sendmidi_ordered((byte1, cc, value*127))
+                osc_sendpacket(osc_prefix + pack_i(value))
+                if shm_write is not None:
+                    shm_write('D', pin, value, value)
                 return value
             return callback
 
@@ -551,41 +924,171 @@ class Pedlbrd(object):
         # --------------
         if kind == "A":
             normalize = self._gen_normalize(pin)
-            oscsend = self._oscserver.send
-            addresses = self._osc_data_addresses
-            midi_lastvalues = self._midi_analog_lastvalues
-            midi_channel = self.config.get('midichannel', 0)
-            byte1 = 176 + midi_channel
-            cc = 101 + pin
+            sendanalog = self._gen_midi_analog(pin, midiwriter)
+            # the message is encoded once and sent to all destinations
+            osc_sendpacket = self._osc_data_sender('A', pin)
+            osc_prefix = message_prefix('/data/A', ',ifi', pin)
+            pack_fi = struct.Struct('>fi').pack
+            shm_write = self._shm.write if self._shm is not None else None
 
             def callback(value):
                 normvalue = normalize(value)
                 # normalize returns -1 if the pin is not active
                 if normvalue < 0:
                     return
-                midivalue = int(normvalue*127+0.5)
-                if midivalue > 127:
-                    midivalue = 127
-                if midivalue != midi_lastvalues[pin]:
-                    midi_lastvalues[pin] = midivalue
-                    sendmidi((byte1, cc, midivalue))
+                sendanalog(normvalue)
 
                 # we send the normalized data as 32bit float, which is 
                 # more than enough for the ADC resolution of any sensor, 
                 # and ensures compatibility with osc implementations 
                 # such as PD, which only interprets floats as 32 bits
-                for address in addresses:
-                    oscsend(address, '/data/A', pin, ('f', normvalue), ('i', value))
+                osc_sendpacket(osc_prefix + pack_fi(normvalue, value))
+                if shm_write is not None:
+                    shm_write('A', pin, value, normvalue)
                 return value
             return callback
 
+    def _gen_midi_analog(self, pin, midiwriter):
+        """
+        returns a function sending the normalized value of the given analog
+        pin as MIDI, according to the 'mode' of its midi mapping:
+
+        cc   : 7-bit CC (default)
+        cc14 : 14-bit CC, as a MSB/LSB pair (CC and CC+32, CC must be < 32)
+        nrpn : 14-bit NRPN, param. number given by 'nrpn' (default: CC)
+
+        In the 14-bit modes the MSB is only sent if it changed, so that
+        jitter in the lower bits does not double the message rate
+
+        midiwriter: the MidiWriter used to send the messages
+        """
+        sendmidi = midiwriter.send
+        sendmidi_ordered = midiwriter.send_ordered
+        sendmidi_pair = midiwriter.send_pair
+        midi_lastvalues = self._midi_analog_lastvalues
+        midi_lastvalues[pin] = -1
+        midicfg = self.config['input_mapping'].get("A%d" % (pin + 1), {}).get('midi', {})
+        mode = midicfg.get('mode', 'cc')
+        cc = midicfg.get('cc', 101 + pin)
+        byte1 = 176 + self.config.get('midichannel', 0)
+        if mode == 'cc14' and not (0 <= cc < 32):
+            self.logger.error("analog input %d: 14-bit CC needs a CC between 0-31, got %d. Using 7-bit" % (pin + 1, cc))
+            mode = 'cc'
+        elif mode == 'nrpn' and not _valid_nrpn(midicfg.get('nrpn', cc)):
+            self.logger.error("analog input %d: the NRPN parameter should be between 0-16383, got %s. Using 7-bit" % (
+                pin + 1, str(midicfg.get('nrpn', cc))))
+            mode = 'cc'
+        elif mode not in ('cc', 'cc14', 'nrpn'):
+            self.logger.error("analog input %d: unknown midi mode %s. Using 7-bit" % (pin + 1, mode))
+            mode = 'cc'
+
+        if mode == 'cc':
+            def func(normvalue):
+                midivalue = int(normvalue*127+0.5)
+                if midivalue > 127:
+                    midivalue = 127
+                if midivalue != midi_lastvalues[pin]:
+                    midi_lastvalues[pin] = midivalue
+                    sendmidi((byte1, cc, midivalue))
+        elif mode == 'cc14':
+            cc_lsb = cc + 32
+
+            def func(normvalue):
+                value = int(normvalue*16383+0.5)
+                if value > 16383:
+                    value = 16383
+                lastvalue = midi_lastvalues[pin]
+                if value != lastvalue:
+                    midi_lastvalues[pin] = value
+                    msb = value >> 7
+                    if msb != lastvalue >> 7:
+                        sendmidi_pair((byte1, cc, msb), (byte1, cc_lsb, value & 127))
+                    else:
+                        sendmidi((byte1, cc_lsb, value & 127))
+        else:
+            param = midicfg.get('nrpn', cc)
+            param_msb, param_lsb = param >> 7, param & 127
+            # the selected NRPN parameter is shared by all inputs on the channel.
+            # NRPN sequences can't be coalesced, the order matters
+            nrpn_selected = self._midi_nrpn_selected
+
+            def func(normvalue):
+                value = int(normvalue*16383+0.5)
+                if value > 16383:
+                    value = 16383
+                lastvalue = midi_lastvalues[pin]
+                if value != lastvalue:
+                    midi_lastvalues[pin] = value
+                    msb = value >> 7
+                    if nrpn_selected.get(byte1) != param:
+                        nrpn_selected[byte1] = param
+                        sendmidi_ordered((byte1, 99, param_msb))
+                        sendmidi_ordered((byte1, 98, param_lsb))
+                        sendmidi_ordered((byte1, 6, msb))
+                    elif msb != lastvalue >> 7:
+                        sendmidi_ordered((byte1, 6, msb))
+                    sendmidi_ordered((byte1, 38, value & 127))
+        return func
+
     def _update_dispatch_funcs(self):
-        for analog_pin in range(4):
+        for analog_pin in range(self._num_analog_pins):
             self._input_changed("A", analog_pin)
-        for digital_pin in range(10):
+        for digital_pin in range(self._num_digital_pins):
             self._input_changed("D", digital_pin)
+        for pin in range(self._num_analog_pins, DISPATCH_TABLE_SIZE):
+            self._analog_funcs[pin] = self._create_reject_func("A", pin)
+        for pin in range(self._num_digital_pins, DISPATCH_TABLE_SIZE):
+            self._digital_funcs[pin] = self._create_reject_func("D", pin)
+
+    def _create_reject_func(self, kind, pin):
+        """
+        returns the dispatch function of a pin which the device did not
+        report: the frame is dropped
+        """
+        logger = self.logger
+        def func(value):
+            logger.debug("got a frame for the unknown pin %s%d, dropping it" % (kind, pin))
+        return func
+
+    def _pins_resize(self, num_analog, num_digital):
+        """
+        size the state of the inputs for the number of pins reported by
+        the device. The lists are resized in place, since the dispatch
+        functions hold a reference to them. The state of the pins which
+        remain is kept
+
+        ==> True if the number of pins changed (the dispatch functions
+            need to be updated)
+        """
+        old_analog, old_digital = self._num_analog_pins, self._num_digital_pins
+        if (num_analog, num_digital) == (old_analog, old_digital):
+            return False
+        self.logger.info("the device has %d analog and %d digital inputs" % (num_analog, num_digital))
+        def resize(seq, size, default):
+            del seq[size:]
+            seq.extend(default() for i in range(size - len(seq)))
+        resolution = DEFAULTS['max_analog_value']
+        resize(self._analog_resolution_per_pin, num_analog, lambda: resolution)
+        resize(self._analog_minvalues, num_analog, lambda: resolution)
+        resize(self._analog_maxvalues, num_analog, lambda: 1)
+        resize(self._analog_autorange, num_analog, lambda: 1)
+        resize(self._analog_curves, num_analog, lambda: _curve_linear)
+        resize(self._analog_luts, num_analog, lambda: [-1] * (MAX_ANALOG_RESOLUTION + 1))
+        resize(self._midi_analog_lastvalues, num_analog, lambda: 0)
+        resize(self._digital_inverted, num_digital, lambda: False)
+        self._num_analog_pins = num_analog
+        self._num_digital_pins = num_digital
+        for pin in range(old_analog, num_analog):
+            self._analog_lut_update(pin)
+        if self._shm is not None:
+            # the layout of the shared memory depends on the number of pins
+            self._shm.close()
+            self._shm_start()
+        return True
 
     def _input_changed(self, kind, pin):
+        if kind == 'A':
+            self._analog_curve_update(pin)
         f = self._create_dispatch_func(kind, pin)
         if kind == 'A':
             self._analog_funcs[pin] = f
@@ -593,14 +1096,28 @@ class Pedlbrd(object):
             self._digital_funcs[pin] = f
 
     def _update_handlers(self):
-        for handler in self._handlers.items():
+        for handler in self._handlers.values():
             handler.cancel()
         self._handlers = {}
-        time.sleep(0.05)
         autosave_config_period = self.config.setdefault('autosave_config_period', 31)
         if autosave_config_period:
             self._handlers['save_config'] = \
-                self._call_regularly(autosave_config_period, self._save_config)
+                self._io_scheduler.call_regularly(autosave_config_period, self._save_config)
+        calibration_save_period = self.config.get('calibration_save_period', 10)
+        if self.config.get('persist_calibration', True) and calibration_save_period > 0:
+            # the ranges are read on the mainloop, the file is written from the io thread
+            self._handlers['save_calibration'] = \
+                self._call_regularly(calibration_save_period, self._calibration_save)
+        self._handlers['pending_expire'] = \
+            self._call_regularly(max(0.1, self._pending.timeout / 4), self._pending_expire)
+        lease_ttl = self.config.get('osc_lease_ttl', 0)
+        if lease_ttl > 0:
+            self._handlers['osc_leases'] = \
+                self._call_regularly(lease_ttl / 4, self._osc_leases_check)
+        host_heartbeat_period = self.config.get('host_heartbeat_period', 0.3)
+        if host_heartbeat_period > 0:
+            self._handlers['host_heartbeat'] = \
+                self._call_regularly(host_heartbeat_period, self._send_heartbeat)
 
     # ***********************************************
     #
@@ -619,7 +1136,6 @@ class Pedlbrd(object):
             th.start()
             return
 
-        self._msgqueue = Queue()
         self._midi_turnon()
         self._update_handlers()
         time_time = time.time
@@ -634,9 +1150,7 @@ class Pedlbrd(object):
 
         # if the mainloop is active without time out for this interval, 
         # it will be interrupted
-        bgtask_checkinterval = self.config['sync_bg_checkinterval']
-        # do background tasks after this time of idle (no data comming from the device)
-        idle_threshold = self.config['idle_threshold'] 
+        bgtask_checkinterval = min(self.config['sync_bg_checkinterval'], self._control_max_latency)
         button_short_click = self.config['reset_click_duration']
         if osc_recv_inside_loop:
             oscrecv = self._oscserver.recv
@@ -659,41 +1173,103 @@ class Pedlbrd(object):
                 s = self._serialconnection
                 s_read = s.read
                 _ord, _len = ord, len
-                last_heartbeat = bgtask_lastcheck = last_idle = button_pressed_time = time_time()
+                bgtask_lastcheck = button_pressed_time = time_time()
                 connected = True
-                needs_reset = False
+                lost = False
+                # the watchdog is armed with the first heartbeat, the device
+                # does not send any while it boots after the port is opened
+                watchdog = self._watchdog
+                watchdog.timeout = self._heartbeat_timeout()
+                watchdog.reset(bgtask_lastcheck)
+
+                s_inwaiting = s.inWaiting
+                now = time_time()
+                # idle, the mainloop waits for the device or to be woken up
+                # (see _mainloop_wakeup), at most until the next job is due
+                if self._wakeup_fds is not None:
+                    wakefd = self._wakeup_fds[0]
+                    serialfd = s.fileno()
+                    waitfds = (serialfd, wakefd)
+                    if osc_recv_inside_loop:
+                        # an OSC message wakes the loop, it is read in the idle branch
+                        waitfds += (self._oscserver.fileno(),)
+                else:
+                    waitfds = None
+                serialtimeout = self._serialtimeout
+                _select, _osread = select.select, os.read
 
                 # CACHE
                 self._update_dispatch_funcs()
                 analog_funcs = self._analog_funcs
                 digital_funcs = self._digital_funcs
+                midiwriter = self._midiwriter
+                midi_pending = midiwriter.pending
+                control = self._control
+                scheduler = self._scheduler
+                clock_update = self._device_clock.update
+                # the analog frames received are counted to adapt the rate of the device
+                analog_frames = 0
+                rate_period = self.config.get('adaptive_rate_period', 0.25)
+                rate_check = now + rate_period if self.config.get('adaptive_rate', False) else float('inf')
+                analog_maskbytes = mask_bytes(self._num_analog_pins)
+                digital_maskbytes = mask_bytes(self._num_digital_pins)
+                # input is dropped until a heartbeat (after a baudrate switch)
+                resync = False
 
                 while self._running:
-                    b = s_read(1)
+                    # scheduled jobs (see _call_later) run here, between frames
+                    if now >= scheduler.deadline:
+                        scheduler.run(now)
+                    if now >= rate_check:
+                        rate_check = now + rate_period
+                        self._adapt_rate(now, analog_frames)
+                        analog_frames = 0
+                    # control messages are checked for every frame, so that
+                    # they are not delayed by a continuous stream of data
+                    while control:
+                        msg = control.popleft()
+                        if msg == "RESET" or msg == "UPDATE":
+                            self.logger.debug("******** got %s message" % msg)
+                            self._update_dispatch_funcs()
+                            analog_funcs = self._analog_funcs
+                            digital_funcs = self._digital_funcs
+                        elif msg == "RESYNC":
+                            resync = True
+                        else:
+                            self.logger.error("got unknown message in the control queue: %s" % str(msg))
+                    # coalesced midi is sent when the window is over or
+                    # when there is nothing more to read from the device
+                    if midi_pending and (now >= midiwriter.deadline or not s_inwaiting()):
+                        midiwriter.flush()
+                    if waitfds is None or s_inwaiting():
+                        b = s_read(1)
+                    else:
+                        timeout = max(0, min(serialtimeout, scheduler.deadline - now, rate_check - now))
+                        try:
+                            readable = _select(waitfds, (), (), timeout)[0]
+                        except select.error:
+                            readable = ()
+                        if wakefd in readable:
+                            _osread(wakefd, 512)
+                        b = s_read(1) if serialfd in readable else ''
                     now = time_time()
                     if not _len(b):
                         # serial timedout: IDLE
                         if osc_recv_inside_loop:
                             oscrecv(0)
-                        if (now - last_idle) > idle_threshold:
-                            self._midioutports_check_changed()
-                            last_idle = now
-                        if not self._msgqueue.empty():
-                            msg = self._msgqueue.get()
-                            if msg == "RESET":
-                                self.logger.debug("******** got RESET message")
-                                needs_reset = True
-                                break
-                            elif msg == "UPDATE":
-                                self._update_dispatch_funcs()
-                                analog_funcs = self._analog_funcs
-                                digital_funcs = self._digital_funcs
-                            else:
-                                self.logger.error("got unknown message in the msgqueue: %s" % str(msg))
+                        if watchdog.lost(now):
+                            self.logger.error("no heartbeat from the device in %.2f seconds" % (now - watchdog.last))
+                            self._notify_disconnected()
+                            lost = True
+                            break
                         continue
                     b = _ord(b)
                     if not(b & 0b10000000):
                         continue
+                    if resync:
+                        if b != 128 + 72:  # H(eartbeat)
+                            continue
+                        resync = False
                     # check also when on heavy load
                     if (now - bgtask_lastcheck) > bgtask_checkinterval:
                         bgtask_lastcheck = now
@@ -712,6 +1288,7 @@ class Pedlbrd(object):
                         value = _ord(msg[1])*128 + _ord(msg[2])
                         func = analog_funcs[param]
                         func(value)
+                        analog_frames += 1
                     # -------------
                     #    DIGITAL
                     # -------------
@@ -728,12 +1305,48 @@ class Pedlbrd(object):
                         else:
                             func = digital_funcs[param]
                             func(value)
+                    # -------------
+                    #   ANALOG (packed, protocol 2)
+                    # -------------
+                    elif cmd == 97:  # --> a(nalog): mask, then 2 bytes per pin in the mask
+                        values = read_analog2(s_read, analog_maskbytes)
+                        if values is None:
+                            self.logger.debug('timed out while reading packed analog message, dropping it')
+                            continue
+                        for param, value in values:
+                            analog_funcs[param](value)
+                        analog_frames += 1
+                    # -------------
+                    #   DIGITAL (packed, protocol 2)
+                    # -------------
+                    elif cmd == 100:  # --> d(igital): changed mask, state mask
+                        changes = read_digital2(s_read, digital_maskbytes)
+                        if changes is None:
+                            self.logger.debug('timed out while reading packed digital message, dropping it')
+                            continue
+                        for param, value in changes:
+                            if digitalinput_needs_calibration[param]:
+                                self._digital_inverted[param] = bool(value)
+                                digitalinput_needs_calibration[param] = False
+                            else:
+                                digital_funcs[param](value)
 
                     # -------------
+                    #     TIME
+                    # -------------
+                    elif cmd == 84:  # --> T(ime), sent before the frames of each loop of the device
+                        msg = s_read(3)
+                        if _len(msg) != 3:
+                            self.logger.debug('timed out while reading timestamp, dropping it')
+                            continue
+                        clock_update((_ord(msg[0]) << 14) + (_ord(msg[1]) << 7) + _ord(msg[2]), now)
+                    # -------------
                     #   HEARTBEAT
                     # -------------
                     elif cmd == 72:  # --> H(eartbeat)
-                        last_heartbeat = now
+                        watchdog.beat(now)
+                        # the period might have been changed (/heartperiod/set)
+                        watchdog.timeout = self._heartbeat_timeout()
                         if not connected:
                             self._notify_connected()
                             self._get_device_info()
@@ -760,19 +1373,7 @@ class Pedlbrd(object):
                     elif cmd == 82:  # --> R(eply)
                         try:
                             msg = serial_read(s, 3)
-                            param = _ord(msg[0])
-                            func = self._callbackreg.get(param)
-                            if func:
-                                value = _ord(msg[1])*128 + _ord(msg[2])
-                                try:
-                                    func(value)
-                                except:
-                                    self.logger.error("error in callback registered to {param}. error: {error}".format(param=param, error=sys.exc_info()))
-                                del self._callbackreg[param]
-                            else:
-                                # discard reply
-                                value = _ord(msg[1])*128 + _ord(msg[2])
-                                self.logger.debug('no callback for param %d, value: %d' % (param, value))
+                            self._apply_callback(_ord(msg[0]), _ord(msg[1])*128 + _ord(msg[2]))
                         except IOError:
                             self.logger.error("serial REPLY: error reading from serial (probably timed out)")
                     # -------------
@@ -801,10 +1402,22 @@ class Pedlbrd(object):
                                 enabled_pins_analog=enabled_pins_analog, enabled_pins_digital=enabled_pins_digital
                             )
                             self._device_info.update(info)
+                            self._device_params_from_info(analog_pins)
+                            resized = self._pins_resize(num_analog_pins, num_digital_pins)
+                            if resized:
+                                self._update_dispatch_funcs()
+                                analog_maskbytes = mask_bytes(num_analog_pins)
+                                digital_maskbytes = mask_bytes(num_digital_pins)
+                            # the frames carry the index of the pin, not the pin itself
+                            for i, pin in enumerate(analog_pins):
+                                self._analog_resolution_per_pin[i] = pin.resolution
+                            previous_device = self._calibration_device
+                            if previous_device is not None and previous_device != str(dev_id):
+                                # another device (or not the one assumed at startup)
+                                self._analog_ranges_reset()
+                            if previous_device != str(dev_id) or resized:
+                                self._calibration_restore(dev_id)
                             self._apply_callback(replyid, info)
-                            for pin in analog_pins:
-                                self._analog_resolution_per_pin[pin.pin] = pin.resolution
-                            print info
                         except IOError:
                             self.logger.error("serial INFO: error reading from serial (probably timed out)")
                             continue
@@ -826,11 +1439,17 @@ class Pedlbrd(object):
                             self.logger.info('>>>>>> ' + msg)
                         except IOError:
                             self.logger.error("serial MESSAGE: error reading from serial (probably timed out)")
-                self.logger.debug("---------------> out of inner loop")
-                if needs_reset:
+                if lost:
+                    # the device is frozen or was unplugged, look for it again.
+                    # The port is opened again at the default baudrate
+                    # only a loss soon after the switch is blamed on the rate (not an unplug later)
+                    trial = self.config.get('serial_baudrate_trial', 5)
+                    if s.baudrate != BAUDRATE and time_time() - self._baudrate_switch_time < trial:
+                        self.logger.error("device lost at %d baud, this rate will not be negotiated again" % s.baudrate)
+                        self._baudrates_failed.add(s.baudrate)
                     continue
-                else:
-                    break
+                self.logger.debug("---------------> out of inner loop")
+                break
             except KeyboardInterrupt:   # poner una opcion en config para decidir si hay que interrumpir por ctrl-c
                 print "keyboard interrupt!"
                 if self.config['stop_on_keyboard_interrupt']:
@@ -847,39 +1466,105 @@ class Pedlbrd(object):
                 continue
         self._terminate()
 
-    def send_to_device(self, bytes, callback=None):
+    def send_to_device(self, bytes, callback=None, errback=None, pacing=None):
         """
         send an arbitrary array of bytes to the device over serial
 
         * If you add a callback, it will be registered to the replyid given
         (the replyid is always the last byte in a message expecting a replyid)
+        * If the device does not reply in time (device_reply_timeout), or
+        too many requests are waiting (device_max_pending), errback is
+        called with the error (a string)
+        * Queries (G) identical to one waiting for its reply are not sent
+        again, the callback is called with the same reply
 
         bytes: a seq of bytes (either chars or numbers between 0-127)
+        pacing: the pacing of the writer for the commands after this one
+                (see SerialWriter.put), for commands changing the loop of the device
         """
         if not self._serialconnection:
             self.logger.error("tried to write to serial before the connection was established")
+            if errback is not None:
+                errback("not connected")
             return
         intbytes = [(ord(b) if isinstance(b, str) else b) for b in bytes]
         if any(not(0 <= byte <= 127) for byte in intbytes):
             self.logger.error("send_to_device: value outside of range (0-127). Data will NOT be sent. %s" % str(intbytes))
             return
         if callback is not None:
-            replyid = self._new_replyid()
-            self._register_callback(replyid, callback)
+            key = tuple(intbytes) if intbytes[0] == ord('G') else None
+            replyid = self._pending.add(key, callback, errback)
+            if replyid is None:
+                # an identical query is waiting, it will answer this one too
+                return
+            if replyid < 0:
+                self.logger.error("send_to_device: too many requests waiting for a reply, dropping %s" % str(bytes))
+                if errback is not None:
+                    errback("busy")
+                return
             intbytes.append(replyid)
         intbytes.append(128)
         bytes2 = map(chr, intbytes)
         s = ''.join(bytes2)
-        try:
-            self._serialconnection.write(s)
-        except serial.SerialException:
-            self.logger.error("could not write to device! SerialException")
+        # the command is written by the serial writer thread
+        if not self._serialwriter.put(s, _command_key(intbytes), pacing):
+            self.logger.error("send_to_device: the write queue is full, dropping %s" % str(bytes))
+            if callback is not None:
+                self._pending.pop(intbytes[-2])
+                if errback is not None:
+                    errback("busy")
+            return
+        if intbytes[0] == ord('S') and len(intbytes) > 2:
+            self._device_param_changed(intbytes)
+
+    def _serial_open(self, port):
+        self._serial_close()
+        self._device_clock.reset()
+        self._rate_controller.reset()
+        self._serialconnection = conn = serial.Serial(port, baudrate=BAUDRATE, timeout=self._serialtimeout)
+        self._serialwriter = SerialWriter(conn.write, pacing=self._serial_pacing(),
+                                          maxsize=self.config.get('serial_write_queuesize', 32))
+
+    def _serial_close(self):
+        if self._serialwriter is not None:
+            self._serialwriter.close()
+            self._serialwriter = None
+        if self._serialconnection:
+            self._serialconnection.close()
+            self._serialconnection = None
+
+    def _serial_pacing(self, delay=None):
+        """
+        the time to wait between commands sent to the device: one loop
+        of the device (its delay plus ~1 ms per pin, see firmware.ino)
+
+        delay: the delay of the device, if not the stored one (see _adapt_rate)
+        """
+        pacing = self.config.get('serial_write_pacing', 0)
+        if pacing > 0:
+            return pacing
+        if delay is None:
+            delay = self._device_params.get((ord('G'), ord('D')), 20)
+        numpins = self._num_analog_pins + self._num_digital_pins
+        return (delay + numpins + 4) / 1000
+
+    def _device_param_changed(self, setbytes):
+        """
+        called when a S(et) command is sent. The cached value is
+        read again from the device, so that the cache holds the value
+        which the device actually accepted
+        """
+        param = chr(setbytes[1])
+        numindex = DEVICE_CACHED_PARAMS.get(param)
+        if numindex is None:
+            return
+        query = (ord('G'), setbytes[1]) + tuple(setbytes[2:2+numindex])
+        self._device_params.pop(query, None)
+        # the query is written after the set command
+        self._device_query(query, lambda value: None)
 
     def _send_osc_ui(self, path, *data):
-        oscserver = self._oscserver
-        if oscserver:
-            for address in self._osc_ui_addresses:
-                oscserver.send(address, path, *data)
+        self._osc_ui_dests.send(path, *data)
 
     def _set_status(self, status=None):
         """
@@ -898,9 +1583,7 @@ class Pedlbrd(object):
             self._send_osc_ui('/status', self._status)
 
     def _send_osc_data(self, path, *data):
-        send = self._oscserver.send
-        for address in self._osc_data_addresses:
-            send(address, path, *data)
+        self._osc_data_dests.send(path, *data)
 
     def _save_config(self):
         if not self.config.state['changed'] and self.config.state['saved']:
@@ -910,42 +1593,171 @@ class Pedlbrd(object):
         def saveit(self=self):
             configfile = self.configfile
             assert configfile is not None
-            _jsondump(self.config, configfile)
+            # cleared before taking the snapshot, a change made meanwhile is saved the next time
+            self.config.state['changed'] = False
+            _jsondump(self.config.snapshot(), configfile)
             self.logger.debug('save_config: saving to ' + configfile)
             self.config.state['saved'] = True
-            self.config.state['changed'] = False
         saveit()
 
+    def _calibration_load(self):
+        """
+        ==> the calibration saved, as a dict {'last_device': dev_id,
+            'devices': {dev_id: {label: [minvalue, maxvalue]}}}
+        """
+        calibration = None
+        if self.config.get('persist_calibration', True):
+            calibration = envir.calibration_load()
+        calibration = calibration or {}
+        devices = calibration.get('devices')
+        if not isinstance(devices, dict):
+            devices = {}
+        return {'last_device': calibration.get('last_device'), 'devices': devices}
+
+    def _calibration_restore(self, dev_id):
+        """
+        extend the range of the analog inputs in autorange mode to the
+        range learned in previous sessions with the device, and use
+        them from now on
+        """
+        if dev_id is None:
+            return
+        # the device is known also without persistence, a reconnection
+        # of the same device must not reset the ranges
+        self._calibration_device = dev_id = str(dev_id)
+        if not self.config.get('persist_calibration', True):
+            return
+        ranges = self._calibration['devices'].get(dev_id)
+        if not isinstance(ranges, dict):
+            ranges = {}
+        for pin in range(self._num_analog_pins):
+            saved = ranges.get("A%d" % (pin + 1))
+            if saved is None or not self._analog_autorange[pin]:
+                continue
+            try:
+                minvalue, maxvalue = map(int, saved)
+            except (TypeError, ValueError):
+                self.logger.error("calibration: could not parse the range of A%d: %s" % (pin + 1, str(saved)))
+                continue
+            self._analog_minvalues[pin] = max(0, min(minvalue, self._analog_minvalues[pin]))
+            self._analog_maxvalues[pin] = min(MAX_ANALOG_RESOLUTION, max(maxvalue, self._analog_maxvalues[pin]))
+            self._analog_lut_update(pin)
+        if ranges:
+            self.logger.debug("calibration: restored the ranges of device %s: %s" % (dev_id, str(ranges)))
+
+    def _calibration_ranges(self):
+        """
+        ==> the ranges of the active analog inputs in autorange mode,
+            as {label: [minvalue, maxvalue]}
+        """
+        ranges = {}
+        for pin in range(self._num_analog_pins):
+            minvalue, maxvalue = self._analog_minvalues[pin], self._analog_maxvalues[pin]
+            if self._analog_autorange[pin] and maxvalue - minvalue > AUTORANGE_MIN_SPAN:
+                ranges["A%d" % (pin + 1)] = [minvalue, maxvalue]
+        return ranges
+
+    def _calibration_save(self, background=True):
+        """
+        save the ranges of the current device, if they changed. Called
+        from the mainloop, which resizes the ranges (see _pins_resize)
+
+        background: write the file from the io thread
+        """
+        dev_id = self._calibration_device
+        if dev_id is None or not self.config.get('persist_calibration', True):
+            return
+        ranges = self._calibration_ranges()
+        if background:
+            self._io_scheduler.call_later(0, self._calibration_store, (dev_id, ranges))
+        else:
+            self._calibration_store(dev_id, ranges)
+
+    def _calibration_store(self, dev_id, ranges):
+        calibration = self._calibration
+        with self._calibration_lock:
+            if calibration['devices'].get(dev_id, {}) == ranges and calibration['last_device'] == dev_id:
+                return
+            calibration['devices'][dev_id] = ranges
+            calibration['last_device'] = dev_id
+        self._calibration_write()
+
+    def _calibration_forget(self):
+        """
+        forget the ranges saved for the current device. The file is
+        written from the io thread
+        """
+        dev_id = self._calibration_device
+        with self._calibration_lock:
+            if dev_id is None or dev_id not in self._calibration['devices']:
+                return
+            del self._calibration['devices'][dev_id]
+        self._io_scheduler.call_later(0, self._calibration_write)
+
+    def _calibration_write(self):
+        with self._calibration_lock:
+            try:
+                envir.calibration_save(self._calibration)
+                self.logger.debug('calibration: saved to ' + envir.calibrationpath())
+            except (IOError, OSError):
+                self.logger.error("could not save the calibration: %s" % str(sys.exc_info()[1]))
+
     def _gen_normalize(self, pin):
+        """
+        returns a function mapping a raw value of the given pin to 0-1
+        (-1 if the pin is not active yet)
+
+        The normalization and the response curve are precomputed in the
+        lookup table of the pin, which is only updated when the range changes
+        """
         maxvalues = self._analog_maxvalues
         minvalues = self._analog_minvalues
+        lut = self._analog_luts[pin]
         if self._analog_autorange[pin]:
+            lut_update = self._analog_lut_update
+
             def func(value):
-                maxvalue = maxvalues[pin]
-                minvalue = minvalues[pin]
-                if value > maxvalue:
-                    maxvalues[pin] = value
-                    value = 1
-                elif value >= minvalue:
-                    value = (value - minvalue) / (maxvalue - minvalue)
-                else:
+                if value > maxvalues[pin]:
+                    maxvalues[pin] = min(value, MAX_ANALOG_RESOLUTION)
+                    lut_update(pin)
+                elif value < minvalues[pin]:
                     minvalues[pin] = value
-                    value = 0
-                if maxvalue - minvalue > 10:
-                    return value
-                return -1
+                    lut_update(pin)
+                try:
+                    return lut[value]
+                except IndexError:
+                    return lut[-1]
         else:
             def func(value):
-                maxvalue = maxvalues[pin]
-                minvalue = minvalues[pin]
-                value2 = (value - minvalue) / (maxvalue - minvalue)
-                if value2 > 1:
-                    value2 = 1
-                elif value2 < 0:
-                    value2 = 0
-                return value2
+                try:
+                    return lut[value]
+                except IndexError:
+                    return lut[-1]
         return func
 
+    def _analog_curve_update(self, pin):
+        """
+        compile the response curve of the given pin as defined in
+        the input_mapping, and recompute its lookup table
+        """
+        mapping = self.config['input_mapping'].get("A%d" % (pin + 1), {})
+        curvedesc = mapping.get('curve', 'linear')
+        curve = _curve_from_description(curvedesc)
+        if curve is None:
+            self.logger.error("analog input %d: could not parse curve %s, using linear" % (pin + 1, str(curvedesc)))
+            curve = _curve_linear
+        self._analog_curves[pin] = curve
+        self._analog_lut_update(pin)
+
+    def _analog_lut_update(self, pin):
+        """
+        recompute the lookup table of the given pin. This should be called
+        whenever the range (min/max) or the curve of the pin change
+        """
+        _analog_lut_fill(self._analog_luts[pin], self._analog_curves[pin],
+                         self._analog_minvalues[pin], self._analog_maxvalues[pin],
+                         self._analog_autorange[pin])
+
     def _normalize(self, pin, value):
         """
         pin here refers to the underlying arduino pin
@@ -976,42 +1788,67 @@ class Pedlbrd(object):
             return
         midiout = rtmidi.MidiOut()
         midiout.open_virtual_port(self.config['midi_device_name'])
-        for port in self._midithrough_ports:
-            midiout.open_port(port)
+        outputs = MidiOutputs(midiout)
+        self._midiports = MidiPortManager(
+            rtmidi.MidiOut, outputs, callback=self._midioutports_changed,
+            poll_period=self.config.get('midiports_poll_period', 3),
+            queuesize=self.config.get('midithrough_queuesize', 256))
+        # the wanted midithrough ports survive a restart of the midi system
+        self._midiports.through = self._midithrough_ports
+        self._midiports.sync()
+        self._midiports.start()
         self._midiout = midiout
-        self._midioutports = self._midiout.ports
+        self._midiwriter = MidiWriter(outputs, self.config.get('midi_coalesce_window', 0))
 
     def _midi_turnoff(self):
         if self._midiout is not None:
+            self._midiwriter.flush()
+            self._midiports.stop()
             self._midiout.close_port()
             self._midiout = None
 
     def _midithrough_set(self, wildcard_or_index, value):
-        self._midithrough_index = wildcard_or_index+1  # 0 is no ports selected
+        """
+        wildcard_or_index: the index of the port (as returned by /midioutports/get)
+                           or a wildcard to match the port names
+        value: 1 to send midi through the port(s), 0 to stop
+        """
+        midiports = self._midiports
+        if midiports is None:
+            self.logger.error("midithrough: midi is not active")
+            return
+        if isinstance(wildcard_or_index, int):
+            self._midithrough_index = wildcard_or_index+1  # 0 is no ports selected
+            portnames = midiports.match(wildcard_or_index)
+            if not portnames:
+                self.logger.error("midithrough: no midiport with index %d" % wildcard_or_index)
+                return
+            # an index is only valid for the current ports, remember the name
+            wildcard_or_index = portnames[0]
+        # the set is replaced, not modified, the midiports thread might be reading it
         if value == 1:
-            if wildcard_or_index not in self._midithrough_ports:
-                print "connecting to", wildcard_or_index
-                self._midiout.open_port(wildcard_or_index)
-                print "open ports:", self._midiout._openedports
-                self._midithrough_ports.add(wildcard_or_index)
+            self._midithrough_ports = self._midithrough_ports | {wildcard_or_index}
         else:
-            if not isinstance(wildcard_or_index, int):
-                self.logger.error("midithrough ports can only be unset by index")
-            else:
-                self._midithrough_ports.discard(wildcard_or_index)
-                self._midiout.close_port()
-                for port in self._midithrough_ports:
-                    self._midiout.open_port(port)
+            self._midithrough_ports = self._midithrough_ports - {wildcard_or_index}
+        midiports.through = self._midithrough_ports
+        # only the ports affected are opened or closed
+        midiports.sync()
+        self.logger.debug("midithrough ports open: %s" % ", ".join(midiports.opened))
 
     def _notify_disconnected(self):
         msg = "DISCONNECTED!"
         self.logger.info(msg)
         self._set_status('DISCONNECTED')
+        self._device_params_clear()
+        for bytes, errbacks in self._pending.expire(everything=True):
+            for errback in errbacks:
+                errback("disconnected")
 
     def _notify_connected(self):
         msg = "CONNECTED!"
         self.logger.info(msg)
         self._set_status('CONNECTED')
+        self._device_params_clear()
 
     def _connect(self):
         """
@@ -1025,7 +1862,8 @@ class Pedlbrd(object):
         if not reconnect_period:
             self.stop()
         else:
-            self._notify_disconnected()
+            if self._status != 'DISCONNECTED':
+                self._notify_disconnected()
             self.logger.debug("....looking for device")
             while self._running:
                 try:
@@ -1036,13 +1874,14 @@ class Pedlbrd(object):
                         break
                     else:
                         self.logger.debug("----> port NOT FOUND. Attempting again in %.2f seconds" % reconnect_period)
-                        time.sleep(reconnect_period)
+                        self._scheduler.sleep(reconnect_period)
                 except KeyboardInterrupt:
                     break
         if conn_found:
-            self._serialconnection = serial.Serial(self.serialport, baudrate=BAUDRATE, timeout=self._serialtimeout)
+            self._serial_open(self.serialport)
             self._notify_connected()
             self._call_later(2, self._get_device_info)
+            self._call_later(2, self._device_negotiate)
             self._call_later(3, lambda self: setattr(self, '_first_conn', False), (self,))
             if self.config['autocalibrate_digital']:
                 self._call_later(2.5, self.calibrate_digital)
@@ -1050,13 +1889,120 @@ class Pedlbrd(object):
                 self.reset_state()
         return conn_found
 
+    def _device_negotiate(self):
+        """
+        ask the device to use the protocol version and the timestamps
+        configured. Devices not supporting them ignore the commands, the
+        frames of every version are decoded
+        """
+        version = min(self.config.get('device_protocol', PROTOCOL_VERSION), PROTOCOL_VERSION)
+        if version > 1:
+            self.send_to_device(('S', 'V', version))
+        self.send_to_device(('S', 'T', int(bool(self.config.get('device_timestamps', False)))))
+        if self.config.get('serial_max_baudrate', BAUDRATE) > BAUDRATE:
+            self.send_to_device(('G', 'R'), self._baudrate_negotiate)
+
+    def _baudrate_negotiate(self, supported):
+        """
+        switch both sides to the highest baudrate supported by the device,
+        up to serial_max_baudrate. If the device gets no heartbeat from us
+        at the new rate, it goes back to BAUDRATE (see firmware.ino)
+
+        supported: a bitmask of the indices in BAUDRATES supported by the device
+        """
+        maxrate = self.config.get('serial_max_baudrate', BAUDRATE)
+        indices = [i for i, rate in enumerate(BAUDRATES)
+                   if supported & (1 << i) and rate <= maxrate and rate not in self._baudrates_failed]
+        conn = self._serialconnection
+        if not indices or conn is None or BAUDRATES[max(indices)] == conn.baudrate:
+            return
+        index = max(indices)
+        self.send_to_device(('S', 'R', index))
+        # this is called from the mainloop, which must not wait for the writer
+        self._baudrate_switch(conn, index, time.time() + 1)
+
+    def _baudrate_switch(self, conn, index, deadline):
+        """
+        switch the port to BAUDRATES[index] once the S R command was
+        written, one loop of the device later (the device acts on it in
+        its next loop). Called again from the mainloop until then
+        """
+        if self._serialconnection is not conn:
+            return
+        if not self._serialwriter.drain(0):
+            if time.time() > deadline:
+                self.logger.error("could not send the baudrate to the device, staying at %d" % conn.baudrate)
+                return
+            self._call_later(self._serialwriter.pacing, self._baudrate_switch, (conn, index, deadline))
+            return
+        self._call_later(self._serial_pacing(), self._baudrate_apply, (conn, index))
+
+    def _baudrate_apply(self, conn, index):
+        if self._serialconnection is not conn:
+            return
+        conn.flush()
+        conn.baudrate = BAUDRATES[index]
+        conn.flushInput()
+        self._baudrate_switch_time = time.time()
+        # what was read during the switch is garbage, the mainloop drops
+        # its input until a heartbeat arrives at the new rate
+        self._control_post("RESYNC")
+        self._send_heartbeat()
+        self.logger.info("serial: switched to %d baud" % conn.baudrate)
+
+    def _send_heartbeat(self):
+        """
+        the device knows that the driver is present (and, after a
+        baudrate switch, that the new rate works) from these heartbeats
+        """
+        if self._serialconnection is not None:
+            self.send_to_device(('H',))
+
+    def _adapt_rate(self, now, analog_frames):
+        """
+        called regularly from the mainloop with the number of analog frames
+        received since the last call. The device runs fast while the inputs
+        move and slows down when idle (see AdaptiveRate)
+        """
+        if self._device_params.get((ord('G'), ord('V')), 1) < 2:
+            # the transient delay (S d) needs protocol 2
+            return
+        stored = self._device_params.get((ord('G'), ord('D')), 20)
+        delay = self._rate_controller.update(now, analog_frames, stored)
+        if delay is None:
+            return
+        # the pacing of the writer follows the loop of the device once
+        # it has the new delay. The delay set is not stored in the
+        # device (/delay/get still returns the stored one)
+        self.send_to_device(('S', 'd') + int14tobytes(delay), pacing=self._serial_pacing(delay))
+
+    def _heartbeat_timeout(self):
+        """
+        ==> the seconds without a heartbeat after which the device is
+            considered lost, 0 if the watchdog is disabled
+        """
+        periods = self.config.get('heartbeat_watchdog_periods', 3)
+        if periods <= 0:
+            return 0
+        period = self._device_params.get((ord('G'), ord('H')), HEARTBEAT_PERIOD)
+        return periods * period / 1000
+
     def _get_device_info(self):
         def callback(infodict):
             p = self.logger.info
             for k, v in infodict.iteritems():
                 p("{0}: {1}".format(k, v))
+            self._device_params_prefetch()
         self.send_to_device(('G', 'I'), callback)
 
+    def _device_params_from_info(self, analog_pins):
+        params = self._device_params
+        G, S, F, O = map(ord, 'GSFO')
+        for pin in analog_pins:
+            params[(G, S, pin.pin)] = pin.smoothing
+            params[(G, F, pin.pin)] = pin.filtertype
+            params[(G, O, pin.pin)] = pin.denoise
+
     def _configchanged_callback(self, key, value):
         self.logger.debug('changing config %s=%s' % (key, str(value)))
         paths = key.split("/")
@@ -1064,35 +2010,25 @@ class Pedlbrd(object):
         if paths0 == 'input_mapping':
             label = paths[1]
             kind = label[0]
-            pin = int(label[1:])
+            pin = int(label[1:]) - 1
             self._input_changed(kind, pin)
-        elif paths0 == 'osc_send_raw_data':
-            self._sendraw = value
-            self.logger.debug('send raw data: %s' % (str(value)))
-        elif paths0 == 'osc_data_addresses' or paths0 == 'osc_ui_addresses':
-            self._cache_osc_addresses()
-
-    def _midioutports_check_changed(self, notify=True):
-        self.logger.debug(">>>> checking midioutports")
-        portsnow = set(self._midiout.ports)
-        if portsnow != self._midioutports:
-            self._midioutports = portsnow
-            self.logger.debug("midioutports changed: %s" % str(portsnow))
-            if notify:
-                #self._call_later(0.1, lambda:self._send_osc_data("/midioutports", *self._midioutports))
-                self._send_osc_data("/midioutports", *self._midioutports)
-            return True
-        return False
+        elif paths0 in ('osc_data_addresses', 'osc_ui_addresses', 'osc_data_filters') or \
+                paths0.startswith('osc_multicast'):
+            self._runtime_update()
 
-    def _new_replyid(self):
-        self._replyid += 1
-        self._replyid = (self._replyid % 127) + 1 # numbers between 1 and 127
-        return self._replyid
+    def _midioutports_changed(self, ports):
+        """
+        called by the MidiPortManager (in its own thread) when the midiports change
+        """
+        self.logger.debug("midioutports changed: %s" % str(ports))
+        self._send_osc_data("/midioutports", *ports)
 
     def _led_pattern(self, numblink, period_ms, dur_ms):
         """
-        blink the device
+        blink the device. The device reads and sends nothing while
+        it blinks, the heartbeat watchdog waits for it
         """
+        self._watchdog.pause(numblink * period_ms / 1000, time.time())
         msg = ['L']
         msg.extend(int14tobytes(numblink))
         msg.extend(int14tobytes(period_ms))
@@ -1124,12 +2060,11 @@ class Pedlbrd(object):
 
 
     def _update_mainloop(self):
-        self._msgqueue.put_nowait("UPDATE")
+        self._control_post("UPDATE")
 
     def cmd_midichannel_set(self, channel):
         """{i} Set the midichannel (0-15)"""
         if 0 <= channel <= 15:
-            self._update_dispatch_funcs()
             self.config.set("midichannel", channel)
             self._send_osc_ui("/changed/midichannel", channel)
             self._update_mainloop()
@@ -1146,8 +2081,9 @@ class Pedlbrd(object):
         return self._midithrough_index
 
     def cmd_midioutports_get(self, src, reply_id):
-        self.logger.debug("midioutports: %s" % ", ".join(self._midiout.ports))
-        return self._midiout.ports
+        ports = self._midiports.ports
+        self.logger.debug("midioutports: %s" % ", ".join(ports))
+        return ports
 
     def cmd_simulate(self, pin, value):
         """Simulate the value of a pin. A0-A3, D0-D9"""
@@ -1155,7 +2091,7 @@ class Pedlbrd(object):
         self._update_dispatch_funcs()
         kind = pin[0]
         pin_number = int(pin[1:])
-        if kind == 'A' and pin_number < (len(self._analog_funcs) - 1):
+        if kind == 'A' and pin_number < self._num_analog_pins:
             func = self._analog_funcs[pin_number]
             if func:
                 func(value)
@@ -1197,27 +2133,53 @@ class Pedlbrd(object):
 
     def cmd__registerui(self, path, args, types, src, report=True):
         """register for notifications. optional arg: address to register"""
-        addresses = self.config.get('osc_ui_addresses', [])
         addr = _oscmeta_get_addr(args, src)
-        if addr not in addresses:
-            addresses.append(addr)
-            self.config.set('osc_ui_addresses', addresses)
+        self._osc_lease_renew(addr)
+        if tuple(addr) not in self._runtime.ui_addresses:
+            # a new list is set, the current one might be in use by a reader
+            self.config.set('osc_ui_addresses', self.config.get('osc_ui_addresses', []) + [addr])
             if report:
                 self.report(log=True)
 
     def _registerdata(self, path, args, types, src, report=True):
-        addresses = self.config.get('osc_data_addresses', [])
+        args, patterns = _split_data_filters(args)
+        if isinstance(src, OSCStreamClient) and not args:
+            # the client receives the data through its connection, which
+            # is not an address to persist or to send UDP to
+            src.server.subscribe(src, data=True, filters=patterns)
+            return
         addr = _oscmeta_get_addr(args, src)
         self.logger.debug("registering addr for data: %s" % str(addr))
-        if addr not in addresses:
-            self.logger.debug('registering addr for data: %s' % str(addr))
-            addresses.append(addr)
-            self.config.set('osc_data_addresses', addresses)
+        self._osc_lease_renew(addr)
+        self._set_data_filters(addr, patterns)
+        if tuple(addr) not in self._runtime.data_addresses:
+            self.config.set('osc_data_addresses', self.config.get('osc_data_addresses', []) + [addr])
             if report:
                 self.report(log=True)
 
+    def _set_data_filters(self, addr, patterns):
+        """
+        patterns: the labels (A1, D*) or paths (/data/D) which addr wants
+                  to receive. An empty list removes the filter
+        """
+        key = "%s:%d" % tuple(addr)
+        filters = self.config.get('osc_data_filters', {})
+        if filters.get(key, []) == patterns:
+            return
+        filters = dict(filters)
+        if patterns:
+            filters[key] = patterns
+        else:
+            del filters[key]
+        self.config.set('osc_data_filters', filters)
+
+    def cmd__registerall(self, path, args, types, src):
+        """Shortcut for /registerui /registerdata. Optional arg: address to register"""
+        self.cmd__registerui(path, args, types, src, report=False)
+        self._registerdata(path, args, types, src)
+
     def cmd__registerdata(self, path, args, types, src, report=True):
-        """Register for data. Optional arg: address to register. Call /signout to stop receiving data"""
+        """Register for data. Optional args: address to register, then labels (A1 A2) or paths (/data/D) to receive only some inputs. Call /signout to stop receiving data"""
         return self._registerdata(path, args, types, src, report=report)
 
     def cmd__register(self, path, args, types, src, report=True):
@@ -1227,14 +2189,48 @@ class Pedlbrd(object):
     def cmd__signout(self, path, args, types, src):
         """Remove observer. Optional: port to signout (defaults to sending port)."""
         addr = _oscmeta_get_addr(args, src)
-        ui_addresses = self.config['osc_ui_addresses']
-        data_addresses = self.config['osc_data_addresses']
-        if addr in ui_addresses:
-            ui_addresses.remove(addr)
-            self.config.set('osc_ui_addresses', ui_addresses)
-        if addr in data_addresses:
-            data_addresses.remove(addr)
-            self.config.set('osc_data_addresses', data_addresses)
+        self._osc_remove_address(addr)
+
+    def _osc_remove_address(self, addr):
+        """
+        stop sending data and notifications to addr
+        """
+        addr = tuple(addr)
+        for key in ('osc_ui_addresses', 'osc_data_addresses'):
+            addresses = self.config[key]
+            remaining = [a for a in addresses if tuple(a) != addr]
+            if len(remaining) != len(addresses):
+                self.config.set(key, remaining)
+        self._set_data_filters(addr, [])
+        self._osc_leases.remove(addr)
+
+    def _osc_lease_renew(self, addr):
+        self._osc_leases.renew(addr)
+
+    def _osc_leases_check(self):
+        """
+        Registered addresses must renew their lease within osc_lease_ttl
+        seconds, by registering again or by answering /ping with /pingback.
+        Addresses which are half way to expire are pinged, expired ones are removed.
+        The addresses in osc_permanent_addresses never expire
+        """
+        ttl = self.config.get('osc_lease_ttl', 0)
+        if ttl <= 0:
+            return
+        now = time.time()
+        permanent = set(tuple(addr) for addr in self.config.get('osc_permanent_addresses', []))
+        runtime = self._runtime
+        addresses = set(runtime.data_addresses + runtime.ui_addresses) - permanent
+        expired, stale = self._osc_leases.check(addresses, ttl, now)
+        for addr in expired:
+            self.logger.info("OSC: lease of %s:%d expired, removing it" % addr)
+            self._osc_remove_address(addr)
+        for addr in stale:
+            self.send_ping(addr, lambda src, addr=addr: self._osc_lease_renew(addr))
+        # forget the pings which were never answered
+        for ID, (callback, senttime) in self._pingback_registry.items():
+            if now - senttime > ttl:
+                del self._pingback_registry[ID]
 
     def cmd_api_get(self, src, reply_id, show=0):
         """{i} Replies with a list of api commands"""
@@ -1261,10 +2257,10 @@ class Pedlbrd(object):
         def callback(devinfo, src=src, reply_id=reply_id):
             tags = 'dev_id:max_digital_pins:max_analog_pins:num_digital_pins:num_analog_pins'
             info = [devinfo.get(tag) for tag in tags.split(':')]
-            self._oscserver.send(src, '/devinfo', tags, *info)
+            self._osc_send(src, '/devinfo', tags, *info)
             tags = 'label:resolution:smoothing:filtertype:denoise:autorange:minvalue:maxvalue'
             for pin in devinfo['analog_pins']:
-                self._oscserver.send(
+                self._osc_send(
                     src, '/devinfo/analogpin', tags,
                     "A%d" % pin.pin, pin.resolution, pin.smoothing, pin.filtertype, pin.denoise,
                     self._analog_autorange[pin.pin], self._analog_minvalues[pin.pin], self._analog_maxvalues[pin.pin]
@@ -1280,29 +2276,34 @@ class Pedlbrd(object):
 
     def cmd__ping(self, path, args, types, src):
         """
-        PING protocol: /ping [optional-return-addr] ID:int
-        will always reply to path /pingback on the
+        PING protocol: /ping ID:int [optional-return-addr]
+        will always reply to path /pingback ID on the
         src address if no address is given.
-        /pingback should return the ID given in /ping
-        Examples: /ping localhost:9000 3456
-                  /ping 9000 3456 (uses src.hostname:9000)
+        Examples: /ping 3456 localhost:9000
+                  /ping 3456 9000 (uses localhost:9000)
                   /ping 3456 (use src.hostname:src.port)
         """
-        addr = _oscmeta_get_addr(args, src)
-        self._oscserver.send(addr, '/pingback')
+        if not args:
+            self.logger.error("/ping: expected an ID")
+            return
+        ID = args[0]
+        addr = _oscmeta_get_addr(args[1:], src)
+        # a ping also renews the lease of the client
+        self._osc_lease_renew((src.hostname, src.port))
+        self._osc_send(addr, '/pingback', ID)
 
-    def cmd_pingback(self, ID):
-        """{i} ID should be the same received by /ping"""
+    def cmd__pingback(self, path, args, types, src):
+        """ID: should be the same received by /ping"""
         if not args:
             self.logger.error("/pingback should return the ID sent by /ping")
             return
         ID = args[0]
-        func = self._pingback_registry.get(ID)
+        func, senttime = self._pingback_registry.pop(ID, (None, None))
         if func:
             try:
                 func((src.hostname, src.port))
             except:
-                self.logger.error("pingback: error while calling callback function: %s" % str(sys.exc_info))
+                self.logger.error("pingback: error while calling callback function: %s" % str(sys.exc_info()[1]))
                 return
         else:
             self.logger.debug("pingback: received a pingback but no callback was registered")
@@ -1310,11 +2311,11 @@ class Pedlbrd(object):
 
     def send_ping(self, addr, callback):
         """
-        callback: a function without arguments (just a continuation)
+        callback: called with the address (host, port) which answered
         """
         ID = self._new_pingbackid()
-        self._pingback_registry[ID] = callback
-        self._oscserver.send(addr, '/ping', ID)
+        self._pingback_registry[ID] = (callback, time.time())
+        self._osc_send(addr, '/ping', ID)
 
     def _new_pingbackid(self):
         try:
@@ -1327,23 +2328,23 @@ class Pedlbrd(object):
         if value < 0 or value > 1:
             self.logger.error("autorange: value outside range")
             return
-        self._analog_autorange_set("A%d" % analoginput, bool(value))
+        self._analog_autorange_set(analoginput, bool(value))
 
     def _analog_autorange_set(self, analoginput, value):
         """
-        analoginput : int --> 0-3
+        analoginput : int --> 1-4
         value : bool
         """
         if value not in (True, False):
             self.logger.error("_analog_autorange_set: value should be a bool")
             return
-        pin = analoginput
-        label = "A%d" % pin
-        if not pintuplet:
+        pin = analoginput - 1
+        if not (0 <= pin < len(self._analog_autorange)):
             self.logger.error("_analog_autorange_set: analoginput out of range")
             return
         self._analog_autorange[pin] = value
-        self.config.set('/input_mapping/{label}/autorange'.format(label=label), value)
+        # this will regenerate the dispatch function of the pin
+        self.config.set('input_mapping/A{0}/autorange'.format(analoginput), value)
 
     def _analogminval_set(self, analoginput, value):
         pin = analoginput - 1
@@ -1351,6 +2352,7 @@ class Pedlbrd(object):
             return
         try:
             self._analog_minvalues[pin] = value
+            self._analog_lut_update(pin)
             self._analog_autorange_set(analoginput, False)
         except IndexError:
             self.logger.error("Analog input outside range")
@@ -1358,6 +2360,46 @@ class Pedlbrd(object):
     def cmd_analogmaxval_set(self, analoginput, value):
         self._analogmaxval_set(analoginput, value)
 
+    def cmd_midimode_set(self, analoginput, mode):
+        """{is} MIDI output of an analog input: cc (7-bit), cc14 (14-bit CC) or nrpn"""
+        label = "A%d" % analoginput
+        if label not in self.config['input_mapping']:
+            self.logger.error("/midimode/set: analoginput out of range: %d" % analoginput)
+            return
+        if mode not in ('cc', 'cc14', 'nrpn'):
+            self.logger.error("/midimode/set: mode should be one of cc, cc14, nrpn. Got %s" % mode)
+            return
+        if mode == 'nrpn':
+            midicfg = self.config['input_mapping'][label].get('midi', {})
+            param = midicfg.get('nrpn', midicfg.get('cc', 100 + analoginput))
+            if not _valid_nrpn(param):
+                self.logger.error("/midimode/set: the NRPN parameter of %s should be between 0-16383, got %s" % (
+                    label, str(param)))
+                return
+        self.config.set('input_mapping/%s/midi/mode' % label, mode)
+
+    def cmd_midimode_get(self, src, reply_id, analoginput):
+        """{i} Returns the MIDI output mode of an analog input (cc, cc14 or nrpn)"""
+        return self.config['input_mapping']["A%d" % analoginput]['midi'].get('mode', 'cc')
+
+    def cmd_curve_set(self, analoginput, curve):
+        """{is} Set the response curve of an analog input: linear, log, exp, scurve"""
+        label = "A%d" % analoginput
+        if label not in self.config['input_mapping']:
+            self.logger.error("/curve/set: analoginput out of range: %d" % analoginput)
+            return
+        if _curve_from_description(curve) is None:
+            self.logger.error("/curve/set: unknown curve %s" % curve)
+            return
+        self.config.set('input_mapping/%s/curve' % label, curve)
+
+    def cmd_curve_get(self, src, reply_id, analoginput):
+        """{i} Returns the response curve of an analog input"""
+        curve = self.config['input_mapping']["A%d" % analoginput].get('curve', 'linear')
+        if not isinstance(curve, basestring):
+            curve = json.dumps(curve)
+        return curve
+
     def _analogmaxval_set(self, analoginput, value):
         pin = analoginput - 1
         if value > self._analog_resolution_per_pin[pin]:
@@ -1365,6 +2407,7 @@ class Pedlbrd(object):
             return
         try:
             self._analog_maxvalues[pin] = value
+            self._analog_lut_update(pin)
             self._analog_autorange_set(analoginput, False)
         except IndexError:
             self.logger.error("Analog input outside range")
@@ -1374,7 +2417,11 @@ class Pedlbrd(object):
         lines = self.report(log=False)
         for line in lines:
             print line
-        self._oscserver.send(addr, '/println', *lines)
+        self._osc_send(addr, '/println', *lines)
+
+    def cmd_shm_get(self, src, replyid):
+        """returns the path of the shared memory output, or an empty string if disabled"""
+        return self._shm.path if self._shm is not None else ''
 
     def cmd_status_get(self, src, replyid):
         return self._status
@@ -1405,6 +2452,10 @@ class Pedlbrd(object):
     specify or even query the port from which you are sending osc,
     so that in order to receive the reply, you must hardcode the src
     """
+    def cmd_protocol_get(self, src, reply_id):
+        """returns the version of the serial protocol used by the device"""
+        return ForwardReply(('G', 'V'))
+
     def cmd_heartperiod_get(self, src, reply_id):
         """returns heartbeat rate in ms"""
         return ForwardReply(('G', 'H'))
@@ -1419,16 +2470,27 @@ class Pedlbrd(object):
 
     def cmd_addrui_get(self, src, reply_id):
         """OSC addresses for UI information ==> uiaddresses : a space separated string of 'hostname:port'"""
-        addresses = self.config['osc_ui_addresses']
-        out = ["%s:%d" % (host, port) for hort, port in addresses]
+        addresses = self._runtime.ui_addresses
+        out = ["%s:%d" % (host, port) for host, port in addresses]
         return out
 
     def cmd_addrdata_get(self, src, reply_id):
         """OSC addresses for data information ==> a space separated string of 'hostname:port'"""
-        addresses = self.config['osc_data_addresses']
+        addresses = self._runtime.data_addresses
         out = ["%s:%d" % (host, port) for host, port in addresses]
         return out
 
+    def cmd_multicast_set(self, value):
+        """{i} 1: send data to the multicast group (osc_multicast_group) instead of each registered address"""
+        self.config.set('osc_multicast', bool(value))
+
+    def cmd_multicast_get(self, src, reply_id):
+        """Returns the multicast group and port (as host:port) if data is sent via multicast, 0 otherwise"""
+        multicast = self._runtime.multicast
+        if multicast:
+            return "%s:%d" % multicast
+        return 0
+
     def cmd_analogresolution_get(self, src, reply_id, analoginput):
         pin = analoginput - 1
         return self._analog_resolution_per_pin[pin]
@@ -1439,7 +2501,7 @@ class Pedlbrd(object):
     def cmd_analogresolution_set(self, analoginput, value):
         """{ii} Set the analog resolution of a pin (value between 255-2047)"""
         pin = analoginput - 1
-        if 255 <= value <= 2047:
+        if 255 <= value <= MAX_ANALOG_RESOLUTION:
             self._analog_resolution_per_pin[pin] = value
             self.send_to_device(('S', 'A', pin) + int14tobytes(value))
 
@@ -1510,6 +2572,11 @@ class Pedlbrd(object):
     def cmd_denoise_get(self, src, replyid, analoginput):
         return ForwardReply(('G', 'O', analoginput-1))
 
+    def cmd_refresh(self):
+        """Forget the cached parameters of the device and read them again"""
+        self._device_params_clear()
+        self._get_device_info()
+
     def cmd_quit(self):
         print("comd_quit")
         self.logger.debug('received /quit signal')
@@ -1595,6 +2662,8 @@ class Pedlbrd(object):
                 # self.logger.debug('registering osc %s --> %s' % (path, method))
                 if self._oscasync:
                     s.add_method(path, None, method)
+                    def handler(path, args, sig, src, callback):
+                        callback(path, args, sig, src)
                 else:
                     def handler(path, args, sig, src, callback):
                         self._call_later(0, callback, (path, args, sig, src))
@@ -1610,6 +2679,7 @@ class Pedlbrd(object):
                     def handler(path, args, sig, src, callback):
                         self._call_later(0, callback, args)
                 s.add_method(path, signature, handler, method)
+            self._osc_handlers[path] = (handler, method, signature if kind == 'ORD' else None)
             osc_commands.append(path)
         return s, osc_commands
 
@@ -1701,7 +2771,7 @@ class Pedlbrd(object):
             except:
                 error = str(sys.exc_info()[1])
                 self.logger.error("error during OSC callback: %s" % str(error))
-                self._oscserver.send(addr, '/error', path, error)
+                self._osc_send(addr, '/error', path, error)
                 return
             if out is None:
                 return
@@ -1710,12 +2780,15 @@ class Pedlbrd(object):
             if isinstance(out, ForwardReply):
                 def callback(outvalue, addr=addr, replyid=replyid, postfunc=out.postfunc):
                     outvalue = postfunc(outvalue)
-                    self._oscserver.send(addr, replypath, methodname, replyid, outvalue)
-                self.send_to_device(out.bytes, callback)
+                    self._osc_send(addr, replypath, methodname, replyid, outvalue)
+
+                def errback(error, addr=addr):
+                    self._osc_send(addr, '/error', path, error)
+                self._device_query(out.bytes, callback, errback)
             else:
                 if not isinstance(out, (tuple, list)):
                     out = (out,)
-                self._oscserver.send(addr, replypath, methodname, replyid, *out)
+                self._osc_send(addr, replypath, methodname, replyid, *out)
                 self._osc_reply_addresses.add(addr)
         return wrapper
 
@@ -1732,6 +2805,161 @@ class ForwardReply(object):
         self.postfunc = postfunc
 
 
+class AdaptiveRate(object):
+    """
+    Chooses the delay between loops of the device from the analog activity.
+
+    While the inputs move (more than `threshold` analog frames per second)
+    the device runs at mindelay. After `idle_time` seconds without
+    movement the delay doubles at each update, starting from the one
+    stored in the device, up to maxdelay, so that a gesture starting
+    meanwhile gets the full rate at once. Idle, the device never runs
+    faster than with its stored delay
+
+    update returns the new delay, or None if it should not change
+    """
+    def __init__(self, mindelay, maxdelay, idle_time=2, threshold=2):
+        self.mindelay = mindelay
+        self.maxdelay = maxdelay
+        self.idle_time = idle_time
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        # the delay last set, None: the one stored in the device
+        self.delay = None
+        self._lastupdate = None
+        self._lastactive = 0
+
+    def update(self, now, frames, stored):
+        """
+        frames: the analog frames received since the last update
+        stored: the delay stored in the device (ms)
+        """
+        lastupdate = self._lastupdate
+        self._lastupdate = now
+        if lastupdate is None or now <= lastupdate:
+            return None
+        if frames / (now - lastupdate) >= self.threshold:
+            self._lastactive = now
+            delay = self.mindelay
+        elif now - self._lastactive < self.idle_time:
+            return None
+        else:
+            current = self.delay if self.delay is not None else stored
+            delay = min(self.maxdelay, current * 2)
+            if delay <= current:
+                return None
+        if delay == self.delay:
+            return None
+        self.delay = delay
+        return delay
+
+
+# The runtime view of the config, read by the OSC thread and the serial
+# loop. It is never modified, see Pedlbrd._runtime_update
+RuntimeConfig = namedtuple('RuntimeConfig', 'data_addresses ui_addresses data_filters multicast')
+
+
+class PendingRequests(object):
+    """
+    The requests sent to the device which wait for a reply, by reply id.
+
+    * a reply id (1-127) is only reused after its request was answered,
+      or one more timeout after it expired, so a late reply can't reach
+      the wrong callback
+    * requests with the same key waiting at the same time are sent
+      only once, all their callbacks are called with the reply
+    * at most maxpending requests wait at the same time
+
+    add is called from the OSC thread, pop from the serial loop
+    """
+    def __init__(self, timeout=1, maxpending=8):
+        self.timeout = timeout
+        self.maxpending = maxpending
+        # replyid -> [key, deadline, callbacks, errbacks]
+        self._byid = {}
+        # key -> replyid
+        self._bykey = {}
+        # expired replyid -> time when it can be reused
+        self._held = {}
+        self._lastid = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._byid)
+
+    def add(self, key, callback, errback=None):
+        """
+        key: identifies identical requests (the bytes of a query),
+             or None if the request should not be coalesced
+
+        ==> the replyid to send with the request, None if an identical
+            request is already waiting, or -1 if too many requests are waiting
+        """
+        with self._lock:
+            if key is not None:
+                replyid = self._bykey.get(key)
+                if replyid is not None:
+                    entry = self._byid[replyid]
+                    entry[2].append(callback)
+                    if errback is not None:
+                        entry[3].append(errback)
+                    return None
+            now = time.time()
+            if self._held:
+                for replyid, until in self._held.items():
+                    if now >= until:
+                        del self._held[replyid]
+            # there are only 127 reply ids
+            if len(self._byid) >= min(self.maxpending, 127 - len(self._held)):
+                return -1
+            replyid = self._lastid
+            while True:
+                replyid = (replyid % 127) + 1
+                if replyid not in self._byid and replyid not in self._held:
+                    break
+            self._lastid = replyid
+            self._byid[replyid] = [key, now + self.timeout,
+                                   [callback], [errback] if errback is not None else []]
+            if key is not None:
+                self._bykey[key] = replyid
+            return replyid
+
+    def pop(self, replyid):
+        """
+        ==> the callbacks waiting for replyid, or None
+        """
+        with self._lock:
+            entry = self._byid.pop(replyid, None)
+            if entry is None:
+                # a late reply, its id is free again
+                self._held.pop(replyid, None)
+                return None
+            if entry[0] is not None:
+                del self._bykey[entry[0]]
+            return entry[2]
+
+    def expire(self, everything=False):
+        """
+        remove the requests whose time is up (or all of them)
+
+        ==> a list of (key, errbacks)
+        """
+        now = time.time()
+        out = []
+        with self._lock:
+            for replyid, (key, deadline, callbacks, errbacks) in self._byid.items():
+                if everything or now > deadline:
+                    del self._byid[replyid]
+                    if key is not None:
+                        del self._bykey[key]
+                    # its reply can still arrive late
+                    self._held[replyid] = now + self.timeout
+                    out.append((key, errbacks))
+        return out
+
+
 class AnalogPin(namedtuple('AnalogPin', 'pin resolutionbits smoothing filtertype denoise')):
     @classmethod
     def fromdata(cls, data):
@@ -1743,6 +2971,119 @@ class AnalogPin(namedtuple('AnalogPin', 'pin resolutionbits smoothing filtertype
         return (1 << self.resolutionbits) - 1
 
 
+def _command_key(intbytes):
+    """
+    commands with the same key replace each other while waiting
+    to be written (see SerialWriter). None: never replaced
+    """
+    cmd = chr(intbytes[0])
+    if cmd in 'HLF':
+        return cmd
+    if cmd == 'S' and len(intbytes) > 2:
+        param = chr(intbytes[1])
+        numindex = DEVICE_CACHED_PARAMS.get(param, DEVICE_UNCACHED_PARAMS.get(param, 1))
+        return tuple(intbytes[:2+numindex])
+    return None
+
+
+def _device_param_key(bytes):
+    """
+    ('G', 'S', 0) -> (71, 83, 0)
+    """
+    return tuple((ord(b) if isinstance(b, str) else b) for b in bytes)
+
+
+def _curve_linear(x):
+    return x
+
+
+def _curve_from_description(desc):
+    """
+    desc: the 'curve' of an analog input, as defined in the input_mapping
+
+        'linear', 'log', 'exp' or 'scurve'
+        [name, shape]     : one of the above, with a shape factor (default
+                            3 for log and exp, 2 for scurve)
+        [[x0, y0], ...]   : breakpoints, both x and y between 0-1
+
+    ==> a function mapping 0-1 to 0-1, or None if desc is not valid
+    """
+    shape = None
+    if isinstance(desc, (list, tuple)) and desc and isinstance(desc[0], basestring):
+        if len(desc) != 2:
+            return None
+        desc, shape = desc
+    if isinstance(desc, basestring):
+        name = desc.lower()
+        if name == 'linear':
+            return _curve_linear
+        try:
+            k = float(shape) if shape is not None else (2. if name == 'scurve' else 3.)
+        except (TypeError, ValueError):
+            return None
+        if k <= 0:
+            return None
+        if name == 'exp':
+            scale = math.expm1(k)
+            return lambda x: math.expm1(k*x) / scale
+        elif name == 'log':
+            # the inverse of exp
+            scale = math.expm1(k)
+            return lambda x: math.log1p(scale*x) / k
+        elif name == 'scurve':
+            def scurve(x):
+                if x <= 0:
+                    return 0
+                elif x >= 1:
+                    return 1
+                a = x ** k
+                return a / (a + (1 - x) ** k)
+            return scurve
+        return None
+    try:
+        points = sorted((float(x), float(y)) for x, y in desc)
+    except (TypeError, ValueError):
+        return None
+    if len(points) < 2:
+        return None
+    xs = [x for x, y in points]
+    ys = [y for x, y in points]
+
+    def breakpoints(x):
+        i = bisect.bisect_right(xs, x)
+        if i == 0:
+            return ys[0]
+        elif i == len(xs):
+            return ys[-1]
+        x0, x1, y0, y1 = xs[i-1], xs[i], ys[i-1], ys[i]
+        return y0 + (y1 - y0) * (x - x0) / (x1 - x0)
+    return breakpoints
+
+
+def _analog_lut_fill(lut, curve, minvalue, maxvalue, autorange):
+    """
+    fill lut in place, so that lut[raw] is the normalized value (0-1)
+    of raw with curve applied.
+
+    In autorange mode, the pin is not active (-1) until the range
+    is bigger than AUTORANGE_MIN_SPAN steps
+    """
+    size = len(lut)
+    span = maxvalue - minvalue
+    if span <= 0 or (autorange and span <= AUTORANGE_MIN_SPAN):
+        lut[:] = [(-1 if autorange else 0)] * size
+        return
+
+    def clip(y):
+        return 0 if y < 0 else (1 if y > 1 else y)
+    start = min(max(minvalue, 0), size)
+    stop = min(maxvalue + 1, size)
+    values = [clip(curve(0))] * start
+    values.extend([clip(curve((raw - minvalue) / span)) for raw in xrange(start, stop)])
+    values.extend([clip(curve(1))] * (size - len(values)))
+    lut[:] = values
+
+
 def int14tobytes(int14):
     """encode int16 into two bytes"""
     b1 = int14 >> 7
@@ -1754,6 +3095,27 @@ def bytes_to_int14(b1, b2):
     return (b1 << 7) + b2
 
 
+def _valid_nrpn(param):
+    """
+    an NRPN parameter number is sent as two 7-bit bytes
+    """
+    return isinstance(param, (int, long)) and 0 <= param <= 16383
+
+
+def _wakeup_pipe():
+    """
+    ==> (read fd, write fd) of a non-blocking pipe, or None if the serial
+        port can't be waited on together with it (windows)
+    """
+    if os.name != 'posix':
+        return None
+    import fcntl
+    fds = os.pipe()
+    for fd in fds:
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    return fds
+
+
 def _get_ip():
     import socket
     return socket.gethostbyname(socket.gethostname())
@@ -1771,6 +3133,31 @@ def _oscmeta_get_addr(args, src):
     return addr
 
 
+def _data_filter_keys(kind, pin):
+    """
+    ==> (label, path) of the given input, matched by the data filters (see /registerdata)
+    """
+    return "%s%d" % (kind, pin + 1), "/data/%s" % kind
+
+
+def _split_data_filters(args):
+    """
+    separate the filters given to /registerdata (labels like A1 or D*,
+    or paths like /data/D) from the address arguments
+
+    ==> (addressargs, filters)
+    """
+    addrargs, filters = [], []
+    for arg in args:
+        if isinstance(arg, basestring) and (arg.startswith('/') or _data_filter_label.match(arg)):
+            filters.append(arg)
+        else:
+            addrargs.append(arg)
+    return addrargs, filters
+
+_data_filter_label = re.compile(r'^[AD][0-9*?\[\]-]*$')
+
+
 def _filtertype_as_string(filtertype):
     out = {
         0: 'LOWPASS',
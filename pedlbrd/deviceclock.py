@@ -0,0 +1,115 @@
+from __future__ import division as _division, absolute_import as _absolute_import
+
+# stdlib
+import time
+
+
+class DeviceClock(object):
+    """
+    Maps the timestamps of the device (T frames, a millisecond counter
+    wrapping at `wrap`) to host time.
+
+    The transport (USB, scheduling of the host) only ever adds delay, so
+    the offset between both clocks is estimated from the frames which
+    arrive fastest: the offset follows a lower arrival at once and
+    rises at most `max_drift` seconds per second, which absorbs the drift
+    between both clocks without following the jitter. The drift itself
+    is estimated from the minimum offset of consecutive windows of
+    `window` seconds and applied between timestamps.
+
+    clock = DeviceClock()
+    hosttime = clock.update(device_ms, time.time())
+
+    frame_time: the host time of the last timestamp received
+    """
+    def __init__(self, wrap=1 << 21, max_drift=0.0005, window=10, maxjump=1.0):
+        self.wrap = wrap
+        self.max_drift = max_drift
+        self.window = window
+        self.maxjump = maxjump
+        self.reset()
+
+    def reset(self):
+        """
+        forget the mapping (the device was reconnected or restarted)
+        """
+        self.active = False
+        self.frame_time = 0
+        self.offset = None
+        # drift of the device clock, in seconds per second
+        self.drift = 0
+        self.resyncs = 0
+        self._lastraw = None
+        self._devicetime = self._lastdevicetime = 0
+        self._window_start = 0
+        self._window_min = None
+        self._prev_min = None
+
+    def time(self):
+        """
+        ==> the host time at which the device read the current frame,
+            or the current time if the device does not send timestamps
+        """
+        return self.frame_time if self.active else time.time()
+
+    def update(self, raw, hosttime):
+        """
+        raw: the timestamp of the device, in ms
+        hosttime: the time the timestamp was received
+
+        ==> the host time corresponding to raw
+        """
+        lastraw = self._lastraw
+        if lastraw is None:
+            self._devicetime = devicetime = 0
+        else:
+            # the counter only goes forward, wrapping around
+            self._devicetime = devicetime = self._devicetime + ((raw - lastraw) % self.wrap) / 1000
+        self._lastraw = raw
+        sample = hosttime - devicetime
+        offset = self.offset
+        if offset is None:
+            self._sync(devicetime)
+            offset = sample
+        else:
+            elapsed = devicetime - self._lastdevicetime
+            predicted = offset + self.drift * elapsed
+            if abs(sample - predicted) > self.maxjump:
+                # the device was restarted, or stopped sending for too long
+                self.resyncs += 1
+                self._sync(devicetime)
+                offset = sample
+            elif sample < predicted:
+                offset = sample
+            else:
+                offset = predicted + min(sample - predicted, self.max_drift * elapsed)
+            self._track_drift(sample, devicetime)
+        self.offset = offset
+        self._lastdevicetime = devicetime
+        self.frame_time = frametime = devicetime + offset
+        self.active = True
+        return frametime
+
+    def _sync(self, devicetime):
+        self._window_start = devicetime
+        self._window_min = None
+        self._prev_min = None
+
+    def _track_drift(self, sample, devicetime):
+        """
+        the minimum offset of each window is a good estimate of the
+        real offset at that time, the drift is the slope between them
+        """
+        window_min = self._window_min
+        if window_min is None or sample < window_min[0]:
+            self._window_min = window_min = (sample, devicetime)
+        if devicetime - self._window_start < self.window:
+            return
+        prev = self._prev_min
+        if prev is not None and window_min[1] > prev[1]:
+            drift = (window_min[0] - prev[0]) / (window_min[1] - prev[1])
+            # smoothed, a single window can be disturbed by a busy host
+            self.drift = min(max(self.drift * 0.75 + drift * 0.25, -self.max_drift), self.max_drift)
+        self._prev_min = window_min
+        self._window_min = None
+        self._window_start = devicetime
@@ -56,6 +56,40 @@ def config_load():
     return out, configfile
 
 
+def calibrationpath():
+    """
+    return the path of the file with the ranges learned by the
+    analog inputs of each device (a .json file)
+    """
+    return os.path.join(basepath(), "calibration.json")
+
+
+def calibration_load():
+    """
+    returns the calibration saved, as a dictionary, or None if
+    there is none or it can't be read
+    """
+    path = calibrationpath()
+    if not os.path.exists(path):
+        return None
+    try:
+        out = json.load(open(path))
+    except ValueError:
+        return None
+    return out if isinstance(out, dict) else None
+
+
+def calibration_save(calibration):
+    """
+    the file is replaced at once, so that it is never left half written
+    """
+    path = calibrationpath()
+    tmppath = path + ".tmp"
+    with open(tmppath, 'w') as f:
+        json.dump(calibration, f)
+    os.rename(tmppath, path)
+
+
 def possible_ports():
     """
     return a list of possible serial ports to look for an arduino device
@@ -0,0 +1,101 @@
+"""
+The packed frames of protocol 2 (see firmware.ino)
+
+    a(nalog)  : 128 + 97, mask, then ValueHI ValueLO for each pin in the mask
+    d(igital) : 128 + 100, changed mask, state mask
+
+Masks have 7 bits per byte, bit i of byte j is the pin of index 7*j + i.
+The header is read by the mainloop, the read functions here read the
+rest of the frame. The encode functions do what the device does, for
+testing
+"""
+
+from __future__ import division as _division, absolute_import as _absolute_import
+
+# the bits set in each 7-bit mask
+_MASK_BITS = [tuple(bit for bit in range(7) if mask & (1 << bit)) for mask in range(128)]
+
+ANALOG2 = 97
+DIGITAL2 = 100
+
+
+def mask_bytes(numpins):
+    return (numpins + 6) // 7
+
+
+def _read_mask(read, maskbytes):
+    """
+    ==> the mask as a list of ints, or None if it timed out or a byte
+        is not a data byte (the frame was cut by the next one)
+    """
+    mask = read(maskbytes)
+    if len(mask) != maskbytes:
+        return None
+    mask = map(ord, mask)
+    if any(byte > 127 for byte in mask):
+        return None
+    return mask
+
+
+def read_analog2(read, maskbytes):
+    """
+    read: a function reading n bytes, returning less if it timed out (serial.read)
+    maskbytes: the number of bytes of the mask (see mask_bytes)
+
+    ==> a list of (pin, value), or None if the frame is incomplete
+    """
+    mask = _read_mask(read, maskbytes)
+    if mask is None:
+        return None
+    pins = [7*i + bit for i, byte in enumerate(mask) for bit in _MASK_BITS[byte]]
+    numbytes = 2 * len(pins)
+    data = read(numbytes)
+    if len(data) != numbytes:
+        return None
+    data = map(ord, data)
+    return [(pin, data[2*i]*128 + data[2*i+1]) for i, pin in enumerate(pins)]
+
+
+def read_digital2(read, maskbytes):
+    """
+    ==> a list of (pin, state) of the pins which changed, or None if
+        the frame is incomplete
+    """
+    masks = _read_mask(read, 2 * maskbytes)
+    if masks is None:
+        return None
+    changed, states = masks[:maskbytes], masks[maskbytes:]
+    return [(7*i + bit, (states[i] >> bit) & 1)
+            for i, byte in enumerate(changed) for bit in _MASK_BITS[byte]]
+
+
+def encode_analog2(values, numpins):
+    """
+    values: {pin index: value (0-16383)} of the pins which changed
+
+    ==> the frame, as sent by the device
+    """
+    mask = [0] * mask_bytes(numpins)
+    for pin in values:
+        mask[pin // 7] |= 1 << (pin % 7)
+    out = [128 + ANALOG2] + mask
+    for pin in sorted(values):
+        out += [values[pin] >> 7, values[pin] & 127]
+    return ''.join(map(chr, out))
+
+
+def encode_digital2(states, changed, numpins):
+    """
+    states: the state (0/1) of every pin, by index
+    changed: the indices of the pins which changed
+
+    ==> the frame, as sent by the device
+    """
+    maskbytes = mask_bytes(numpins)
+    changedmask, statemask = [0] * maskbytes, [0] * maskbytes
+    for pin in changed:
+        changedmask[pin // 7] |= 1 << (pin % 7)
+    for pin, state in enumerate(states):
+        if state:
+            statemask[pin // 7] |= 1 << (pin % 7)
+    return ''.join(map(chr, [128 + DIGITAL2] + changedmask + statemask))
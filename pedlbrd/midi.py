@@ -0,0 +1,366 @@
+from __future__ import division as _division, absolute_import as _absolute_import
+
+# stdlib
+import sys
+import time
+import fnmatch
+import itertools
+import threading
+import logging
+from collections import OrderedDict, deque
+
+logger = logging.getLogger('pedlbrd-debug')
+
+
+class MidiWriter(object):
+    """
+    Collects the MIDI messages generated while reading from the device
+    and sends them together.
+
+    * send: CC messages coalesce per (status, cc) within the window,
+            only the latest value is sent
+    * send_ordered: messages which should never be merged (note that
+            they are still sent together with the rest)
+    * send_pair: a MSB/LSB pair (14-bit CC). The LSB is always sent
+            after the MSB, since a new MSB resets the LSB
+
+    If window is 0, messages are sent as they come
+    """
+    def __init__(self, midiout, window=0):
+        self.midiout = midiout
+        self.window = window
+        self.deadline = 0
+        # a dict (status, cc) -> msg. it is cleared in place, so it
+        # can be cached by the caller to check for pending messages
+        self.pending = OrderedDict()
+        self._counter = itertools.count()
+        # some backends (rtmidi2) can send a list of messages of the same
+        # type in one call, which lets the backend use running status
+        self._send_messages = getattr(midiout, 'send_messages', None)
+        if window > 0:
+            self.send = self._send_coalesced
+            self.send_ordered = self._send_later
+            self.send_pair = self._send_pair_coalesced
+        else:
+            self.send = self.send_ordered = midiout.send_message
+            self.send_pair = self._send_pair_now
+
+    def _send_coalesced(self, msg):
+        pending = self.pending
+        if not pending:
+            self.deadline = time.time() + self.window
+        pending[(msg[0], msg[1])] = msg
+
+    def _send_later(self, msg):
+        pending = self.pending
+        if not pending:
+            self.deadline = time.time() + self.window
+        pending[next(self._counter)] = msg
+
+    def _send_pair_coalesced(self, msb, lsb):
+        pending = self.pending
+        if not pending:
+            self.deadline = time.time() + self.window
+        pending.pop((lsb[0], lsb[1]), None)
+        pending[(msb[0], msb[1])] = msb
+        pending[(lsb[0], lsb[1])] = lsb
+
+    def _send_pair_now(self, msb, lsb):
+        send = self.midiout.send_message
+        send(msb)
+        send(lsb)
+
+    def flush(self):
+        """
+        send all pending messages, grouped by status byte
+        (the order within a channel is kept)
+        """
+        pending = self.pending
+        if not pending:
+            return
+        msgs = pending.values()
+        pending.clear()
+        msgs.sort(key=lambda msg: msg[0])
+        send_messages = self._send_messages
+        if send_messages is None or len(msgs) == 1:
+            send = self.midiout.send_message
+            for msg in msgs:
+                send(msg)
+            return
+        for status, group in itertools.groupby(msgs, key=lambda msg: msg[0]):
+            group = list(group)
+            send_messages(status & 0xF0, [status & 0x0F] * len(group),
+                          [msg[1] for msg in group], [msg[2] for msg in group])
+
+
+class MidiOutputs(object):
+    """
+    Sends each message to a group of MIDI outputs
+    (the virtual port and the midithrough ports)
+
+    The group is replaced, not modified, when an output is added or
+    removed, so it can be changed from another thread while sending
+    """
+    def __init__(self, *outputs):
+        self.outputs = tuple(outputs)
+
+    def add(self, output):
+        self.outputs = self.outputs + (output,)
+
+    def remove(self, output):
+        self.outputs = tuple(out for out in self.outputs if out is not output)
+
+    def send_message(self, msg):
+        for output in self.outputs:
+            output.send_message(msg)
+
+    def send_messages(self, messagetype, channels, values1, values2):
+        for output in self.outputs:
+            send_messages = getattr(output, 'send_messages', None)
+            if send_messages is not None:
+                send_messages(messagetype, channels, values1, values2)
+            else:
+                for channel, value1, value2 in zip(channels, values1, values2):
+                    output.send_message((messagetype + channel, value1, value2))
+
+
+class QueuedMidiOutput(object):
+    """
+    A midiout which sends from its own thread, through a bounded queue.
+
+    If the destination is slow or gone, the oldest messages are dropped
+    (and counted) instead of blocking the caller. After an error the
+    output is marked as broken and drops everything until it is replaced
+
+    The counters are changed from the caller and from the sending thread,
+    always under the lock
+    """
+    def __init__(self, midiout, name, maxsize=256):
+        self.midiout = midiout
+        self.name = name
+        self.dropped = 0
+        self.errors = 0
+        self.broken = False
+        self._lock = threading.Lock()
+        self._queue = deque(maxlen=maxsize)
+        self._wakeup = threading.Event()
+        self._running = True
+        self._thread = th = threading.Thread(target=self._run)
+        th.daemon = True
+        th.start()
+
+    def send_message(self, msg):
+        queue = self._queue
+        if self.broken:
+            with self._lock:
+                self.dropped += 1
+            return
+        if len(queue) == queue.maxlen:
+            # the deque discards the oldest message
+            with self._lock:
+                self.dropped += 1
+        queue.append(msg)
+        self._wakeup.set()
+
+    def close(self):
+        self._running = False
+        self._wakeup.set()
+        if threading.current_thread() is not self._thread:
+            self._thread.join(1)
+        self.midiout.close_port()
+
+    def _run(self):
+        queue = self._queue
+        wakeup = self._wakeup
+        send = self.midiout.send_message
+        while self._running:
+            # without timeout, wait does not poll
+            wakeup.wait()
+            wakeup.clear()
+            while queue:
+                msg = queue.popleft()
+                try:
+                    send(msg)
+                except Exception:
+                    with self._lock:
+                        self.errors += 1
+                        self.broken = True
+                        self.dropped += len(queue)
+                        queue.clear()
+                    logger.error("midiport %s failed, dropping its messages: %s" % (
+                        self.name, str(sys.exc_info()[1])))
+                    break
+
+
+class MidiPortManager(object):
+    """
+    Keeps a cached list of the MIDI output ports present in the system,
+    and opens the midithrough ports, each on its own handle, so that
+    they can be opened and closed independently. Each midithrough port
+    sends from its own queue (see QueuedMidiOutput), so that a slow or
+    vanished port does not block the rest. Broken ports are reopened.
+
+    Changes in the ports are detected in a background thread, via the
+    announce port of the ALSA sequencer if available (pyalsa), or by
+    polling otherwise.
+
+    newmidiout : a function returning a new, unopened midiout (rtmidi.MidiOut)
+    outputs    : the MidiOutputs where the opened ports are added
+    callback   : called as callback(ports) when the ports change
+    """
+    def __init__(self, newmidiout, outputs, callback=None, poll_period=3, queuesize=256):
+        self._newmidiout = newmidiout
+        self.queuesize = queuesize
+        self._probe = newmidiout()
+        self.outputs = outputs
+        self.callback = callback
+        self.poll_period = poll_period
+        self.ports = tuple(self._probe.ports)
+        # the wildcards or port names which should be opened, if present.
+        # It is replaced, not modified, when the wanted ports change
+        self.through = frozenset()
+        self._opened = {}
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+
+    @property
+    def opened(self):
+        return self._opened.keys()
+
+    def stats(self):
+        """
+        ==> a list of (portname, dropped, errors, broken) for each open port
+        """
+        return [(name, out.dropped, out.errors, out.broken)
+                for name, out in self._opened.items()]
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = th = threading.Thread(target=self._run)
+        th.daemon = True
+        th.start()
+
+    def stop(self):
+        self._running = False
+        with self._lock:
+            for portname in self._opened.keys():
+                self._close(portname)
+
+    def refresh(self):
+        """
+        enumerate the ports. If they changed, sync the midithrough ports
+        and call the callback
+
+        ==> True if the ports changed
+        """
+        ports = tuple(self._probe.ports)
+        if ports == self.ports:
+            return False
+        self.ports = ports
+        logger.debug("midioutports changed: %s" % str(ports))
+        self.sync()
+        if self.callback is not None:
+            self.callback(ports)
+        return True
+
+    def match(self, wildcard_or_index):
+        """
+        ==> a list of the port names matching wildcard_or_index
+        """
+        ports = self.ports
+        if isinstance(wildcard_or_index, int):
+            if 0 <= wildcard_or_index < len(ports):
+                return [ports[wildcard_or_index]]
+            return []
+        return [port for port in ports if fnmatch.fnmatch(port, wildcard_or_index)]
+
+    def sync(self):
+        """
+        open the midithrough ports which are present and not open yet,
+        close the ones which are gone or not wanted anymore
+        """
+        with self._lock:
+            wanted = set()
+            for wildcard in self.through:
+                wanted.update(self.match(wildcard))
+            for portname, output in self._opened.items():
+                if portname not in wanted or output.broken:
+                    self._close(portname)
+            for portname in wanted:
+                if portname not in self._opened:
+                    self._open(portname)
+
+    def _open(self, portname):
+        midiout = self._newmidiout()
+        try:
+            midiout.open_port(self.ports.index(portname))
+        except Exception:
+            logger.error("could not open midiport %s: %s" % (portname, str(sys.exc_info()[1])))
+            return
+        output = QueuedMidiOutput(midiout, portname, maxsize=self.queuesize)
+        self._opened[portname] = output
+        self.outputs.add(output)
+        logger.debug("midithrough: opened %s" % portname)
+
+    def _close(self, portname):
+        output = self._opened.pop(portname)
+        self.outputs.remove(output)
+        try:
+            output.close()
+        except Exception:
+            logger.error("could not close midiport %s: %s" % (portname, str(sys.exc_info()[1])))
+        logger.debug("midithrough: closed %s" % portname)
+
+    def _run(self):
+        wait = _alsa_announce_waiter() if sys.platform.startswith('linux') else None
+        while self._running:
+            if any(output.broken for output in self._opened.values()):
+                self.sync()
+            if wait is not None:
+                try:
+                    if not wait(self.poll_period):
+                        continue
+                except Exception:
+                    logger.error("ALSA announce failed, polling midiports instead")
+                    wait = None
+                    continue
+            else:
+                time.sleep(self.poll_period)
+            try:
+                self.refresh()
+            except Exception:
+                logger.error("error checking midiports: %s" % str(sys.exc_info()[1]))
+
+
+def _alsa_announce_waiter():
+    """
+    returns a function wait(timeout) which blocks until the ALSA
+    sequencer announces a change in its clients or ports (True) or
+    the timeout is reached (False).
+
+    Returns None if this is not possible (pyalsa not present, no ALSA)
+    """
+    try:
+        from pyalsa import alsaseq
+    except ImportError:
+        return None
+    try:
+        seq = alsaseq.Sequencer(clientname='pedlbrd-portwatch',
+                                streams=alsaseq.SEQ_OPEN_INPUT,
+                                mode=alsaseq.SEQ_BLOCK)
+        port = seq.create_simple_port(
+            'announce', alsaseq.SEQ_PORT_TYPE_APPLICATION,
+            alsaseq.SEQ_PORT_CAP_WRITE | alsaseq.SEQ_PORT_CAP_SUBS_WRITE)
+        # 0:1 is System:Announce
+        seq.connect_ports((0, 1), (seq.client_id, port))
+    except Exception:
+        logger.debug("could not subscribe to the ALSA announce port: %s" % str(sys.exc_info()[1]))
+        return None
+
+    def wait(timeout):
+        events = seq.receive_events(timeout=int(timeout * 1000), maxevents=64)
+        return bool(events)
+    return wait
@@ -0,0 +1,773 @@
+from __future__ import division as _division, absolute_import as _absolute_import
+
+# stdlib
+import re
+import sys
+import struct
+import time
+import socket
+import select
+import errno
+import fnmatch
+import threading
+import logging
+from collections import deque
+
+logger = logging.getLogger('pedlbrd-debug')
+
+"""
+OSC output
+
+The core encodes each message once and sends the same packet to all
+destinations through one non-blocking UDP socket. liblo is still
+used to receive (see core.Pedlbrd._create_oscserver)
+"""
+
+_pack_i = struct.Struct('>i').pack
+_pack_f = struct.Struct('>f').pack
+_pack_d = struct.Struct('>d').pack
+_pack_h = struct.Struct('>q').pack
+_unpack_i = struct.Struct('>i').unpack_from
+_unpack_f = struct.Struct('>f').unpack_from
+_unpack_d = struct.Struct('>d').unpack_from
+_unpack_h = struct.Struct('>q').unpack_from
+
+# below this, a sendto per destination is cheaper than a sendmmsg via ctypes
+_MMSG_MIN_DESTINATIONS = 3
+
+
+def oscstring(s):
+    """encode s as an OSC-string (null terminated, padded to 4 bytes)"""
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    return s + '\0' * (4 - (len(s) % 4))
+
+
+def oscblob(b):
+    size = len(b)
+    return _pack_i(size) + b + '\0' * ((4 - (size % 4)) % 4)
+
+
+def encode_args(args):
+    """
+    args: a seq of values. As in liblo, a value can be given as a
+          tuple (typetag, value) to force a type
+
+    ==> (typetags, data)
+    """
+    tags = [',']
+    data = []
+    for arg in args:
+        if isinstance(arg, tuple):
+            tag, arg = arg
+        elif isinstance(arg, bool):
+            tag = 'T' if arg else 'F'
+        elif isinstance(arg, (int, long)):
+            tag = 'i' if -2147483648 <= arg <= 2147483647 else 'h'
+        elif isinstance(arg, float):
+            tag = 'f'
+        elif isinstance(arg, basestring):
+            tag = 's'
+        elif arg is None:
+            tag = 'N'
+        else:
+            raise TypeError("can't encode %s as OSC" % str(type(arg)))
+        tags.append(tag)
+        if tag == 'i':
+            data.append(_pack_i(arg))
+        elif tag == 'f':
+            data.append(_pack_f(arg))
+        elif tag == 'd':
+            data.append(_pack_d(arg))
+        elif tag == 'h':
+            data.append(_pack_h(arg))
+        elif tag == 's' or tag == 'S':
+            data.append(oscstring(arg))
+        elif tag == 'b':
+            data.append(oscblob(arg))
+        elif tag not in 'TFNI':
+            raise ValueError("OSC typetag not supported: %s" % tag)
+    return ''.join(tags), ''.join(data)
+
+
+def encode_message(path, *args):
+    """
+    ==> the OSC packet (a str)
+    """
+    tags, data = encode_args(args)
+    return oscstring(path) + oscstring(tags) + data
+
+
+def message_prefix(path, typetags, *args):
+    """
+    Encode the first part of a message, the rest of the arguments
+    (as declared in typetags) should be appended already packed.
+
+    message_prefix('/data/A', ',ifi', 3) + struct.pack('>fi', 0.5, 512)
+    is the same as encode_message('/data/A', 3, ('f', 0.5), ('i', 512))
+    """
+    _, data = encode_args(args)
+    return oscstring(path) + oscstring(typetags) + data
+
+
+# seconds between 1900 (the epoch of OSC timetags) and 1970
+_NTP_DELTA = 2208988800
+_pack_timetag = struct.Struct('>II').pack
+_BUNDLE_HEADER = oscstring('#bundle')
+
+
+def encode_bundle(timestamp, *packets):
+    """
+    timestamp: the time (as returned by time.time()) at which the
+               receiver should act on the packets. None: immediately
+    packets: encoded messages or bundles
+    """
+    if timestamp is None:
+        timetag = _pack_timetag(0, 1)
+    else:
+        timestamp += _NTP_DELTA
+        seconds = int(timestamp)
+        timetag = _pack_timetag(seconds, int((timestamp - seconds) * 4294967296))
+    parts = [_BUNDLE_HEADER, timetag]
+    for packet in packets:
+        parts.append(_pack_i(len(packet)))
+        parts.append(packet)
+    return ''.join(parts)
+
+
+def _decode_string(packet, pos):
+    end = packet.index('\0', pos)
+    return packet[pos:end], end + 4 - ((end - pos) % 4)
+
+
+def decode_message(packet):
+    """
+    ==> (path, typetags, args). typetags does not include the leading ','
+    """
+    path, pos = _decode_string(packet, 0)
+    if pos >= len(packet):
+        return path, '', []
+    tags, pos = _decode_string(packet, pos)
+    tags = tags[1:]
+    args = []
+    for tag in tags:
+        if tag == 'i':
+            args.append(_unpack_i(packet, pos)[0])
+            pos += 4
+        elif tag == 'f':
+            args.append(_unpack_f(packet, pos)[0])
+            pos += 4
+        elif tag == 'd':
+            args.append(_unpack_d(packet, pos)[0])
+            pos += 8
+        elif tag == 'h':
+            args.append(_unpack_h(packet, pos)[0])
+            pos += 8
+        elif tag == 's' or tag == 'S':
+            s, pos = _decode_string(packet, pos)
+            args.append(s)
+        elif tag == 'b':
+            size = _unpack_i(packet, pos)[0]
+            args.append(packet[pos+4:pos+4+size])
+            pos += 4 + size + (4 - size % 4) % 4
+        elif tag == 'T':
+            args.append(True)
+        elif tag == 'F':
+            args.append(False)
+        elif tag == 'N':
+            args.append(None)
+        elif tag == 'I':
+            args.append(float('inf'))
+        else:
+            raise ValueError("OSC typetag not supported: %s" % tag)
+    return path, tags, args
+
+
+def decode_packet(packet):
+    """
+    decode a message or a bundle (the timetag is ignored)
+
+    ==> a list of (path, typetags, args)
+    """
+    if not packet.startswith('#bundle'):
+        return [decode_message(packet)]
+    out = []
+    pos = 16
+    while pos < len(packet):
+        size = _unpack_i(packet, pos)[0]
+        out.extend(decode_packet(packet[pos+4:pos+4+size]))
+        pos += 4 + size
+    return out
+
+
+# SLIP (RFC 1055), double END framing as in OSC 1.1
+_SLIP_END, _SLIP_ESC, _SLIP_ESC_END, _SLIP_ESC_ESC = '\xc0', '\xdb', '\xdc', '\xdd'
+_slip_unescape_re = re.compile('\xdb([\xdc\xdd])')
+
+
+def slip_encode(packet):
+    packet = packet.replace(_SLIP_ESC, _SLIP_ESC + _SLIP_ESC_ESC).replace(_SLIP_END, _SLIP_ESC + _SLIP_ESC_END)
+    return _SLIP_END + packet + _SLIP_END
+
+
+def slip_decode(data):
+    """
+    data: the bytes read so far
+
+    ==> (a list of the complete packets, the remaining bytes)
+    """
+    frames = data.split(_SLIP_END)
+    rest = frames.pop()
+    packets = [_slip_unescape_re.sub(lambda m: _SLIP_END if m.group(1) == _SLIP_ESC_END else _SLIP_ESC, frame)
+               for frame in frames if frame]
+    return packets, rest
+
+
+def resolve_address(addr):
+    """
+    addr: (host, port) or a liblo.Address
+
+    ==> a sockaddr tuple (ip, port), or None if it could not be resolved
+    """
+    if hasattr(addr, 'hostname'):
+        host, port = addr.hostname, addr.port
+    else:
+        host, port = addr
+    try:
+        return socket.getaddrinfo(host, int(port), socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+    except (socket.error, ValueError):
+        logger.error("could not resolve OSC address %s:%s" % (str(host), str(port)))
+        return None
+
+
+class OSCSender(object):
+    """
+    Owns the non-blocking UDP socket used to send OSC.
+    Destinations are organized in groups (see OSCDestinations)
+    """
+    def __init__(self):
+        self.sock = sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(0)
+
+    def group(self, addresses=()):
+        """
+        ==> a new OSCDestinations sending through this socket
+        """
+        return OSCDestinations(self.sock, addresses)
+
+    def sendto(self, addr, path, *args):
+        """
+        send a message to a single address
+        """
+        sockaddr = resolve_address(addr)
+        if sockaddr is not None:
+            try:
+                self.sock.sendto(encode_message(path, *args), sockaddr)
+            except socket.error:
+                logger.debug("could not send OSC to %s: %s" % (str(sockaddr), str(sys.exc_info()[1])))
+
+    def set_multicast_ttl(self, ttl):
+        """
+        the number of hops for multicast packets (1: only the local network)
+        """
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+
+    def close(self):
+        self.sock.close()
+
+
+class OSCDestinations(object):
+    """
+    A group of destinations, resolved once when the addresses change.
+    Each packet is sent to all of them with one call to sendmmsg
+    (linux), or with one sendto per destination otherwise.
+
+    The group is updated in place (set_addresses), so it can be cached
+    by the functions sending to it
+    """
+    def __init__(self, sock, addresses=()):
+        self.sock = sock
+        self.dropped = 0
+        self.sockaddrs = ()
+        # functions called with each packet, for outputs other than UDP
+        self.sinks = ()
+        self._batch = None
+        self.set_addresses(addresses)
+
+    def add_sink(self, sink):
+        self.sinks = self.sinks + (sink,)
+
+    def remove_sink(self, sink):
+        self.sinks = tuple(s for s in self.sinks if s != sink)
+
+    def set_addresses(self, addresses):
+        sockaddrs = [resolve_address(addr) for addr in addresses]
+        sockaddrs = tuple(addr for addr in sockaddrs if addr is not None)
+        batch = _MMsgBatch(self.sock, sockaddrs) if len(sockaddrs) >= _MMSG_MIN_DESTINATIONS and _MMsgBatch.available else None
+        # swap both at once, this can be called from another thread
+        self._batch, self.sockaddrs = batch, sockaddrs
+
+    def __len__(self):
+        return len(self.sockaddrs)
+
+    def send_packet(self, packet):
+        for sink in self.sinks:
+            sink(packet)
+        batch, sockaddrs = self._batch, self.sockaddrs
+        if batch is not None:
+            sent = batch.send(packet)
+            if sent == len(sockaddrs):
+                return
+            # sendmmsg stops at the first message it could not send,
+            # that one and the rest are sent one by one
+            sockaddrs = sockaddrs[max(sent, 0):]
+        sendto = self.sock.sendto
+        for sockaddr in sockaddrs:
+            try:
+                sendto(packet, sockaddr)
+            except socket.error as e:
+                # EAGAIN: the socket buffer is full, ECONNREFUSED: nobody listening
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNREFUSED):
+                    logger.debug("OSC sendto %s failed: %s" % (str(sockaddr), str(e)))
+                self.dropped += 1
+
+    def send(self, path, *args):
+        if self.sockaddrs or self.sinks:
+            self.send_packet(encode_message(path, *args))
+
+
+class OSCLeases(object):
+    """
+    The leases of the addresses registered to receive OSC. An address
+    keeps its lease by renewing it (registering again, sending /ping or
+    answering /ping with /pingback) within ttl seconds
+
+        expired, stale = leases.check(addresses, ttl)
+
+    The expired addresses should be removed, the stale ones (half way
+    to expire) pinged
+    """
+    def __init__(self):
+        self.expired = 0
+        self._leases = {}
+
+    def __len__(self):
+        return len(self._leases)
+
+    def renew(self, addr, now=None):
+        self._leases[tuple(addr)] = now if now is not None else time.time()
+
+    def remove(self, addr):
+        self._leases.pop(tuple(addr), None)
+
+    def check(self, addresses, ttl, now=None):
+        """
+        addresses: the registered addresses which can expire, as (host, port).
+                   Addresses without a lease get one from now on, leases of
+                   addresses not given are forgotten
+
+        ==> (expired, stale), lists of addresses
+        """
+        if now is None:
+            now = time.time()
+        leases = self._leases
+        expired, stale = [], []
+        for addr in addresses:
+            age = now - leases.setdefault(addr, now)
+            if age > ttl:
+                expired.append(addr)
+            elif age > ttl / 2:
+                stale.append(addr)
+        for addr in leases.keys():
+            if addr not in addresses or addr in expired:
+                del leases[addr]
+        self.expired += len(expired)
+        return expired, stale
+
+
+class OSCStreamClient(object):
+    """
+    A client connected to the OSCStreamServer. It has a hostname and
+    a port, like a liblo.Address, and replies can be sent to it (send)
+
+    Outgoing packets are dropped (the oldest first) if the client can't
+    keep up. Data and replies/notifications are queued separately, so
+    that a stream of data never pushes out a reply
+    """
+    def __init__(self, server, sock, addr, maxqueue):
+        self.server = server
+        self.sock = sock
+        self.hostname, self.port = addr[:2]
+        self.data = False
+        self.ui = False
+        # the inputs the client wants to receive (see data_accepts)
+        self.data_filters = ()
+        self.dropped = 0
+        self._data_accepted = {}
+        self._dataqueue = deque(maxlen=maxqueue)
+        self._queue = deque(maxlen=maxqueue)
+        self._outbuf = ''
+        self._inbuf = ''
+
+    @property
+    def url(self):
+        return "osc.tcp://%s:%d/" % (self.hostname, self.port)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, path, *args):
+        self.push(self.server.frame(encode_message(path, *args)))
+
+    def push(self, frame, droppable=False):
+        """
+        frame: an already framed packet (see OSCStreamServer.frame)
+        droppable: data, which is dropped before replies and notifications
+        """
+        queue = self._dataqueue if droppable else self._queue
+        if len(queue) == queue.maxlen:
+            # the deque discards the oldest frame
+            self.dropped += 1
+        queue.append(frame)
+        self.server.wakeup()
+
+    def set_data_filters(self, patterns):
+        """
+        patterns: labels (A1, D*) or paths (/data/D), as given to /registerdata.
+                  No patterns: all data is received
+        """
+        self.data_filters = tuple(patterns)
+        self._data_accepted = {}
+
+    def data_accepts(self, label, path):
+        """
+        ==> True if the data of the input (label like A1, path like
+            /data/A) passes the filters of the client
+        """
+        accepted = self._data_accepted.get(label)
+        if accepted is None:
+            filters = self.data_filters
+            accepted = self._data_accepted[label] = not filters or any(
+                fnmatch.fnmatch(label, patt) or fnmatch.fnmatch(path, patt) for patt in filters)
+        return accepted
+
+    def pending(self):
+        return bool(self._outbuf or self._queue or self._dataqueue)
+
+    def flush(self):
+        """
+        write as much as possible without blocking
+        """
+        if not self._outbuf:
+            frames = []
+            queue, dataqueue = self._queue, self._dataqueue
+            while queue:
+                frames.append(queue.popleft())
+            while dataqueue and len(frames) < 256:
+                frames.append(dataqueue.popleft())
+            self._outbuf = ''.join(frames)
+        if self._outbuf:
+            n = self.sock.send(self._outbuf)
+            self._outbuf = self._outbuf[n:]
+
+    def read(self):
+        """
+        ==> a list of the packets received, or None if the connection was closed
+        """
+        data = self.sock.recv(4096)
+        if not data:
+            return None
+        packets, self._inbuf = slip_decode(self._inbuf + data)
+        return packets
+
+
+class OSCStreamServer(object):
+    """
+    OSC over TCP, SLIP framed (OSC 1.1), served from its own thread.
+
+    Clients subscribe by sending /registerdata, /registerui, /register
+    or /registerall (without arguments) through the stream, and /signout
+    to stop. Any other message is passed to handler(client, path, typetags, args),
+    which can change the subscription of a client with subscribe (for
+    example /registerdata with filters)
+
+    Data which belongs to an input is sent through data_sink, so that
+    the data filters of each client apply
+
+    Nagle is disabled for all connections
+    """
+    SUBSCRIBE_PATHS = {
+        '/registerdata': (True, None),
+        '/register': (True, None),
+        '/registerui': (None, True),
+        '/registerall': (True, True),
+        '/signout': (False, False)
+    }
+
+    client_class = OSCStreamClient
+    frame = staticmethod(slip_encode)
+    # the timeout of select, _poll is called at least this often
+    poll_period = 1
+
+    def __init__(self, port, handler, maxqueue=1024):
+        self.port = port
+        self.handler = handler
+        self.maxqueue = maxqueue
+        self.clients = ()
+        self._data_clients = ()
+        self._ui_clients = ()
+        self._running = False
+        self._wakeup_pending = False
+        self._listener = None
+        # a udp socket sending to itself is a portable way to wake up select
+        self._wake = wake = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        wake.bind(('127.0.0.1', 0))
+        wake.setblocking(0)
+        self._wake_addr = wake.getsockname()
+
+    def start(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('', self.port))
+        listener.listen(8)
+        listener.setblocking(0)
+        self._listener = listener
+        self._running = True
+        self._thread = th = threading.Thread(target=self._run)
+        th.daemon = True
+        th.start()
+
+    def stop(self):
+        self._running = False
+        self.wakeup()
+        if self._listener is not None and threading.current_thread() is not self._thread:
+            self._thread.join(2)
+
+    def wakeup(self):
+        if not self._wakeup_pending:
+            self._wakeup_pending = True
+            try:
+                self._wake.sendto('x', self._wake_addr)
+            except socket.error:
+                pass
+
+    def send_data(self, packet, label=None, path=None):
+        """
+        label, path: the input the data belongs to (see data_sink).
+                     None: the data is sent to all data clients
+        """
+        clients = self._data_clients
+        if clients:
+            frame = None
+            for client in clients:
+                if label is not None and not client.data_accepts(label, path):
+                    continue
+                if frame is None:
+                    frame = self.frame(packet)
+                client.push(frame, droppable=True)
+
+    def data_sink(self, label, path):
+        """
+        ==> a function sending a data packet of the given input
+            (label like A1, path like /data/A) to the clients whose
+            data filters accept it
+        """
+        send_data = self.send_data
+
+        def sink(packet):
+            send_data(packet, label, path)
+        return sink
+
+    def subscribe(self, client, data=None, ui=None, filters=None):
+        """
+        change the subscription of a client. None leaves it unchanged
+        """
+        if data is not None:
+            client.data = data
+        if ui is not None:
+            client.ui = ui
+        if filters is not None:
+            client.set_data_filters(filters)
+        self._update_subscriptions()
+
+    def send_ui(self, packet):
+        clients = self._ui_clients
+        if clients:
+            frame = self.frame(packet)
+            for client in clients:
+                client.push(frame)
+
+    def _update_subscriptions(self):
+        self._data_clients = tuple(c for c in self.clients if c.data)
+        self._ui_clients = tuple(c for c in self.clients if c.ui)
+
+    def _accept(self):
+        try:
+            sock, addr = self._listener.accept()
+        except socket.error:
+            return
+        sock.setblocking(0)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        client = self.client_class(self, sock, addr, self.maxqueue)
+        self.clients = self.clients + (client,)
+        logger.debug("OSC stream: %s connected" % client.url)
+
+    def _close(self, client):
+        self.clients = tuple(c for c in self.clients if c is not client)
+        self._update_subscriptions()
+        try:
+            client.sock.close()
+        except socket.error:
+            pass
+        logger.debug("OSC stream: %s disconnected" % client.url)
+
+    def _received(self, client, packet):
+        try:
+            messages = decode_packet(packet)
+        except (ValueError, IndexError, struct.error):
+            logger.error("OSC stream: could not decode packet from %s" % client.url)
+            return
+        for path, typetags, args in messages:
+            if self._subscribe(client, path, args):
+                continue
+            try:
+                self.handler(client, path, typetags, args)
+            except Exception:
+                logger.error("OSC stream: error handling %s: %s" % (path, str(sys.exc_info()[1])))
+
+    def _subscribe(self, client, path, args):
+        """
+        ==> True if the message changed the subscriptions of the client
+        """
+        subscribe = self.SUBSCRIBE_PATHS.get(path)
+        if subscribe is None or args:
+            return False
+        data, ui = subscribe
+        # a plain /registerdata receives all the data
+        self.subscribe(client, data, ui, filters=() if data else None)
+        return True
+
+    def _poll(self):
+        pass
+
+    def _run(self):
+        listener, wake = self._listener, self._wake
+        while self._running:
+            clients = self.clients
+            writers = [c for c in clients if c.pending()]
+            try:
+                readable, writable, _ = select.select([listener, wake] + list(clients), writers, [],
+                                                      self.poll_period)
+            except select.error:
+                continue
+            self._poll()
+            for r in readable:
+                if r is listener:
+                    self._accept()
+                elif r is wake:
+                    self._wakeup_pending = False
+                    try:
+                        while True:
+                            wake.recv(64)
+                    except socket.error:
+                        pass
+                else:
+                    try:
+                        packets = r.read()
+                    except socket.error:
+                        packets = None
+                    if packets is None:
+                        self._close(r)
+                        continue
+                    for packet in packets:
+                        self._received(r, packet)
+            for client in writable:
+                try:
+                    client.flush()
+                except socket.error as e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        self._close(client)
+        for client in self.clients:
+            self._close(client)
+        listener.close()
+
+
+class _MMsgBatch(object):
+    """
+    A prebuilt array of mmsghdr, one per destination, all pointing to
+    the same iovec. Sending a packet to all destinations is then one
+    sendmmsg call
+
+    The call releases the GIL and the iovec is shared, so sends from
+    different threads are serialized
+    """
+    available = False
+
+    def __init__(self, sock, sockaddrs):
+        ctypes = _ctypes
+        n = len(sockaddrs)
+        self._fd = sock.fileno()
+        self._n = n
+        self._lock = threading.Lock()
+        self._iov = iov = _iovec()
+        self._names = names = (_sockaddr_in * n)()
+        self._msgs = msgs = (_mmsghdr * n)()
+        for i, (ip, port) in enumerate(sockaddrs):
+            name = names[i]
+            name.sin_family = socket.AF_INET
+            name.sin_port = socket.htons(port)
+            ctypes.memmove(name.sin_addr, socket.inet_aton(ip), 4)
+            hdr = msgs[i].msg_hdr
+            hdr.msg_name = ctypes.cast(ctypes.pointer(name), ctypes.c_void_p)
+            hdr.msg_namelen = ctypes.sizeof(_sockaddr_in)
+            hdr.msg_iov = ctypes.pointer(iov)
+            hdr.msg_iovlen = 1
+
+    def send(self, packet):
+        """
+        ==> the number of messages sent, or -1 if there was an error
+        """
+        iov = self._iov
+        with self._lock:
+            # iov_base is declared as c_char_p: this points to the buffer of packet
+            iov.iov_base = packet
+            iov.iov_len = len(packet)
+            return _sendmmsg(self._fd, self._msgs, self._n, _MSG_DONTWAIT)
+
+
+def _init_sendmmsg():
+    global _ctypes, _sendmmsg, _iovec, _sockaddr_in, _mmsghdr, _MSG_DONTWAIT
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        sendmmsg = libc.sendmmsg
+    except (ImportError, OSError, AttributeError):
+        return False
+
+    class iovec(ctypes.Structure):
+        _fields_ = [('iov_base', ctypes.c_char_p), ('iov_len', ctypes.c_size_t)]
+
+    class sockaddr_in(ctypes.Structure):
+        _fields_ = [('sin_family', ctypes.c_ushort), ('sin_port', ctypes.c_ushort),
+                    ('sin_addr', ctypes.c_ubyte * 4), ('sin_zero', ctypes.c_ubyte * 8)]
+
+    class msghdr(ctypes.Structure):
+        _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                    ('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+                    ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                    ('msg_flags', ctypes.c_int)]
+
+    class mmsghdr(ctypes.Structure):
+        _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    _ctypes, _sendmmsg = ctypes, sendmmsg
+    _iovec, _sockaddr_in, _mmsghdr = iovec, sockaddr_in, mmsghdr
+    _MSG_DONTWAIT = 0x40
+    return True
+
+_MMsgBatch.available = _init_sendmmsg()
@@ -5,9 +5,14 @@ from PyQt4.QtGui import *
 import sys
 import os
 import time
+import socket
 import subprocess
 import liblo
 import logging
+try:
+    from pedlbrd.shm import ShmReader
+except ImportError:
+    ShmReader = None
 
 global qt_app
 
@@ -33,6 +38,19 @@ logger.info("-------------------------- GUI --------------------------")
 # /////////// HELPERS ////////////
 
 
+def _is_local(hostname):
+    """
+    True if hostname is this host
+    """
+    try:
+        ip = socket.gethostbyname(hostname)
+        if ip.startswith('127.'):
+            return True
+        return ip in socket.gethostbyname_ex(socket.gethostname())[2]
+    except socket.error:
+        return False
+
+
 def _func2osc(func):
     def wrap(path, args, types, src):
         func(*args)
@@ -74,7 +92,7 @@ class OSCThread(QThread):
             addr = liblo.Address(pedlbrd_address)
         self.pedlbrd_address = addr
         self.register_osc_methods()
-        self.s.send(self.pedlbrd_address, '/register')
+        # data is registered after asking the core for shared memory (see post_init)
         self.s.send(self.pedlbrd_address, '/registerui')
         self.gui = gui
         self._heartbeat_counter = 0
@@ -107,6 +125,10 @@ class OSCThread(QThread):
     def cmd_status(self, status):
         self.gui.set_status(status)
 
+    def cmd_ping(self, ID):
+        # the core pings registered clients to keep them registered
+        self.s.send(self.pedlbrd_address, '/pingback', ID)
+
     def cmd_changed_midichannel(self, channel):
         self.gui.set_midichannel(channel)
 
@@ -279,6 +301,9 @@ class Pedlbrd(QWidget):
         self._analog_dirty = [False, False, False, False, False, False]
         self._dirty = False
         self._quitting = False
+        self._shm = None
+        # (kind, pin) -> the last record read from the shared memory
+        self._shm_last = {}
 
         # -----------------------------------------------
         self.setup_widgets()
@@ -300,6 +325,8 @@ class Pedlbrd(QWidget):
         self.get_midiports()
 
     def poll_action(self):
+        if self._shm is not None:
+            self.poll_shm()
         if self._dirty:
             for pin in self.anpins:
                 if pin._dirty:
@@ -309,6 +336,35 @@ class Pedlbrd(QWidget):
                     pin.repaint()
             self._dirty = False
 
+    def poll_shm(self):
+        shm = self._shm
+        last = self._shm_last
+        for kind, widgets, numpins in (('A', self.anpins, shm.num_analog), ('D', self.digpins, shm.num_digital)):
+            for pin, widget in enumerate(widgets[:numpins]):
+                record = shm.latest(kind, pin)
+                if record is None or record == last.get((kind, pin)):
+                    continue
+                last[(kind, pin)] = record
+                widget.setValue(record.norm if kind == 'A' else record.raw)
+                # the widgets only get dirty if the change is visible
+                if widget._dirty:
+                    self._dirty = True
+
+    def open_shm(self, path):
+        """
+        read the data from the shared memory of the core, if it has one.
+        Otherwise (or if the core runs in another host, the path is then
+        not ours) register for data via OSC
+        """
+        if path and ShmReader is not None and _is_local(self.osc_thread.pedlbrd_address.hostname):
+            try:
+                self._shm = ShmReader(path)
+                logger.info("reading data from shared memory: %s" % path)
+                return
+            except (IOError, ValueError):
+                logger.error("could not open shared memory %s" % path)
+        self.osc_thread.sendosc('/register')
+
     def set_status(self, status):
         self.conn_status = status.strip()
         self.status.setText(status)
@@ -420,6 +476,7 @@ class Pedlbrd(QWidget):
 
     def post_init(self):
         print("--------------------- post_init")
+        self.osc_thread.get_mainthread('shm', self.open_shm)
         self.get_midiports()
         self.osc_thread.get('status', lambda status: invoke_in_main_thread(self.set_status, status))
         self.osc_thread.get('midithrough', lambda index: self.midithrough_set(index, notifycore=False, updategui=True))
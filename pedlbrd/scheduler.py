@@ -0,0 +1,202 @@
+from __future__ import division as _division, absolute_import as _absolute_import
+
+# stdlib
+import sys
+import time
+import heapq
+import itertools
+import threading
+import logging
+from collections import deque
+
+logger = logging.getLogger('pedlbrd-debug')
+
+
+class Job(object):
+    """
+    A call scheduled in a Scheduler. cancel() removes it
+    """
+    __slots__ = ('deadline', 'period', 'function', 'args', 'kws', 'cancelled')
+
+    def __init__(self, deadline, period, function, args, kws):
+        self.deadline = deadline
+        self.period = period
+        self.function = function
+        self.args = args
+        self.kws = kws
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler(object):
+    """
+    Runs functions at a later time, or regularly, from the thread which
+    calls run (the mainloop), instead of from a timer thread.
+
+    Jobs are kept in a min-heap of deadlines. Jobs without delay go to
+    a fifo, so that they do not need to pass through the heap. Cancelled
+    jobs are discarded when they reach the top.
+
+    Jobs can be added from any thread. The caller checks `deadline`
+    (the time of the next job, 0 if a job is due now) before calling run:
+
+        if now >= scheduler.deadline:
+            scheduler.run(now)
+
+    wakeup: called (from the thread adding the job) when a job is added
+            which is due before the current deadline, to wake a caller
+            waiting until the deadline
+    """
+    def __init__(self, wakeup=None):
+        self.wakeup = wakeup
+        self.deadline = float('inf')
+        self._heap = []
+        self._now = deque()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def call_later(self, delay, function, args=(), kws={}):
+        """
+        ==> a Job
+        """
+        return self._add(Job(time.time() + delay, 0, function, args, kws))
+
+    def call_regularly(self, period, function, args=(), kws={}):
+        """
+        call function every `period` seconds, the first time after one period
+
+        ==> a Job
+        """
+        if period <= 0:
+            raise ValueError("the period must be possitive, got %s" % str(period))
+        return self._add(Job(time.time() + period, period, function, args, kws))
+
+    def _add(self, job):
+        with self._lock:
+            earlier = job.deadline < self.deadline
+            if job.period == 0 and job.deadline <= time.time():
+                self._now.append(job)
+                self.deadline = 0
+            else:
+                heapq.heappush(self._heap, (job.deadline, next(self._counter), job))
+                if earlier:
+                    self.deadline = job.deadline
+        if earlier and self.wakeup is not None:
+            self.wakeup()
+        return job
+
+    def _update_deadline(self):
+        heap = self._heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+        if self._now:
+            self.deadline = 0
+        else:
+            self.deadline = heap[0][0] if heap else float('inf')
+
+    def timeout(self, now=None):
+        """
+        ==> the time until the next job, or None if there are no jobs
+        """
+        deadline = self.deadline
+        if deadline == float('inf'):
+            return None
+        return max(0, deadline - (now or time.time()))
+
+    def run(self, now=None):
+        """
+        run the jobs which are due. Jobs added while running are run
+        in the next call
+        """
+        if now is None:
+            now = time.time()
+        due = []
+        with self._lock:
+            while self._now:
+                due.append(self._now.popleft())
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                job = heapq.heappop(heap)[2]
+                if job.cancelled:
+                    continue
+                due.append(job)
+                if job.period:
+                    # periodic jobs keep their phase, missed periods are skipped
+                    job.deadline += job.period * ((now - job.deadline) // job.period + 1)
+                    heapq.heappush(heap, (job.deadline, next(self._counter), job))
+            self._update_deadline()
+        for job in due:
+            if job.cancelled:
+                continue
+            try:
+                job.function(*job.args, **job.kws)
+            except Exception:
+                logger.error("error in scheduled function %s: %s" % (
+                    getattr(job.function, '__name__', str(job.function)), str(sys.exc_info()[1])))
+
+    def sleep(self, seconds, resolution=0.05):
+        """
+        sleep, running the jobs which are due meanwhile. Jobs added from
+        other threads are noticed after at most `resolution` seconds
+        """
+        end = time.time() + seconds
+        while True:
+            now = time.time()
+            if now >= self.deadline:
+                self.run(now)
+                now = time.time()
+            if now >= end:
+                return
+            time.sleep(max(0, min(end, self.deadline, now + resolution) - now))
+
+    def clear(self):
+        with self._lock:
+            self._heap = []
+            self._now.clear()
+            self.deadline = float('inf')
+
+
+class SchedulerThread(Scheduler):
+    """
+    A Scheduler running its jobs from its own thread, for the jobs
+    which should not delay the mainloop (writing to disk) or which
+    should run also when the mainloop does not
+    """
+    def __init__(self):
+        Scheduler.__init__(self)
+        self._wakeup = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = th = threading.Thread(target=self._run)
+        th.daemon = True
+        th.start()
+
+    def stop(self, timeout=2):
+        """
+        stop the thread, after the job running (if any) finished
+        """
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None and threading.current_thread() is not self._thread:
+            self._thread.join(timeout)
+
+    def _add(self, job):
+        Scheduler._add(self, job)
+        self._wakeup.set()
+        return job
+
+    def _run(self):
+        wakeup = self._wakeup
+        while self._running:
+            # cleared before looking at the deadline, a job added meanwhile wakes us up
+            wakeup.clear()
+            now = time.time()
+            if now >= self.deadline:
+                self.run(now)
+            # without timeout (no jobs), wait does not poll
+            wakeup.wait(self.timeout())
@@ -0,0 +1,127 @@
+from __future__ import division as _division, absolute_import as _absolute_import
+
+# stdlib
+import sys
+import time
+import itertools
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger('pedlbrd-debug')
+
+
+class SerialWriter(object):
+    """
+    Writes the commands for the device from its own thread, one at a time.
+
+    The device reads one command per loop, a command arriving before
+    the previous one was read overwrites it, so the writer waits `pacing`
+    seconds (about one loop of the device) between commands
+
+    * urgent commands (the first byte in URGENT) go before the rest
+    * a command replaces a waiting one with the same key (a newer value
+      for the same parameter), keeping its place in the queue
+    * at most maxsize commands wait, put returns False when full
+    * a command can change the pacing (it changes the loop of the device),
+      the commands after it are written with the new pacing
+
+    write: a function writing a string to the device (serial.write)
+    """
+    URGENT = frozenset('HLF')
+
+    def __init__(self, write, pacing=0.04, maxsize=32):
+        self.write = write
+        self.pacing = pacing
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.errors = 0
+        self._urgent = OrderedDict()
+        self._normal = OrderedDict()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        # set when everything queued was written
+        self._idle = threading.Event()
+        self._idle.set()
+        self._running = True
+        self._thread = th = threading.Thread(target=self._run)
+        th.daemon = True
+        th.start()
+
+    def __len__(self):
+        return len(self._urgent) + len(self._normal)
+
+    def put(self, data, key=None, pacing=None):
+        """
+        data  : the command, as a string (terminated by the separator)
+        key   : commands with the same key replace each other while waiting.
+                None: the command is never replaced
+        pacing: if given, the pacing after this command is written. The
+                device acts on the command in its next loop, so the wait
+                right after it is never shorter than the current pacing
+
+        ==> True if the command was queued, False if the queue is full
+        """
+        queue = self._urgent if data[0] in self.URGENT else self._normal
+        with self._lock:
+            if key is None:
+                key = next(self._counter)
+            elif key in queue:
+                queue[key] = (data, pacing)
+                return True
+            if len(self) >= self.maxsize:
+                self.dropped += 1
+                return False
+            queue[key] = (data, pacing)
+            self._idle.clear()
+        self._wakeup.set()
+        return True
+
+    def drain(self, timeout=None):
+        """
+        wait until all the queued commands were written
+
+        ==> False if the timeout was reached
+        """
+        return self._idle.wait(timeout)
+
+    def close(self):
+        self._running = False
+        self._wakeup.set()
+        if threading.current_thread() is not self._thread:
+            self._thread.join(1)
+
+    def _pop(self):
+        with self._lock:
+            for queue in (self._urgent, self._normal):
+                if queue:
+                    return queue.popitem(last=False)[1]
+            self._idle.set()
+        return None
+
+    def _run(self):
+        wakeup = self._wakeup
+        lastwrite = 0
+        while self._running:
+            # without timeout, wait does not poll
+            wakeup.wait()
+            wakeup.clear()
+            while self._running:
+                command = self._pop()
+                if command is None:
+                    break
+                data, pacing = command
+                wait = lastwrite + self.pacing - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                try:
+                    self.write(data)
+                except Exception:
+                    self.errors += 1
+                    logger.error("could not write to device: %s" % str(sys.exc_info()[1]))
+                lastwrite = time.time()
+                if pacing is not None:
+                    # shorter: the next command still waits one loop at the old pacing
+                    lastwrite += max(0, self.pacing - pacing)
+                    self.pacing = pacing
@@ -0,0 +1,204 @@
+"""
+Data output to a memory-mapped file, for readers on the same host
+
+Layout (little endian)
+
+    header   : magic 'PDLB', version, capacity, num_analog, num_digital,
+               write count (number of records ever written)
+    ring     : capacity records
+    snapshot : the latest record of each pin (analog pins first),
+               each guarded by a sequence number (odd while writing)
+
+    record   : timestamp (double), kind ('A' or 'D'), pin, raw value, normalized value
+
+A record in the ring is valid if, after reading it, the write count is
+still less than its index + capacity (otherwise it was overwritten while
+reading). Readers only need this module (see ShmReader)
+"""
+
+from __future__ import division as _division, absolute_import as _absolute_import
+
+# stdlib
+import os
+import mmap
+import time
+import struct
+import tempfile
+from collections import namedtuple
+
+MAGIC = 'PDLB'
+VERSION = 1
+
+_header = struct.Struct('<4sIIII4xQ')
+_record = struct.Struct('<dBBxxif')
+_seq = struct.Struct('<I')
+_count = struct.Struct('<Q')
+_COUNT_OFFSET = 24
+_SLOT_SIZE = 4 + _record.size
+_KIND_A, _KIND_D = ord('A'), ord('D')
+
+ShmRecord = namedtuple('ShmRecord', 'timestamp kind pin raw norm')
+
+
+def default_path():
+    shmdir = '/dev/shm'
+    if not os.path.isdir(shmdir):
+        shmdir = tempfile.gettempdir()
+    return os.path.join(shmdir, 'pedlbrd.shm')
+
+
+def _size(capacity, num_analog, num_digital):
+    return _header.size + capacity * _record.size + (num_analog + num_digital) * _SLOT_SIZE
+
+
+class ShmWriter(object):
+    """
+    Writes the data of the device to a memory-mapped ring buffer,
+    see the module documentation for the layout
+
+    path: the file to map. If None, a file in /dev/shm (or the temp dir)
+    timefunc: returns the timestamp of the record being written
+    """
+    def __init__(self, num_analog, num_digital, capacity=4096, path=None, timefunc=time.time):
+        self.path = path or default_path()
+        self.timefunc = timefunc
+        self.capacity = capacity
+        self.num_analog = num_analog
+        self.num_digital = num_digital
+        size = _size(capacity, num_analog, num_digital)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        # the file can be left by a previous run: its records and
+        # sequence numbers would look current to the readers
+        self._mmap[:] = '\0' * size
+        _header.pack_into(self._mmap, 0, MAGIC, VERSION, capacity, num_analog, num_digital, 0)
+        self._count = 0
+        self._ring_offset = _header.size
+        self._snapshot_offset = self._ring_offset + capacity * _record.size
+        self._slotseqs = [0] * (num_analog + num_digital)
+
+    def write(self, kind, pin, raw, norm):
+        """
+        kind: 'A' or 'D'
+        """
+        if kind == 'A':
+            kindbyte, slot = _KIND_A, pin
+            if pin >= self.num_analog:
+                return
+        else:
+            kindbyte, slot = _KIND_D, self.num_analog + pin
+            if pin >= self.num_digital:
+                return
+        now = self.timefunc()
+        buf = self._mmap
+        count = self._count
+        _record.pack_into(buf, self._ring_offset + (count % self.capacity) * _record.size,
+                          now, kindbyte, pin, raw, norm)
+        self._count = count = count + 1
+        _count.pack_into(buf, _COUNT_OFFSET, count)
+        # snapshot, guarded by a seqlock
+        offset = self._snapshot_offset + slot * _SLOT_SIZE
+        seqs = self._slotseqs
+        seq = (seqs[slot] + 1) & 0xFFFFFFFF
+        _seq.pack_into(buf, offset, seq)
+        _record.pack_into(buf, offset + 4, now, kindbyte, pin, raw, norm)
+        seqs[slot] = seq = (seq + 1) & 0xFFFFFFFF
+        _seq.pack_into(buf, offset, seq)
+
+    def close(self):
+        self._mmap.close()
+
+
+class ShmReader(object):
+    """
+    Reads the data written by a ShmWriter, possibly in another process
+
+    reader = ShmReader()
+    while True:
+        for record in reader.read():
+            print record.kind, record.pin, record.norm
+        print reader.latest('A', 0)
+    """
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        f = open(self.path, 'rb')
+        try:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        magic, version, capacity, num_analog, num_digital, count = _header.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("%s is not a pedlbrd shared memory file (version %d)" % (self.path, VERSION))
+        self.capacity = capacity
+        self.num_analog = num_analog
+        self.num_digital = num_digital
+        self._ring_offset = _header.size
+        self._snapshot_offset = self._ring_offset + capacity * _record.size
+        # start with the new records
+        self.position = count
+        # the number of records which were overwritten before being read
+        self.lost = 0
+
+    def write_count(self):
+        return _count.unpack_from(self._mmap, _COUNT_OFFSET)[0]
+
+    def read(self):
+        """
+        ==> a list of the records written since the last read
+        """
+        buf = self._mmap
+        capacity = self.capacity
+        count = self.write_count()
+        position = self.position
+        if count < position:
+            # the writer was restarted
+            position = 0
+        if count - position > capacity:
+            self.lost += count - position - capacity
+            position = count - capacity
+        records = [_record.unpack_from(buf, self._ring_offset + (i % capacity) * _record.size)
+                   for i in xrange(position, count)]
+        # records which were overwritten while reading are discarded
+        overwritten = self.write_count() - capacity - position + 1
+        if overwritten > 0:
+            self.lost += overwritten
+            records = records[overwritten:]
+        self.position = count
+        return [ShmRecord(t, chr(kind), pin, raw, norm) for t, kind, pin, raw, norm in records]
+
+    def latest(self, kind, pin):
+        """
+        ==> the last record written for the given pin, or None if nothing
+            was written yet
+        """
+        slot = pin if kind == 'A' else self.num_analog + pin
+        offset = self._snapshot_offset + slot * _SLOT_SIZE
+        buf = self._mmap
+        for attempt in range(1000):
+            seq = _seq.unpack_from(buf, offset)[0]
+            if seq & 1:
+                continue
+            record = _record.unpack_from(buf, offset + 4)
+            if _seq.unpack_from(buf, offset)[0] == seq:
+                break
+        else:
+            return None
+        if seq == 0:
+            return None
+        t, kind, pin, raw, norm = record
+        return ShmRecord(t, chr(kind), pin, raw, norm)
+
+    def snapshot(self):
+        """
+        ==> a list with the latest record of each pin (None if not written yet),
+            analog pins first
+        """
+        return ([self.latest('A', pin) for pin in range(self.num_analog)] +
+                [self.latest('D', pin) for pin in range(self.num_digital)])
+
+    def close(self):
+        self._mmap.close()
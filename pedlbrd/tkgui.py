@@ -122,6 +122,8 @@ class GUI(object):
 		s.add_method('/quit', None, quit_handler)
 		s.add_method('/notify/calibrate', None, calibrate_handler, self)
 		s.add_method('/notify/reset', None, notify_reset_handler, self)
+		# the core pings registered clients to keep them registered
+		s.add_method('/ping', 'i', lambda path, args: s.send(self.coreaddr, '/pingback', args[0]))
 		s.send(self.coreaddr, '/registerui')
 		return s
 
@@ -0,0 +1,54 @@
+from __future__ import division as _division, absolute_import as _absolute_import
+
+
+class HeartbeatWatchdog(object):
+    """
+    Detects a device which stopped sending heartbeats.
+
+    It is armed with the first heartbeat (the device sends none while it
+    boots after the port is opened). Some commands keep the device busy
+    without reading or sending anything (a led pattern blocks its loop),
+    the watchdog is then paused for that time.
+
+    watchdog = HeartbeatWatchdog(timeout=0.9)
+    watchdog.beat(now)      # for each heartbeat
+    watchdog.lost(now)      # when the serial read timed out
+
+    timeout: the seconds without a heartbeat after which the device is
+             lost. 0 disables the watchdog
+    """
+    def __init__(self, timeout=0):
+        self.timeout = timeout
+        self.reset(0)
+
+    def reset(self, now):
+        """
+        a new connection, disarm the watchdog until the first heartbeat
+        """
+        self.armed = False
+        self.last = now
+        self.paused_until = 0
+
+    def beat(self, now):
+        self.last = now
+        self.armed = True
+
+    def pause(self, seconds, now):
+        """
+        the device will be busy for `seconds`. Its next heartbeat is
+        expected one timeout after that
+
+        Called from other threads, a float is assigned atomically
+        """
+        until = now + seconds + self.timeout
+        if until > self.paused_until:
+            self.paused_until = until
+
+    def lost(self, now):
+        """
+        ==> True if the device should have sent a heartbeat by now
+        """
+        timeout = self.timeout
+        if not self.armed or not timeout or now < self.paused_until:
+            return False
+        return now - self.last > timeout
@@ -0,0 +1,297 @@
+from __future__ import division as _division, absolute_import as _absolute_import
+
+# stdlib
+import time
+import socket
+import struct
+import base64
+import hashlib
+import fnmatch
+import threading
+from collections import OrderedDict
+
+from .osc import OSCStreamServer, OSCStreamClient
+
+_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+_OP_CONTINUATION, _OP_TEXT, _OP_BINARY, _OP_CLOSE, _OP_PING, _OP_PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+_MAX_MESSAGE = 65536
+# close codes (RFC 6455, 7.4.1)
+_CLOSE_PROTOCOL_ERROR, _CLOSE_TOO_BIG = 1002, 1009
+
+
+def ws_frame(payload, opcode=_OP_BINARY):
+    """
+    a single, unmasked frame (server -> client)
+    """
+    size = len(payload)
+    if size < 126:
+        header = struct.pack('>BB', 0x80 | opcode, size)
+    elif size < 65536:
+        header = struct.pack('>BBH', 0x80 | opcode, 126, size)
+    else:
+        header = struct.pack('>BBQ', 0x80 | opcode, 127, size)
+    return header + payload
+
+
+def _unmask(payload, mask):
+    data = bytearray(payload)
+    mask = bytearray(mask)
+    for i in xrange(len(data)):
+        data[i] ^= mask[i & 3]
+    return str(data)
+
+
+def _parse_frame(data):
+    """
+    parse a frame sent by a client, which must be masked
+
+    ==> (fin, opcode, payload, rest) or None if the frame is not complete
+    """
+    if len(data) < 2:
+        return None
+    b0, b1 = ord(data[0]), ord(data[1])
+    size = b1 & 0x7F
+    pos = 2
+    if size == 126:
+        if len(data) < 4:
+            return None
+        size = struct.unpack_from('>H', data, 2)[0]
+        pos = 4
+    elif size == 127:
+        if len(data) < 10:
+            return None
+        size = struct.unpack_from('>Q', data, 2)[0]
+        pos = 10
+    if size > _MAX_MESSAGE:
+        raise ValueError("websocket frame too big: %d" % size)
+    if not b1 & 0x80:
+        raise ValueError("unmasked frame from a client")
+    mask = data[pos:pos+4]
+    pos += 4
+    if len(data) < pos + size:
+        return None
+    payload = _unmask(data[pos:pos+size], mask)
+    return bool(b0 & 0x80), b0 & 0x0F, payload, data[pos+size:]
+
+
+def _packet_key(packet):
+    """
+    the path and the first argument of an OSC packet, which identify
+    a data stream (/data/A + pin). Used to keep only the latest value
+    """
+    if packet.startswith('#bundle'):
+        # a timetagged message (see encode_bundle), keyed by its message
+        return _packet_key(packet[20:])
+    end = packet.index('\0')
+    tagsend = packet.index('\0', end + 4 - (end % 4))
+    argstart = tagsend + 4 - (tagsend % 4)
+    return packet[:end], packet[:argstart+4]
+
+
+class WebSocketClient(OSCStreamClient):
+    """
+    A websocket connection. Each binary message is an OSC packet.
+
+    Data is sent at most at the rate of the server (only the latest
+    value for each path and pin is kept between updates). Paths are
+    filtered with the patterns given via /subscribe
+    """
+    def __init__(self, server, sock, addr, maxqueue):
+        OSCStreamClient.__init__(self, server, sock, addr, maxqueue)
+        self.handshaken = False
+        self.patterns = []
+        self._matches = {}
+        self._fragments = []
+        self._fragments_size = 0
+        self._latest = OrderedDict()
+        self._latest_lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "ws://%s:%d/" % (self.hostname, self.port)
+
+    def accepts(self, path):
+        """
+        ==> True if the path matches the subscription patterns
+        (everything is accepted if there are no patterns)
+        """
+        matches = self._matches
+        accepted = matches.get(path)
+        if accepted is None:
+            patterns = self.patterns
+            accepted = matches[path] = not patterns or any(fnmatch.fnmatch(path, patt) for patt in patterns)
+        return accepted
+
+    def set_patterns(self, patterns):
+        self.patterns = patterns
+        self._matches = {}
+
+    def push_latest(self, key, frame):
+        with self._latest_lock:
+            self._latest[key] = frame
+
+    def flush_latest(self):
+        if not self._latest:
+            return
+        with self._latest_lock:
+            latest, self._latest = self._latest, OrderedDict()
+        dataqueue = self._dataqueue
+        for frame in latest.itervalues():
+            if len(dataqueue) == dataqueue.maxlen:
+                self.dropped += 1
+            dataqueue.append(frame)
+        self.server.wakeup()
+
+    def read(self):
+        data = self.sock.recv(4096)
+        if not data:
+            return None
+        data = self._inbuf + data
+        if not self.handshaken:
+            if '\r\n\r\n' not in data:
+                if len(data) > 8192:
+                    return None
+                self._inbuf = data
+                return []
+            request, data = data.split('\r\n\r\n', 1)
+            if not self._handshake(request):
+                return None
+        packets = []
+        while True:
+            try:
+                parsed = _parse_frame(data)
+            except ValueError:
+                self._send_close(struct.pack('>H', _CLOSE_PROTOCOL_ERROR))
+                return None
+            if parsed is None:
+                break
+            fin, opcode, payload, data = parsed
+            if opcode == _OP_CLOSE:
+                # echo the status code before closing
+                self._send_close(payload[:2])
+                return None
+            elif opcode == _OP_PING:
+                self._queue.append(ws_frame(payload, _OP_PONG))
+                self.server.wakeup()
+            elif opcode in (_OP_BINARY, _OP_CONTINUATION):
+                self._fragments_size += len(payload)
+                if self._fragments_size > _MAX_MESSAGE:
+                    self._send_close(struct.pack('>H', _CLOSE_TOO_BIG))
+                    return None
+                self._fragments.append(payload)
+                if fin:
+                    packets.append(''.join(self._fragments))
+                    self._fragments = []
+                    self._fragments_size = 0
+        self._inbuf = data
+        return packets
+
+    def _send_close(self, payload):
+        """
+        send a close frame, the connection is closed right after
+        (what is still queued is not sent)
+        """
+        try:
+            self.sock.sendall(ws_frame(payload, _OP_CLOSE))
+        except socket.error:
+            pass
+
+    def _handshake(self, request):
+        headers = {}
+        for line in request.split('\r\n')[1:]:
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        key = headers.get('sec-websocket-key')
+        upgrade = headers.get('upgrade', '').lower()
+        connection = [token.strip() for token in headers.get('connection', '').lower().split(',')]
+        if key is None or upgrade != 'websocket' or 'upgrade' not in connection:
+            self.sock.sendall("HTTP/1.1 400 Bad Request\r\n\r\n")
+            return False
+        accept = base64.b64encode(hashlib.sha1(key + _GUID).digest())
+        self._queue.append(
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            "Sec-WebSocket-Accept: %s\r\n\r\n" % accept)
+        self.server.wakeup()
+        self.handshaken = True
+        return True
+
+
+class WebSocketServer(OSCStreamServer):
+    """
+    Serves the OSC api to browsers: each binary websocket message
+    is an OSC packet, in both directions.
+
+    Besides the subscriptions of OSCStreamServer, a client can send
+    /subscribe pattern and /unsubscribe pattern to receive only the
+    paths matching the patterns (fnmatch wildcards, like /data/A or /data/*).
+    /subscribe also registers the client for data and ui messages.
+
+    rate: the max. number of data updates per second sent to each
+          client (0 to send data as it comes)
+    """
+    client_class = WebSocketClient
+    frame = staticmethod(ws_frame)
+
+    def __init__(self, port, handler, maxqueue=1024, rate=30):
+        OSCStreamServer.__init__(self, port, handler, maxqueue=maxqueue)
+        self.rate = rate
+        self.poll_period = 1 / rate if rate > 0 else 1
+        self._next_flush = 0
+
+    def send_data(self, packet, label=None, datapath=None):
+        clients = self._data_clients
+        if not clients:
+            return
+        path, key = _packet_key(packet)
+        frame = None
+        for client in clients:
+            if not client.handshaken or not client.accepts(path):
+                continue
+            if label is not None and not client.data_accepts(label, datapath):
+                continue
+            if frame is None:
+                frame = ws_frame(packet)
+            if self.rate > 0:
+                client.push_latest(key, frame)
+            else:
+                client.push(frame, droppable=True)
+
+    def send_ui(self, packet):
+        clients = self._ui_clients
+        if not clients:
+            return
+        path = packet[:packet.index('\0')]
+        frame = None
+        for client in clients:
+            if not client.handshaken or not client.accepts(path):
+                continue
+            if frame is None:
+                frame = ws_frame(packet)
+            client.push(frame)
+
+    def _subscribe(self, client, path, args):
+        if path == '/subscribe' and args:
+            client.set_patterns(client.patterns + [arg for arg in args if arg not in client.patterns])
+            self.subscribe(client, data=True, ui=True)
+            return True
+        elif path == '/unsubscribe':
+            # without patterns, unsubscribe from everything
+            patterns = [patt for patt in client.patterns if patt not in args] if args else []
+            client.set_patterns(patterns)
+            if not patterns:
+                self.subscribe(client, data=False, ui=False)
+            return True
+        return OSCStreamServer._subscribe(self, client, path, args)
+
+    def _poll(self):
+        if self.rate <= 0:
+            return
+        now = time.time()
+        if now < self._next_flush:
+            return
+        self._next_flush = now + self.poll_period
+        for client in self._data_clients:
+            client.flush_latest()
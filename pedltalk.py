@@ -198,6 +198,11 @@ def echo_handler(path, args, types, src):
 def heartbeat_handler(path, args, types, src):
     pass
 
+def ping_handler(path, args, types, src):
+    # the core pings registered clients to keep them registered
+    if args:
+        s.send(src, '/pingback', args[0])
+
 def quit_handler(path, args, types, src):
     addr = src.hostname, src.port
     try:
@@ -357,6 +362,7 @@ if __name__ == '__main__':
         port = s.port
 
     s.add_method('/heartbeat', None, heartbeat_handler)
+    s.add_method('/ping', None, ping_handler)
     s.add_method('/echo', None, echo_handler)
     s.add_method('/quit', None, quit_handler)
     s.add_method(None, None, main_callback)
@@ -0,0 +1,113 @@
+from __future__ import division as _division, absolute_import as _absolute_import
+
+import time
+import logging
+import unittest
+from collections import deque
+
+try:
+    from pedlbrd import core
+except ImportError:
+    # pedlbrd.core needs liblo, pyserial and rtmidi2
+    core = None
+
+from pedlbrd.scheduler import Scheduler
+from pedlbrd.serialwriter import SerialWriter
+
+
+class FakeSerial(object):
+    """
+    records what is done to the port, in order
+    """
+    def __init__(self):
+        self.baudrate = 115200
+        self.log = []
+
+    def write(self, data):
+        self.log.append(('write', self.baudrate, data))
+
+    def flush(self):
+        self.log.append(('flush', self.baudrate))
+
+    def flushInput(self):
+        self.log.append(('flushInput', self.baudrate))
+
+
+@unittest.skipIf(core is None, "pedlbrd.core can't be imported")
+class TestBaudrateNegotiation(unittest.TestCase):
+    def setUp(self):
+        # only what the negotiation uses
+        self.pedlbrd = p = core.Pedlbrd.__new__(core.Pedlbrd)
+        p.config = {'serial_max_baudrate': 250000, 'serial_write_pacing': 0.01}
+        p.logger = logging.getLogger('pedlbrd-test')
+        p._running = False
+        p._device_params = {}
+        p._baudrates_failed = set()
+        p._baudrate_switch_time = 0
+        p._control = deque()
+        p._wakeup_fds = None
+        p._scheduler = Scheduler()
+        p._serialconnection = self.conn = FakeSerial()
+        p._serialwriter = SerialWriter(self.conn.write, pacing=0.01)
+
+    def tearDown(self):
+        self.pedlbrd._serialwriter.close()
+
+    def run_mainloop(self, seconds):
+        scheduler = self.pedlbrd._scheduler
+        end = time.time() + seconds
+        while time.time() < end:
+            now = time.time()
+            if now >= scheduler.deadline:
+                scheduler.run(now)
+            time.sleep(0.002)
+
+    def test_switch(self):
+        # 115200, 230400 and 250000 and 500000 supported, 500000 is above the max
+        self.pedlbrd._baudrate_negotiate(0b1111)
+        self.run_mainloop(0.2)
+        log = self.conn.log
+        self.assertEqual(log[0], ('write', 115200, 'SR\x02\x80'))
+        # the port switches after the command was written, then forgets what it read
+        self.assertEqual(log[1:3], [('flush', 115200), ('flushInput', 250000)])
+        self.assertEqual(log[3], ('write', 250000, 'H\x80'))
+        self.assertEqual(list(self.pedlbrd._control), ["RESYNC"])
+        self.assertGreater(self.pedlbrd._baudrate_switch_time, 0)
+
+    def test_failed_rates_are_skipped(self):
+        self.pedlbrd._baudrates_failed.add(250000)
+        self.pedlbrd._baudrate_negotiate(0b1111)
+        self.run_mainloop(0.2)
+        self.assertEqual(self.conn.log[0], ('write', 115200, 'SR\x01\x80'))
+        self.assertEqual(self.conn.baudrate, 230400)
+
+    def test_nothing_to_negotiate(self):
+        self.conn.baudrate = 250000
+        self.pedlbrd._baudrate_negotiate(0b111)
+        self.run_mainloop(0.05)
+        self.assertEqual(self.conn.log, [])
+
+    def test_writer_busy(self):
+        # the writer can't write the command in time: stay at the rate
+        self.pedlbrd._serialwriter.close()
+        self.pedlbrd._serialwriter = writer = SerialWriter(self.conn.write, pacing=5)
+        # the first one is written at once, the second waits for the pacing
+        writer.put('first')
+        writer.put('busy')
+        self.pedlbrd._baudrate_switch(self.conn, 2, time.time() + 0.1)
+        self.run_mainloop(0.2)
+        self.assertEqual(self.conn.baudrate, 115200)
+        self.assertEqual(list(self.pedlbrd._control), [])
+
+    def test_connection_replaced(self):
+        self.pedlbrd._baudrate_negotiate(0b111)
+        # the device was lost and found again before the switch
+        self.pedlbrd._serialconnection = other = FakeSerial()
+        self.run_mainloop(0.2)
+        self.assertEqual(self.conn.baudrate, 115200)
+        self.assertEqual(other.log, [])
+        self.assertEqual(list(self.pedlbrd._control), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
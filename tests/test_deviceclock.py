@@ -0,0 +1,68 @@
+from __future__ import division as _division, absolute_import as _absolute_import
+
+import random
+import unittest
+
+from pedlbrd.deviceclock import DeviceClock
+
+
+WRAP = 1 << 21
+
+
+class TestDeviceClock(unittest.TestCase):
+    def simulate(self, clock, seconds, drift, start_ms=0, period_ms=10, latency=0.002, jitter=0.004, seed=0):
+        """
+        the device reads a frame every period_ms of its own clock, which
+        runs `drift` seconds per second slower than the host clock. Each
+        timestamp arrives latency plus a random delay (up to jitter) later
+
+        ==> a list of (estimated host time, real host time of the read)
+        """
+        rnd = random.Random(seed)
+        base = 1000.0
+        out = []
+        for i in range(int(seconds * 1000 / period_ms)):
+            device_ms = i * period_ms
+            real = base + device_ms / 1000 * (1 + drift)
+            arrival = real + latency + rnd.uniform(0, jitter)
+            estimated = clock.update((start_ms + device_ms) % WRAP, arrival)
+            out.append((estimated, real))
+        return out
+
+    def assertConverges(self, clock, times, latency=0.002):
+        # after the first windows, the error is about the fixed latency
+        for estimated, real in times[len(times) // 2:]:
+            self.assertAlmostEqual(estimated - real - latency, 0, delta=0.001)
+
+    def test_jitter(self):
+        clock = DeviceClock()
+        times = self.simulate(clock, 60, drift=0)
+        self.assertConverges(clock, times)
+        self.assertAlmostEqual(clock.drift, 0, delta=20e-6)
+
+    def test_drift_is_recovered(self):
+        clock = DeviceClock()
+        times = self.simulate(clock, 120, drift=200e-6)
+        self.assertConverges(clock, times)
+        self.assertAlmostEqual(clock.drift, 200e-6, delta=20e-6)
+        self.assertEqual(clock.resyncs, 0)
+
+    def test_wraparound(self):
+        # the 21-bit counter wraps after about 35 minutes
+        clock = DeviceClock(wrap=WRAP)
+        times = self.simulate(clock, 120, drift=200e-6, start_ms=WRAP - 60000)
+        self.assertConverges(clock, times)
+        self.assertAlmostEqual(clock.drift, 200e-6, delta=20e-6)
+        self.assertEqual(clock.resyncs, 0)
+
+    def test_restart_resyncs(self):
+        clock = DeviceClock()
+        clock.update(5000, 100.0)
+        clock.update(5010, 100.01)
+        # the device restarted, its counter starts again at 0
+        self.assertAlmostEqual(clock.update(0, 105.0), 105.0)
+        self.assertEqual(clock.resyncs, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+from __future__ import division as _division, absolute_import as _absolute_import
+
+import unittest
+
+from pedlbrd.frames import (mask_bytes, read_analog2, read_digital2,
+                            encode_analog2, encode_digital2)
+
+
+def reader(data):
+    """
+    ==> a function reading from data like serial.read, returning
+        less bytes when the data is exhausted (a timeout)
+    """
+    pos = [0]
+    def read(n):
+        out = data[pos[0]:pos[0] + n]
+        pos[0] += len(out)
+        return out
+    return read
+
+
+class TestFrames(unittest.TestCase):
+    def test_mask_bytes(self):
+        self.assertEqual([mask_bytes(n) for n in (1, 4, 7, 8, 14, 15)], [1, 1, 1, 2, 2, 3])
+
+    def test_headers_are_not_data(self):
+        frame = encode_analog2({pin: 16383 for pin in range(14)}, 14)
+        self.assertGreaterEqual(ord(frame[0]), 128)
+        self.assertTrue(all(ord(byte) < 128 for byte in frame[1:]))
+
+    def test_analog_roundtrip(self):
+        for numpins in (4, 7, 8, 10, 14):
+            values = {pin: pin * 1000 + 7 for pin in range(0, numpins, 3)}
+            values[numpins - 1] = 16383
+            frame = encode_analog2(values, numpins)
+            self.assertEqual(len(frame), 1 + mask_bytes(numpins) + 2 * len(values))
+            decoded = read_analog2(reader(frame[1:]), mask_bytes(numpins))
+            self.assertEqual(dict(decoded), values)
+
+    def test_analog_pins_beyond_seven(self):
+        frame = encode_analog2({7: 1, 13: 300}, 14)
+        self.assertEqual(read_analog2(reader(frame[1:]), 2), [(7, 1), (13, 300)])
+
+    def test_analog_empty_mask(self):
+        frame = encode_analog2({}, 10)
+        self.assertEqual(read_analog2(reader(frame[1:]), 2), [])
+
+    def test_digital_roundtrip(self):
+        for numpins in (4, 7, 8, 10, 14):
+            states = [pin % 2 for pin in range(numpins)]
+            changed = [0, numpins - 1] + ([7] if numpins > 7 else [])
+            frame = encode_digital2(states, changed, numpins)
+            self.assertEqual(len(frame), 1 + 2 * mask_bytes(numpins))
+            decoded = read_digital2(reader(frame[1:]), mask_bytes(numpins))
+            self.assertEqual(sorted(decoded), sorted((pin, states[pin]) for pin in set(changed)))
+
+    def test_timeout_partway(self):
+        analog = encode_analog2({1: 100, 9: 200}, 10)[1:]
+        for cut in range(len(analog)):
+            self.assertIsNone(read_analog2(reader(analog[:cut]), 2))
+        digital = encode_digital2([1] * 10, [8], 10)[1:]
+        for cut in range(len(digital)):
+            self.assertIsNone(read_digital2(reader(digital[:cut]), 2))
+
+    def test_mask_cut_by_next_header(self):
+        # the frame was cut and the next frame started where the mask should be
+        data = encode_analog2({1: 100}, 4)[:1] + encode_analog2({2: 5}, 4)
+        self.assertIsNone(read_analog2(reader(data[1:]), 1))
+        self.assertIsNone(read_digital2(reader(chr(128 + 68) + '\x00'), 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
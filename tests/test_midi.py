@@ -0,0 +1,55 @@
+from __future__ import division as _division, absolute_import as _absolute_import
+
+import time
+import threading
+import unittest
+
+from pedlbrd.midi import QueuedMidiOutput
+
+
+class FakeMidiOut(object):
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.sent = []
+
+    def send_message(self, msg):
+        if self.fail:
+            raise IOError("port gone")
+        self.sent.append(msg)
+
+    def close_port(self):
+        pass
+
+
+class TestQueuedMidiOutput(unittest.TestCase):
+    def test_sends_in_order(self):
+        midiout = FakeMidiOut()
+        out = QueuedMidiOutput(midiout, 'test')
+        for i in range(10):
+            out.send_message((176, 1, i))
+        time.sleep(0.05)
+        out.close()
+        self.assertEqual([msg[2] for msg in midiout.sent], range(10))
+        self.assertEqual(out.dropped, 0)
+
+    def test_broken_output_counts_every_drop(self):
+        out = QueuedMidiOutput(FakeMidiOut(fail=True), 'test', maxsize=8)
+        out.send_message((176, 1, 0))
+        time.sleep(0.05)
+        self.assertTrue(out.broken)
+        self.assertEqual(out.errors, 1)
+        # sent from several threads at once
+        def sendmany():
+            for i in range(2000):
+                out.send_message((176, 1, 1))
+        threads = [threading.Thread(target=sendmany) for i in range(4)]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        out.close()
+        self.assertEqual(out.dropped, 4 * 2000)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+from __future__ import division as _division, absolute_import as _absolute_import
+
+import socket
+import struct
+import threading
+import unittest
+
+from pedlbrd.osc import (OSCLeases, OSCStreamServer, OSCStreamClient, OSCSender, encode_message, encode_bundle,
+                         decode_packet, slip_encode, slip_decode, _MMsgBatch)
+
+
+class TestSLIP(unittest.TestCase):
+    PACKETS = [encode_message('/data/A', 1, 0.5), '\xc0\xdb\xc0x\xdb\xdc\xdd', encode_message('/status', 'ok')]
+
+    def test_roundtrip(self):
+        data = ''.join(slip_encode(packet) for packet in self.PACKETS)
+        self.assertEqual(slip_decode(data), (self.PACKETS, ''))
+
+    def test_escapes(self):
+        self.assertEqual(slip_encode('a\xc0b\xdbc'), '\xc0a\xdb\xdcb\xdb\xddc\xc0')
+
+    def test_partial_reads(self):
+        # the packets arrive split at every possible byte, also inside an escape
+        data = ''.join(slip_encode(packet) for packet in self.PACKETS)
+        for size in (1, 2, 3, 7):
+            received, rest = [], ''
+            for pos in range(0, len(data), size):
+                packets, rest = slip_decode(rest + data[pos:pos+size])
+                received.extend(packets)
+            self.assertEqual(received, self.PACKETS)
+            self.assertEqual(rest, '')
+
+
+class TestBundle(unittest.TestCase):
+    def test_immediately(self):
+        bundle = encode_bundle(None, encode_message('/a'))
+        self.assertEqual(bundle[:16], '#bundle\0' + struct.pack('>II', 0, 1))
+
+    def test_timetag(self):
+        bundle = encode_bundle(1.5, encode_message('/a'))
+        seconds, fraction = struct.unpack('>II', bundle[8:16])
+        self.assertEqual(seconds, 2208988801)
+        self.assertEqual(fraction, 1 << 31)
+
+    def test_contents(self):
+        first, second = encode_message('/data/A', 3, 0.25), encode_message('/data/D', 1, 1)
+        bundle = encode_bundle(1000.0, first, encode_bundle(None, second))
+        self.assertEqual(struct.unpack('>i', bundle[16:20])[0], len(first))
+        self.assertEqual(bundle[20:20+len(first)], first)
+        self.assertEqual(decode_packet(bundle), [('/data/A', 'if', [3, 0.25]), ('/data/D', 'ii', [1, 1])])
+
+
+class TestOSCLeases(unittest.TestCase):
+    TTL = 120
+
+    def run_checks(self, leases, addresses, answering, duration):
+        """
+        check the leases every ttl/4 seconds, as the core does. The
+        addresses in answering renew their lease when pinged
+        """
+        alive = set(addresses)
+        t = 0
+        while t <= duration:
+            expired, stale = leases.check(alive, self.TTL, now=t)
+            alive -= set(expired)
+            for addr in stale:
+                if addr in answering:
+                    # the /pingback arrives some time after the /ping
+                    leases.renew(addr, now=t + 0.5)
+            t += self.TTL / 4
+        return alive
+
+    def test_answering_client_keeps_its_lease(self):
+        leases = OSCLeases()
+        client = ('127.0.0.1', 9000)
+        leases.renew(client, now=0)
+        alive = self.run_checks(leases, [client], answering=[client], duration=10 * self.TTL)
+        self.assertEqual(alive, set([client]))
+        self.assertEqual(leases.expired, 0)
+
+    def test_silent_client_expires(self):
+        leases = OSCLeases()
+        client, silent = ('127.0.0.1', 9000), ('127.0.0.1', 9001)
+        leases.renew(client, now=0)
+        leases.renew(silent, now=0)
+        alive = self.run_checks(leases, [client, silent], answering=[client], duration=2 * self.TTL)
+        self.assertEqual(alive, set([client]))
+        self.assertEqual(leases.expired, 1)
+        self.assertEqual(len(leases), 1)
+
+    def test_addresses_without_lease_get_one(self):
+        # addresses loaded from the config expire one ttl after the first check
+        leases = OSCLeases()
+        addr = ('127.0.0.1', 9000)
+        self.assertEqual(leases.check(set([addr]), self.TTL, now=1000), ([], []))
+        self.assertEqual(leases.check(set([addr]), self.TTL, now=1000 + self.TTL * 0.75), ([], [addr]))
+        self.assertEqual(leases.check(set([addr]), self.TTL, now=1001 + self.TTL), ([addr], []))
+
+
+
+class TestOSCStreamServer(unittest.TestCase):
+    def setUp(self):
+        self.server = OSCStreamServer(0, handler=lambda *args: None, maxqueue=4)
+        self.server.wakeup = lambda: None
+
+    def tearDown(self):
+        self.server._wake.close()
+
+    def connect(self):
+        client = OSCStreamClient(self.server, None, ('127.0.0.1', 50000 + len(self.server.clients)), 4)
+        self.server.clients = self.server.clients + (client,)
+        return client
+
+    def test_data_filters_per_client(self):
+        everything, only_a1 = self.connect(), self.connect()
+        self.server.subscribe(everything, data=True)
+        self.server.subscribe(only_a1, data=True, filters=['A1'])
+        sink_a1 = self.server.data_sink('A1', '/data/A')
+        sink_d2 = self.server.data_sink('D2', '/data/D')
+        sink_a1('a1')
+        sink_d2('d2')
+        self.assertEqual(len(everything._dataqueue), 2)
+        self.assertEqual(len(only_a1._dataqueue), 1)
+        # filters by path
+        self.server.subscribe(only_a1, filters=['/data/D'])
+        sink_d2('d2')
+        self.assertEqual(len(only_a1._dataqueue), 2)
+
+    def test_plain_register_clears_the_filters(self):
+        client = self.connect()
+        self.server.subscribe(client, data=True, filters=['A1'])
+        self.server._subscribe(client, '/registerdata', [])
+        self.assertEqual(client.data_filters, ())
+        self.assertTrue(client.data)
+
+    def test_queues_are_bounded(self):
+        client = self.connect()
+        for i in range(10):
+            client.push('reply%d' % i)
+            client.push('data%d' % i, droppable=True)
+        self.assertEqual(list(client._queue), ['reply6', 'reply7', 'reply8', 'reply9'])
+        self.assertEqual(len(client._dataqueue), 4)
+        self.assertEqual(client.dropped, 12)
+
+
+class PartialBatch(object):
+    """sendmmsg stopped after the first destination"""
+    def send(self, packet):
+        return 1
+
+
+class TestOSCDestinations(unittest.TestCase):
+    def setUp(self):
+        self.sender = OSCSender()
+        self.receivers = []
+        for i in range(4):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            sock.settimeout(1)
+            self.receivers.append(sock)
+        self.dests = self.sender.group([sock.getsockname() for sock in self.receivers])
+
+    def tearDown(self):
+        for sock in self.receivers:
+            sock.close()
+        self.sender.close()
+
+    def test_partial_batch_sends_the_rest(self):
+        self.dests._batch = PartialBatch()
+        self.dests.send_packet('packet')
+        for sock in self.receivers[1:]:
+            self.assertEqual(sock.recv(64), 'packet')
+        self.assertEqual(self.dests.dropped, 0)
+
+    @unittest.skipUnless(_MMsgBatch.available, "needs sendmmsg")
+    def test_concurrent_sends(self):
+        self.assertIsNotNone(self.dests._batch)
+        # packets of different sizes, a mixed iovec would send a wrong length
+        packets = [encode_message('/thread%d' % i, 'x' * (i * 50)) for i in range(4)]
+        def sendmany(packet):
+            for _ in range(50):
+                self.dests.send_packet(packet)
+        threads = [threading.Thread(target=sendmany, args=(packet,)) for packet in packets]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        sock = self.receivers[0]
+        sock.settimeout(0.2)
+        received = []
+        try:
+            while True:
+                received.append(sock.recv(4096))
+        except socket.timeout:
+            pass
+        self.assertTrue(received)
+        for packet in received:
+            self.assertIn(packet, packets)
+
+
+if __name__ == '__main__':
+    unittest.main()
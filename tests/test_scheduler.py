@@ -0,0 +1,111 @@
+from __future__ import division as _division, absolute_import as _absolute_import
+
+import time
+import threading
+import unittest
+
+from pedlbrd.scheduler import Scheduler, SchedulerThread
+
+
+class TestScheduler(unittest.TestCase):
+    def test_call_later_runs_when_due(self):
+        scheduler = Scheduler()
+        calls = []
+        scheduler.call_later(10, calls.append, ('late',))
+        scheduler.call_later(5, calls.append, ('early',))
+        now = time.time()
+        scheduler.run(now)
+        self.assertEqual(calls, [])
+        self.assertAlmostEqual(scheduler.deadline, now + 5, delta=0.1)
+        scheduler.run(now + 6)
+        self.assertEqual(calls, ['early'])
+        scheduler.run(now + 11)
+        self.assertEqual(calls, ['early', 'late'])
+        self.assertEqual(scheduler.deadline, float('inf'))
+        self.assertIsNone(scheduler.timeout())
+
+    def test_without_delay_runs_in_the_next_run(self):
+        scheduler = Scheduler()
+        calls = []
+        scheduler.call_later(0, calls.append, (1,))
+        self.assertEqual(scheduler.deadline, 0)
+        scheduler.run()
+        self.assertEqual(calls, [1])
+
+    def test_regular_jobs_keep_their_phase(self):
+        scheduler = Scheduler()
+        calls = []
+        job = scheduler.call_regularly(1, lambda: calls.append(1))
+        start = job.deadline
+        # three periods are missed, the job runs once
+        scheduler.run(start + 3.5)
+        self.assertEqual(len(calls), 1)
+        self.assertAlmostEqual(job.deadline, start + 4)
+        job.cancel()
+        scheduler.run(start + 10)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(scheduler.deadline, float('inf'))
+
+    def test_errors_do_not_stop_the_other_jobs(self):
+        scheduler = Scheduler()
+        calls = []
+        scheduler.call_later(0, lambda: 1 / 0)
+        scheduler.call_later(0, calls.append, (1,))
+        scheduler.run()
+        self.assertEqual(calls, [1])
+
+    def test_sleep_runs_the_jobs_due(self):
+        scheduler = Scheduler()
+        calls = []
+        scheduler.call_later(0.02, calls.append, (1,))
+        start = time.time()
+        scheduler.sleep(0.05)
+        self.assertGreaterEqual(time.time() - start, 0.05)
+        self.assertEqual(calls, [1])
+
+    def test_wakeup_when_the_deadline_moves_earlier(self):
+        wakeups = []
+        scheduler = Scheduler(wakeup=lambda: wakeups.append(1))
+        scheduler.call_later(5, lambda: None)
+        scheduler.call_later(10, lambda: None)
+        self.assertEqual(len(wakeups), 1)
+        scheduler.call_later(0, lambda: None)
+        scheduler.call_later(0, lambda: None)
+        self.assertEqual(len(wakeups), 2)
+
+
+class TestSchedulerThread(unittest.TestCase):
+    def test_jobs_run_in_the_thread(self):
+        scheduler = SchedulerThread()
+        scheduler.start()
+        done = threading.Event()
+        threads = []
+
+        def job():
+            threads.append(threading.current_thread())
+            done.set()
+        try:
+            # added while the thread waits without timeout
+            time.sleep(0.02)
+            scheduler.call_later(0.01, job)
+            self.assertTrue(done.wait(1))
+        finally:
+            scheduler.stop()
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_stop(self):
+        scheduler = SchedulerThread()
+        scheduler.start()
+        calls = []
+        scheduler.call_regularly(0.01, calls.append, (1,))
+        time.sleep(0.05)
+        scheduler.stop()
+        self.assertFalse(scheduler._thread.is_alive())
+        ncalls = len(calls)
+        self.assertGreater(ncalls, 0)
+        time.sleep(0.03)
+        self.assertEqual(len(calls), ncalls)
+
+
+if __name__ == '__main__':
+    unittest.main()
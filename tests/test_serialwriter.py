@@ -0,0 +1,66 @@
+from __future__ import division as _division, absolute_import as _absolute_import
+
+import time
+import unittest
+
+from pedlbrd.serialwriter import SerialWriter
+
+
+class Recorder(object):
+    def __init__(self):
+        self.writes = []
+
+    def __call__(self, data):
+        self.writes.append((time.time(), data))
+
+
+class TestSerialWriter(unittest.TestCase):
+    def setUp(self):
+        self.recorder = Recorder()
+        self.writer = SerialWriter(self.recorder, pacing=0.05)
+
+    def tearDown(self):
+        self.writer.close()
+
+    def gaps(self):
+        times = [t for t, data in self.recorder.writes]
+        return [b - a for a, b in zip(times, times[1:])]
+
+    def test_pacing(self):
+        for i in range(3):
+            self.writer.put('S%d' % i)
+        self.assertTrue(self.writer.drain(1))
+        self.assertEqual([data for t, data in self.recorder.writes], ['S0', 'S1', 'S2'])
+        for gap in self.gaps():
+            self.assertGreaterEqual(gap, 0.045)
+
+    def test_coalescing(self):
+        # while the writer waits to write 'second', a1 is replaced
+        self.writer.pacing = 0.1
+        self.writer.put('first')
+        self.writer.put('second')
+        self.writer.put('a1', key='a')
+        self.writer.put('a2', key='a')
+        self.assertTrue(self.writer.drain(1))
+        self.assertEqual([data for t, data in self.recorder.writes], ['first', 'second', 'a2'])
+
+    def test_shorter_pacing_waits_one_old_period(self):
+        # the device still runs its old loop until it reads the command
+        self.writer.put('faster', pacing=0.01)
+        self.writer.put('next')
+        self.writer.put('last')
+        self.assertTrue(self.writer.drain(1))
+        gaps = self.gaps()
+        self.assertGreaterEqual(gaps[0], 0.045)
+        self.assertLess(gaps[1], 0.04)
+        self.assertEqual(self.writer.pacing, 0.01)
+
+    def test_longer_pacing_applies_at_once(self):
+        self.writer.put('slower', pacing=0.1)
+        self.writer.put('next')
+        self.assertTrue(self.writer.drain(1))
+        self.assertGreaterEqual(self.gaps()[0], 0.095)
+
+
+if __name__ == '__main__':
+    unittest.main()
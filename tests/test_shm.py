@@ -0,0 +1,43 @@
+from __future__ import division as _division, absolute_import as _absolute_import
+
+import os
+import tempfile
+import unittest
+
+from pedlbrd.shm import ShmWriter, ShmReader
+
+
+class TestShm(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.shm')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_roundtrip(self):
+        writer = ShmWriter(2, 2, capacity=4, path=self.path, timefunc=lambda: 1.0)
+        reader = ShmReader(self.path)
+        writer.write('A', 1, 512, 0.5)
+        writer.write('D', 0, 1, 1.0)
+        self.assertEqual([(r.kind, r.pin, r.raw) for r in reader.read()], [('A', 1, 512), ('D', 0, 1)])
+        self.assertEqual(reader.latest('A', 1).norm, 0.5)
+        self.assertIsNone(reader.latest('A', 0))
+        writer.close()
+        reader.close()
+
+    def test_restart_forgets_the_previous_run(self):
+        writer = ShmWriter(2, 2, capacity=4, path=self.path)
+        for i in range(6):
+            writer.write('A', 0, i, i / 10)
+        writer.close()
+        writer = ShmWriter(2, 2, capacity=4, path=self.path)
+        reader = ShmReader(self.path)
+        self.assertEqual(reader.write_count(), 0)
+        self.assertEqual(reader.snapshot(), [None] * 4)
+        writer.close()
+        reader.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
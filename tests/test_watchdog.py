@@ -0,0 +1,67 @@
+from __future__ import division as _division, absolute_import as _absolute_import
+
+import unittest
+
+from pedlbrd.watchdog import HeartbeatWatchdog
+
+
+class TestHeartbeatWatchdog(unittest.TestCase):
+    PERIOD = 0.3
+    TIMEOUT = 3 * PERIOD
+
+    def run_loop(self, watchdog, heartbeats, until, step=0.01):
+        """
+        the mainloop: a serial read times out every step seconds
+        when nothing arrives. heartbeats: the times of the heartbeats
+
+        ==> the time at which the device was lost, or None
+        """
+        heartbeats = sorted(heartbeats)
+        now = 0
+        while now < until:
+            now += step
+            while heartbeats and heartbeats[0] <= now:
+                watchdog.beat(heartbeats.pop(0))
+            if watchdog.lost(now):
+                return now
+        return None
+
+    def test_armed_with_the_first_heartbeat(self):
+        watchdog = HeartbeatWatchdog(self.TIMEOUT)
+        self.assertIsNone(self.run_loop(watchdog, [], 5))
+        lost = self.run_loop(watchdog, [5.2], 10)
+        self.assertAlmostEqual(lost, 5.2 + self.TIMEOUT, delta=0.02)
+
+    def test_disabled(self):
+        watchdog = HeartbeatWatchdog(0)
+        watchdog.beat(0)
+        self.assertFalse(watchdog.lost(100))
+
+    def test_blink(self):
+        # reset_state blinks 15 x 50 ms, right before the next heartbeat was due
+        watchdog = HeartbeatWatchdog(self.TIMEOUT)
+        watchdog.beat(0.0)
+        watchdog.pause(15 * 0.05, 0.29)
+        # the device answers with a heartbeat as soon as it is done
+        heartbeats = [0.0, 0.29 + 0.75 + 0.01]
+        heartbeats += [heartbeats[-1] + self.PERIOD * i for i in range(1, 10)]
+        self.assertIsNone(self.run_loop(watchdog, heartbeats, heartbeats[-1]))
+
+    def test_blink_then_silence(self):
+        # /testblink for 10 s, then the device is unplugged
+        watchdog = HeartbeatWatchdog(self.TIMEOUT)
+        watchdog.beat(0.0)
+        watchdog.pause(10, 0.1)
+        lost = self.run_loop(watchdog, [0.0], 20)
+        self.assertAlmostEqual(lost, 0.1 + 10 + self.TIMEOUT, delta=0.02)
+
+    def test_new_connection_forgets_the_pause(self):
+        watchdog = HeartbeatWatchdog(self.TIMEOUT)
+        watchdog.pause(10, 0)
+        watchdog.reset(1)
+        watchdog.beat(1)
+        self.assertTrue(watchdog.lost(1 + self.TIMEOUT + 0.01))
+
+
+if __name__ == '__main__':
+    unittest.main()
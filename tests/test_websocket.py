@@ -0,0 +1,117 @@
+from __future__ import division as _division, absolute_import as _absolute_import
+
+import struct
+import unittest
+
+from pedlbrd.websocket import WebSocketServer, WebSocketClient, ws_frame
+
+
+class FakeSocket(object):
+    def __init__(self):
+        self.sent = []
+        self.incoming = []
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+    def recv(self, size):
+        return self.incoming.pop(0)
+
+
+def client_frame(payload, opcode=0x2, fin=True, mask='abcd'):
+    """
+    a frame as sent by a browser (masked)
+    """
+    size = len(payload)
+    b0 = (0x80 if fin else 0) | opcode
+    if size < 126:
+        header = struct.pack('>BB', b0, 0x80 | size)
+    else:
+        header = struct.pack('>BBH', b0, 0x80 | 126, size)
+    masked = ''.join(chr(ord(c) ^ ord(mask[i % 4])) for i, c in enumerate(payload))
+    return header + mask + masked
+
+
+REQUEST = ("GET / HTTP/1.1\r\n"
+           "Host: localhost\r\n"
+           "Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+           "Sec-WebSocket-Version: 13\r\n")
+
+
+class TestWebSocketServer(unittest.TestCase):
+    def setUp(self):
+        self.server = WebSocketServer(0, handler=lambda *args: None, maxqueue=4)
+        self.server.wakeup = lambda: None
+
+    def tearDown(self):
+        self.server._wake.close()
+
+    def connect(self):
+        client = WebSocketClient(self.server, FakeSocket(), ('127.0.0.1', 50000 + len(self.server.clients)), 4)
+        self.server.clients = self.server.clients + (client,)
+        return client
+
+    def test_unsubscribe_patterns(self):
+        client = self.connect()
+        self.server._subscribe(client, '/subscribe', ['/data/A', '/data/D'])
+        self.server._subscribe(client, '/unsubscribe', ['/data/A'])
+        self.assertEqual(client.patterns, ['/data/D'])
+        self.assertTrue(client.data)
+
+    def test_unsubscribe_without_patterns(self):
+        client = self.connect()
+        self.server._subscribe(client, '/subscribe', ['/data/A'])
+        self.assertTrue(self.server._subscribe(client, '/unsubscribe', []))
+        self.assertEqual(client.patterns, [])
+        self.assertFalse(client.data)
+        self.assertFalse(client.ui)
+
+    def test_handshake(self):
+        client = self.connect()
+        self.assertTrue(client._handshake(REQUEST + "Upgrade: websocket\r\nConnection: keep-alive, Upgrade\r\n"))
+        self.assertIn("s3pPLMBiTxaQ9kYGzzhZRbK+xOo=", client._queue[0])
+
+    def test_handshake_needs_upgrade(self):
+        for headers in ("", "Upgrade: websocket\r\n", "Connection: Upgrade\r\n",
+                        "Upgrade: h2c\r\nConnection: Upgrade\r\n"):
+            client = self.connect()
+            self.assertFalse(client._handshake(REQUEST + headers))
+            self.assertTrue(client.sock.sent[0].startswith("HTTP/1.1 400"))
+            self.assertFalse(client.handshaken)
+
+
+class TestWebSocketFrames(unittest.TestCase):
+    def setUp(self):
+        self.server = WebSocketServer(0, handler=lambda *args: None, maxqueue=4)
+        self.server.wakeup = lambda: None
+        self.client = WebSocketClient(self.server, FakeSocket(), ('127.0.0.1', 50000), 4)
+        self.client.handshaken = True
+
+    def tearDown(self):
+        self.server._wake.close()
+
+    def receive(self, data):
+        self.client.sock.incoming.append(data)
+        return self.client.read()
+
+    def test_fragments(self):
+        self.assertEqual(self.receive(client_frame('ab', fin=False)), [])
+        self.assertEqual(self.receive(client_frame('cd', opcode=0x0)), ['abcd'])
+
+    def test_message_size_is_capped(self):
+        chunk = 'x' * 60000
+        self.assertEqual(self.receive(client_frame(chunk, fin=False)), [])
+        self.assertIsNone(self.receive(client_frame(chunk, opcode=0x0, fin=False)))
+        self.assertEqual(self.client.sock.sent, [ws_frame(struct.pack('>H', 1009), 0x8)])
+
+    def test_unmasked_frames_are_rejected(self):
+        self.assertIsNone(self.receive(ws_frame('abc')))
+        self.assertEqual(self.client.sock.sent, [ws_frame(struct.pack('>H', 1002), 0x8)])
+
+    def test_close_is_echoed(self):
+        self.assertIsNone(self.receive(client_frame(struct.pack('>H', 1000) + 'bye', opcode=0x8)))
+        self.assertEqual(self.client.sock.sent, [ws_frame(struct.pack('>H', 1000), 0x8)])
+
+
+if __name__ == '__main__':
+    unittest.main()